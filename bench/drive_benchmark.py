@@ -0,0 +1,92 @@
+#!/usr/bin/python
+from __future__ import print_function
+
+import argparse
+import json
+import os.path
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from gdrivepel.fake_drive import FakeDriveServer, FakeDriveTree
+
+# Runs copy_folder.py against a local fake Drive server, once per
+# configuration, and reports wall time, API requests and bytes served.
+#
+#   python bench/drive_benchmark.py --depth 3 --fanout 10 --files 10 \
+#       --config "-w 1" --config "-w 8" --config "-w 8 -f"
+
+COPY_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'copy_folder.py')
+
+def run_config(server, config, dest_base, verbose=False):
+    server.stats.reset()
+    command = [ sys.executable, COPY_FOLDER, '--fake_drive', server.base_url ]
+    command += shlex.split(config)
+    command += [ server.tree.root_id, dest_base ]
+    if verbose:
+        print(' '.join(command))
+
+    output = None if verbose else open(os.devnull, 'w')
+    start_time = time.time()
+    returncode = subprocess.call(command, stdout=output, stderr=output)
+    elapsed = time.time() - start_time
+    if output is not None:
+        output.close()
+
+    stats = server.stats.as_dict()
+    return {
+        'config': config,
+        'returncode': returncode,
+        'seconds': elapsed,
+        'requests': stats['total_requests'],
+        'requests_by_kind': stats['requests'],
+        'errors': stats['errors'],
+        'bytes': stats['bytes_sent']
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark copy_folder.py against a fake Drive server')
+    parser.add_argument('--depth', type=int, default=3, help='levels of folders below the root')
+    parser.add_argument('--fanout', type=int, default=4, help='subfolders per folder')
+    parser.add_argument('--files', type=int, default=10, help='files per folder')
+    parser.add_argument('--file_size', type=int, default=20000, help='average size of PDF and Markdown files')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every API request')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='fraction of requests that fail with 403 or 503')
+    parser.add_argument('--seed', type=int, default=1, help='random seed for the tree and for errors')
+    parser.add_argument('--config', action='append', default=[ ],
+        help='copy_folder.py options for one run, may be repeated (default: "-w 1")')
+    parser.add_argument('--repeat', type=int, default=1, help='runs of each configuration')
+    parser.add_argument('--json', metavar='FILE', help='also write the results to FILE as JSON')
+    parser.add_argument('-v', '--verbose', action='store_true', help='show copy_folder.py output')
+    args = parser.parse_args()
+
+    tree = FakeDriveTree(args.depth, args.fanout, args.files, args.file_size, args.seed)
+    server = FakeDriveServer(tree, latency=args.latency, error_rate=args.error_rate, seed=args.seed)
+    server.start()
+    print('Fake Drive with %s at %s' % (tree.summary(), server.base_url))
+
+    results = [ ]
+    for config in args.config or [ '-w 1' ]:
+        for i in range(args.repeat):
+            # Fresh output folder for every run, so nothing is skipped
+            dest_base = tempfile.mkdtemp(prefix='drive_benchmark_')
+            try:
+                result = run_config(server, config, dest_base, args.verbose)
+            finally:
+                shutil.rmtree(dest_base)
+            results.append(result)
+            print('%-30s %8.2fs %8d requests %6d errors %12d bytes%s' % (config, result['seconds'],
+                result['requests'], result['errors'], result['bytes'],
+                '' if result['returncode'] == 0 else '  (exit status %d)' % result['returncode']))
+
+    server.shutdown()
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({ 'tree': tree.summary(), 'latency': args.latency,
+                'error_rate': args.error_rate, 'results': results }, f, indent=2)
+            f.write('\n')
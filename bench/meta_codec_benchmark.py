@@ -0,0 +1,104 @@
+#!/usr/bin/python
+from __future__ import print_function
+
+import argparse
+import json
+import os.path
+import sys
+import timeit
+import yaml
+
+import dateutil.parser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from gdrivepel.metadata import dump_metadata, load_metadata, parse_date
+
+# Times metadata load, dump and date parsing with plain PyYAML and
+# dateutil, as the downloader and YamlReader used to, against the
+# gdrivepel.metadata codec and the JSON sidecar format.
+
+def make_metadata(i):
+    return {
+        'author': 'Some Author',
+        'basename': 'page-%d.html' % i,
+        'basename_raw': '_raw_page-%d.html' % i,
+        'date': '2016-01-%02dT12:34:56.789Z' % (i % 28 + 1),
+        'dirname': 'sites/folder-%d/subfolder-%d' % (i % 10, i % 7),
+        'email': 'some.author@example.com',
+        'exported_type': 'text/html',
+        'modified': '2016-02-%02dT01:02:03.000Z' % (i % 28 + 1),
+        'relative_url': 'page-%d' % i,
+        'slug': 'page-%d' % i,
+        'sort_priority': 999,
+        'sorted_title': '999]Page %d' % i,
+        'source_id': '1aBcDeFgHiJkLmNoPqRsTuVwXyZ%06d' % i,
+        'source_type': 'application/vnd.google-apps.document',
+        'summary': 'A short summary of page %d, as typed into the Drive description.' % i,
+        'template': None,
+        'title': 'Page %d' % i,
+        'version': str(1000 + i)
+    }
+
+# Long non-ASCII values, which libyaml folds at different points than
+# the pure Python emitter: the text differs, the data loaded back does
+# not
+def make_unicode_metadata(i):
+    metadata = make_metadata(i)
+    metadata['title'] = u'R\u00e9sum\u00e9 \u65e5\u672c\u8a9e %d' % i
+    metadata['summary'] = u' '.join([u'Caf\u00e9 \u00fcber na\u00efve \u2014 \u65e5\u672c\u8a9e'] * 8)
+    return metadata
+
+def best_of(fn, repeat):
+    return min(timeit.repeat(fn, number=1, repeat=repeat))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark metadata serialization')
+    parser.add_argument('-n', '--count', type=int, default=2000, help='metadata documents per run')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each case, best is reported')
+    args = parser.parse_args()
+
+    docs = [make_metadata(i) for i in range(args.count)]
+    yaml_texts = [yaml.safe_dump(d, default_flow_style=False, explicit_start=True) for d in docs]
+    json_texts = [json.dumps(d, sort_keys=True) for d in docs]
+    dates = [d['date'] for d in docs]
+
+    # The codec must give the same results as what it replaces.  For
+    # ASCII metadata the text is the same, for long non-ASCII values
+    # only the data read back is.
+    assert [dump_metadata(d) for d in docs] == yaml_texts
+    assert [load_metadata(t) for t in yaml_texts] == [yaml.load(t, Loader=yaml.SafeLoader) for t in yaml_texts]
+    assert [parse_date(d) for d in dates] == [dateutil.parser.parse(d) for d in dates]
+    unicode_docs = [make_unicode_metadata(i) for i in range(10)]
+    for d in unicode_docs:
+        codec_text = dump_metadata(d)
+        assert load_metadata(codec_text) == d
+        assert yaml.load(codec_text, Loader=yaml.SafeLoader) == d
+        assert load_metadata(yaml.safe_dump(d, default_flow_style=False, explicit_start=True)) == d
+    folded = sum(1 for d in unicode_docs
+        if dump_metadata(d) != yaml.safe_dump(d, default_flow_style=False, explicit_start=True))
+
+    cases = [
+        ('dump', 'yaml.safe_dump',
+            lambda: [yaml.safe_dump(d, default_flow_style=False, explicit_start=True) for d in docs],
+            lambda: [dump_metadata(d) for d in docs]),
+        ('load', 'yaml.load',
+            lambda: [yaml.load(t, Loader=yaml.Loader) for t in yaml_texts],
+            lambda: [load_metadata(t) for t in yaml_texts]),
+        ('load (JSON sidecar)', 'yaml.load',
+            lambda: [yaml.load(t, Loader=yaml.Loader) for t in yaml_texts],
+            lambda: [json.loads(t) for t in json_texts]),
+        ('date', 'dateutil.parser.parse',
+            lambda: [dateutil.parser.parse(d) for d in dates],
+            lambda: [parse_date(d) for d in dates]),
+    ]
+
+    print('%d documents, libyaml %s' % (args.count, 'available' if yaml.__with_libyaml__ else 'NOT available'))
+    print('%d of %d non-ASCII documents dump to different text than yaml.safe_dump, all load back the same' %
+        (folded, len(unicode_docs)))
+    print('%-22s %-24s %10s %10s %8s' % ('case', 'baseline', 'baseline', 'codec', 'speedup'))
+    for name, baseline_name, baseline, codec in cases:
+        baseline_time = best_of(baseline, args.repeat)
+        codec_time = best_of(codec, args.repeat)
+        print('%-22s %-24s %9.3fs %9.3fs %7.1fx' % (name, baseline_name, baseline_time, codec_time,
+            baseline_time / codec_time))
@@ -0,0 +1,198 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import argparse
+import codecs
+import os.path
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from gdrivepel.sanitizer import SANITIZER_ENGINES, make_raw_filename, sanitize
+
+# Checks that the sanitizer engines give the same output, on fixed edge
+# cases, synthetic Google Docs exports and any _raw_*.html files given
+# on the command line, then times each engine on the same documents.
+# Exits with status 1 if any output differs, so --check_only can be run
+# as a regression test.
+
+STYLE = (u'<style type="text/css">ol{margin:0;padding:0}table td,table th{padding:0}'
+    u'.c1{color:#000000;font-size:11pt;font-family:"Arial"}.c3{font-weight:bold}'
+    u'.c5{background-color:#ffffff;max-width:468pt;padding:72pt 72pt 72pt 72pt}'
+    u'.c7{color:#1155cc;text-decoration:underline}.c12{font-style:italic;font-weight:700}'
+    u'.title{padding-top:0pt;color:#000000;font-size:26pt}</style>')
+
+WORDS = (u'the district board policy students school year meeting minutes teachers '
+    u'parents café naïve résumé — “quoted” ‘single’ 5 < 6 & 7 > 3 AT&T').split(' ')
+
+# Bodies for the edge cases that have tripped up one engine or the other
+EDGE_CASES = [
+    ('entities', u'<p class="c0"><span class="c1">&nbsp;&rsquo;&#8217;&#x2019;&amp;amp; &lt;b&gt; &quot;q&quot; '
+        u'&copy;&eacute;&hellip; AT&T 5 < 6 &unknown; &#0;&#xD800;&#150;&#x81;&#1;&#xFFFE;&#65&#128512;</span></p>'),
+    ('nested-spans', u'<p class="c0"><span class="c3">bold <span class="c12">bold italic '
+        u'<span class="c7">underlined</span></span> bold</span><span class="c3"> again</span>'
+        u'<span class="c1"><span></span></span></p>'),
+    ('empty-markup', u'<p class="c0"><span class="c3"> </span></p><p class="c0"></p>'
+        u'<ul class="c8"><li class="c6"><span class="c1"></span></li></ul><p><a href="#h.1"></a></p>'),
+    ('table', u'<table class="c11"><tbody><tr class="c9"><td class="c10" colspan="2" rowspan="1">'
+        u'<p class="c0"><span class="c3">cell</span></p></td><td class="c10"><table><tr><td>'
+        u'<span class="c12">nested</span></td></tr></table></td></tr><tr><th>head</th></tr></tbody></table>'),
+    ('images', u'<p class="c0"><span style="overflow: hidden; display: inline-block; width: 624.00px; height: 416.00px;">'
+        u'<img alt="a &quot;quoted&quot; alt" src="https://lh5.googleusercontent.com/x?a=1&amp;b=2" '
+        u'style="width: 624.00px; height: 416.00px; margin-left: -3.00px; transform: rotate(0.00rad) translateZ(0px); '
+        u'-webkit-transform: rotate(0.00rad);" title=""></span><img src="images/image1.png" style="">'
+        u'<img src="javascript:alert(1)" onerror="alert(1)" style="width: 10px; position: absolute"></p>'),
+    ('comments', u'<!-- top --><p class="c0"><!-- in <p> --><span class="c1">a<!-- in text -->b</span>'
+        u'<!--[if IE]><b>ie</b><![endif]--></p><!---->'),
+    ('scripts', u'<script>alert(1)</script><p class="c0" onclick="x()"><style>p{}</style>'
+        u'<span class="c1"><iframe src="http://example.com"></iframe>text</span></p>'),
+    ('links', u'<p class="c0"><a href="https://www.google.com/url?q=http://example.com/?a%3D1%26b%3D2&amp;sa=D">g</a>'
+        u'<a href="#ftnt1" id="ftnt_ref1">[1]</a><a href="mailto:a@b.org" target="_blank">m</a>'
+        u'<a name="anchor"></a><a href="javascript:void(0)">j</a></p>')
+]
+
+def make_text(rnd, n):
+    return u' '.join([rnd.choice(WORDS) for i in range(n)])
+
+def escape(text):
+    return text.replace(u'&', u'&amp;').replace(u'<', u'&lt;').replace(u'>', u'&gt;')
+
+def make_span(rnd):
+    kind = rnd.randint(0, 9)
+    text = escape(make_text(rnd, rnd.randint(1, 12)))
+    if kind == 0:
+        return u'<span class="c3">%s</span>' % text
+    if kind == 1:
+        url = u'https://www.google.com/url?q=http://example.com/%d?a%%3D1&amp;sa=D&amp;ust=1469' % rnd.randint(0, 99)
+        return u'<span class="c1 c7"><a class="c4" href="%s">%s</a></span>' % (url, text)
+    if kind == 2:
+        return u'<span class="c1">%s&nbsp;&rsquo;&#8217;&amp;&nbsp;</span>' % text
+    if kind == 3:
+        return (u'<span style="overflow: hidden; display: inline-block; width: 624.00px; height: 416.00px;">'
+            u'<img alt="" src="https://lh5.googleusercontent.com/abc%d" style="width: 624.00px; height: 416.00px; '
+            u'margin-left: 0.00px; transform: rotate(0.00rad) translateZ(0px);" title=""></span>' % rnd.randint(0, 99))
+    if kind == 4:
+        return u'<img alt="chart" src="images/image%d.png" style="width: 300.00px; height: 200.00px;">' % rnd.randint(0, 9)
+    if kind == 5:
+        return u'<span class="c1"><a href="javascript:alert(1)">%s</a> <a href="mailto:a@b.org">mail</a></span>' % text
+    if kind == 6:
+        return u'<span class="c1"><a title="Say &quot;hi&quot;" href="#h.%d">%s</a><br></span>' % (rnd.randint(0, 99), text)
+    if kind == 7:
+        return u'<sup><a href="#ftnt%d" id="ftnt_ref%d">[%d]</a></sup>' % ((rnd.randint(1, 9),) * 3)
+    if kind == 8:
+        return u'<!-- comment %d --><span></span>' % rnd.randint(0, 99)
+    if kind == 9 and rnd.randint(0, 1):
+        return u'<span class="c12">%s</span>' % text
+    return u'<span class="c1">%s</span>' % text
+
+def make_paragraph(rnd):
+    spans = u''.join([make_span(rnd) for i in range(rnd.randint(0, 6))])
+    return u'<p class="c0 c%d">%s</p>' % (rnd.randint(1, 9), spans)
+
+def make_block(rnd):
+    kind = rnd.randint(0, 6)
+    if kind == 0:
+        level = rnd.randint(1, 6)
+        return u'<h%d class="c2" id="h.%d"><span>%s</span></h%d>' % (level, rnd.randint(0, 999),
+            escape(make_text(rnd, 4)), level)
+    if kind == 1:
+        items = u''.join([u'<li class="c6">%s</li>' % make_span(rnd) for i in range(rnd.randint(1, 5))])
+        return u'<ul class="c8 lst-kix_list_1-0 start">%s</ul>' % items
+    if kind == 2:
+        items = u''.join([u'<li class="c6">%s</li>' % make_span(rnd) for i in range(rnd.randint(1, 5))])
+        return u'<ol class="c8 lst-kix_list_2-0 start" start="1">%s</ol>' % items
+    if kind == 3:
+        rows = u''.join([u'<tr class="c9">%s</tr>' % u''.join([
+            u'<td class="c10" colspan="1" rowspan="1">%s</td>' % make_paragraph(rnd) for j in range(3)])
+            for i in range(rnd.randint(1, 4))])
+        return u'<table class="c11"><tbody>%s</tbody></table>' % rows
+    if kind == 4:
+        return u'<hr style="page-break-before:always;display:none;"><div>%s</div>' % make_paragraph(rnd)
+    return make_paragraph(rnd)
+
+def wrap_body(body):
+    return (u'<html><head><meta content="text/html; charset=UTF-8" http-equiv="content-type">%s</head>'
+        u'<body class="c5">%s</body></html>' % (STYLE, body))
+
+def make_document(rnd, blocks):
+    return wrap_body(u''.join([make_block(rnd) for i in range(blocks)]))
+
+def edge_case_documents():
+    return [('edge-case-' + name, wrap_body(body)) for name, body in EDGE_CASES]
+
+def make_metadata(i):
+    return { 'title': u'Page %d' % i, 'slug': 'page-%d' % i, 'sort_priority': 999 }
+
+def read_documents(paths):
+    documents = [ ]
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                for filename in sorted(filenames):
+                    if filename.startswith(make_raw_filename('')) and filename.endswith('.html'):
+                        documents.append(os.path.join(dirpath, filename))
+        else:
+            documents.append(path)
+    result = [ ]
+    for path in documents:
+        with codecs.open(path, 'r', 'utf-8') as f:
+            result.append((path, f.read()))
+    return result
+
+def first_difference(a, b):
+    i = 0
+    while i < min(len(a), len(b)) and a[i] == b[i]:
+        i += 1
+    return i
+
+def check(documents, engines, verbose):
+    mismatches = 0
+    for i, (name, content) in enumerate(documents):
+        outputs = [sanitize(content, make_metadata(i), engine) for engine in engines]
+        for engine, output in zip(engines[1:], outputs[1:]):
+            if output != outputs[0]:
+                mismatches += 1
+                j = first_difference(outputs[0], output)
+                print('%s: %s and %s differ at %d' % (name, engines[0], engine, j))
+                if verbose:
+                    print('  %s: %r' % (engines[0], outputs[0][max(0, j - 60):j + 60]))
+                    print('  %s: %r' % (engine, output[max(0, j - 60):j + 60]))
+    print('Checked %d documents, %d mismatches' % (len(documents), mismatches))
+    return mismatches
+
+def time_engine(documents, engine, repeat):
+    size = sum([len(content.encode('utf-8')) for name, content in documents])
+    best = None
+    for r in range(repeat):
+        start_time = time.time()
+        for i, (name, content) in enumerate(documents):
+            sanitize(content, make_metadata(i), engine)
+        elapsed = time.time() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+    return (len(documents) / best, size / best / 1024.0 / 1024.0, best)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the sanitizer engines for equal output and speed')
+    parser.add_argument('--documents', type=int, default=50, help='number of synthetic documents')
+    parser.add_argument('--blocks', type=int, default=200, help='paragraphs, lists and tables per document')
+    parser.add_argument('--repeat', type=int, default=3, help='timing runs per engine, the best is reported')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--check_only', action='store_true', help='only compare output, for use as a regression test')
+    parser.add_argument('-v', '--verbose', action='store_true', help='show where outputs differ')
+    parser.add_argument('paths', nargs='*', metavar='PATH', help='_raw_*.html files, or folders to search for them')
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    documents = edge_case_documents()
+    documents += [('synthetic-%d' % i, make_document(rnd, args.blocks)) for i in range(args.documents)]
+    documents += read_documents(args.paths)
+
+    mismatches = check(documents, SANITIZER_ENGINES, args.verbose)
+    if not args.check_only:
+        for engine in SANITIZER_ENGINES:
+            docs_per_second, mb_per_second, seconds = time_engine(documents, engine, args.repeat)
+            print('%-8s %8.1f docs/sec %8.2f MB/sec %8.2fs' % (engine, docs_per_second, mb_per_second, seconds))
+    sys.exit(1 if mismatches else 0)
@@ -0,0 +1,96 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import argparse
+from multiprocessing.pool import ThreadPool
+import os.path
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from gdrivepel.sanitizer import SANITIZER_ENGINES, Sanitizer, check_engine
+from sanitizer_benchmark import first_difference, make_document, make_metadata
+
+# Sanitizes many synthetic documents in a thread pool and checks that
+# each one comes out the same as when it is sanitized on its own, by a
+# fresh Sanitizer.  Each document has its own bold class, or none, so
+# state leaking from one document into another shows up as different
+# output.  Exits with status 1 on any difference, or if no engine could
+# be tested, so it can be run as a regression test.
+
+def make_documents(rnd, count, blocks):
+    documents = [ ]
+    for i in range(count):
+        content = make_document(rnd, blocks)
+        if i % 4 == 3:
+            content = content.replace(u'font-weight:bold', u'font-weight:400')
+        else:
+            content = content.replace(u'c3', u'c%d' % rnd.randint(12, 99))
+        documents.append(content)
+    return documents
+
+def sanitize_all(sanitizer, documents, threads):
+    def sanitize_one(i):
+        return sanitizer.sanitize(documents[i], make_metadata(i))
+    if threads <= 1:
+        return [sanitize_one(i) for i in range(len(documents))]
+    pool = ThreadPool(threads)
+    try:
+        # chunksize 1, so that threads interleave as much as possible
+        return pool.map(sanitize_one, range(len(documents)), 1)
+    finally:
+        pool.close()
+        pool.join()
+
+def stress(engine, documents, threads, rounds):
+    start_time = time.time()
+    expected = [Sanitizer(engine).sanitize(content, make_metadata(i)) for i, content in enumerate(documents)]
+    serial_seconds = time.time() - start_time
+    sanitizer = Sanitizer(engine)
+    mismatches = 0
+    start_time = time.time()
+    for r in range(rounds):
+        outputs = sanitize_all(sanitizer, documents, threads)
+        for i, (output, serial_output) in enumerate(zip(outputs, expected)):
+            if output != serial_output:
+                mismatches += 1
+                print('%s: document %d differs from sanitizing it on its own at %d (round %d)' % (
+                    engine, i, first_difference(serial_output, output), r + 1))
+    threaded_seconds = (time.time() - start_time) / rounds
+    print('%-8s %d documents, %d threads x %d rounds: %d mismatches, serial %.2fs, threaded %.2fs' % (
+        engine, len(documents), threads, rounds, mismatches, serial_seconds, threaded_seconds))
+    return mismatches
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check that sanitizing in threads gives the serial output')
+    parser.add_argument('--documents', type=int, default=400, help='number of synthetic documents')
+    parser.add_argument('--blocks', type=int, default=20, help='paragraphs, lists and tables per document')
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--rounds', type=int, default=2, help='threaded runs to compare')
+    parser.add_argument('--engine', choices=SANITIZER_ENGINES, action='append',
+        help='engine to test, default all installed ones')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    engines = args.engine
+    if not engines:
+        engines = [ ]
+        for engine in SANITIZER_ENGINES:
+            try:
+                check_engine(engine)
+                engines.append(engine)
+            except ImportError:
+                print('Skipping %s, not installed' % engine)
+
+    if not engines:
+        print('No sanitizer engine to test')
+        sys.exit(1)
+
+    documents = make_documents(random.Random(args.seed), args.documents, args.blocks)
+    mismatches = 0
+    for engine in engines:
+        mismatches += stress(engine, documents, args.threads, args.rounds)
+    sys.exit(1 if mismatches else 0)
@@ -0,0 +1,120 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import argparse
+import os.path
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from gdrivepel.generators import YamlGenerator
+
+# Times the section phase of YamlGenerator.prepare_pages_for_output
+# (categorizing, section links and navmenus, section templates for
+# pages) on a synthetic site, and checks the section links against the
+# old way of finding them, a scan of every doc and _folder_.yml for
+# each folder.  Section index pages are not created, they need a full
+# Pelican context.
+
+# Stand-ins for the content classes, YamlGenerator only looks at the
+# class name, metadata and url
+class Content(object):
+    def __init__(self, location, title):
+        self.metadata = { 'title': title, 'slug': os.path.basename(location) }
+        self.url = location
+        self.template = 'page'
+
+class Page(Content):
+    pass
+
+class Static(Content):
+    pass
+
+class DocMeta(Content):
+    pass
+
+def make_filenames(folders, docs):
+    filenames = { }
+    folder_list = [ 'pages' ]
+    i = 0
+    while len(folder_list) < folders:
+        parent = folder_list[i // 8]
+        folder_list.append(os.path.join(parent, 'folder-%d' % len(folder_list)))
+        i += 1
+    for n, folder in enumerate(folder_list):
+        location = os.path.join(folder, '_folder_.yml')
+        filenames[location] = DocMeta(location, 'Folder %d' % n)
+    for n in range(docs):
+        folder = folder_list[n % len(folder_list)]
+        if n % 5 == 4:
+            location = os.path.join(folder, 'handout-%d.pdf' % n)
+            filenames[location] = Static(location, 'Handout %d' % n)
+        else:
+            location = os.path.join(folder, 'page-%d.html' % n)
+            filenames[location] = Page(location, 'Page %d' % n)
+    return filenames
+
+def make_generator(filenames):
+    generator = object.__new__(YamlGenerator)
+    generator.context = { 'filenames': filenames }
+    generator.settings = { 'SITEURL': '' }
+    generator.by_classes = { }
+    generator.folders = { }
+    generator.navmenus = { }
+    generator.index_pages = [ ]
+    generator._create_section_index = lambda folder, section_meta: None
+    return generator
+
+# The links _build_section_links used to find by scanning
+def scan_section_links(generator, folder):
+    doc_links = [ ]
+    for location, doc in generator.by_classes['Doc'].iteritems():
+        if os.path.dirname(location) == folder:
+            title = doc.metadata['title']
+            doc_links.append((title, doc.url))
+    subfolder_links = [ ]
+    for location, doc_meta in generator.by_classes['DocMeta'].iteritems():
+        dirname, fname = os.path.split(location)
+        if fname == '_folder_.yml' and os.path.dirname(dirname) == folder:
+            subfolder_links.append((doc_meta.metadata['title'], dirname))
+    return sorted(doc_links), sorted(subfolder_links)
+
+def check_links(generator, folders):
+    mismatches = 0
+    for folder in folders:
+        section_meta = generator.folders[folder]['folder_meta']
+        doc_links, subfolder_links = scan_section_links(generator, folder)
+        contents = sorted((link['title'], link['location']) for link in section_meta.metadata['contents'])
+        subtopics = sorted((link['title'], link['location']) for link in section_meta.metadata['subtopics'])
+        if contents != doc_links or subtopics != subfolder_links:
+            mismatches += 1
+            print('Section links differ for %s' % folder)
+    return mismatches
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time building sections for a synthetic site')
+    parser.add_argument('--folders', type=int, default=2000)
+    parser.add_argument('--docs', type=int, default=20000)
+    parser.add_argument('--check', type=int, default=50,
+        help='number of sections to check against a full scan (slow)')
+    args = parser.parse_args()
+
+    filenames = make_filenames(args.folders, args.docs)
+    generator = make_generator(filenames)
+
+    start_time = time.time()
+    generator._categorize_filenames()
+    generator._build_sections()
+    generator._set_sections_for_pages()
+    seconds = time.time() - start_time
+
+    sections = sum(1 for page in generator.by_classes['Page'].itervalues() if page.template == 'section')
+    print('%d folders, %d docs: sections built in %.2fs, %d pages in sections' % (
+        args.folders, args.docs, seconds, sections))
+
+    folders = sorted(folder for folder, entry in generator.folders.iteritems() if entry['folder_meta'] is not None)[:args.check]
+    mismatches = check_links(generator, folders)
+    print('%d of %d sections checked against a full scan differ' % (mismatches, len(folders)))
+    sys.exit(1 if mismatches else 0)
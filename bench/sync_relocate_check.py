@@ -0,0 +1,125 @@
+#!/usr/bin/python
+from __future__ import print_function
+
+import argparse
+import json
+import os.path
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from drive_benchmark import run_config
+from gdrivepel.fake_drive import DOCUMENT_MIME_TYPE, FakeDriveServer, FakeDriveTree
+from gdrivepel.manifest import DownloadManifest, make_manifest_filename
+from gdrivepel.run_metrics import make_report_filename
+
+# Checks that copy_folder.py --sync relocates renamed and moved items
+# instead of fetching them again, although Drive bumps their version.
+# Crawls a fake Drive, renames a doc and a PDF, moves a Markdown file to
+# a subfolder, edits one doc and one PDF, then crawls again.  Only the
+# edited items may be exported or downloaded, and the renamed and moved
+# ones must be at their new paths, with the old ones pruned.
+#
+#   python bench/sync_relocate_check.py -v
+
+# Files directly in the root folder (folders all have a children list)
+def root_files(tree):
+    return [tree.items[item_id] for item_id in tree.children[tree.root_id] if item_id not in tree.children]
+
+def first_of_type(items, test, skip=()):
+    for item in items:
+        if test(item) and item['id'] not in skip:
+            return item
+    raise ValueError('The tree is too small, use more --files')
+
+def is_doc(item):
+    return item['mimeType'] == DOCUMENT_MIME_TYPE
+
+def is_pdf(item):
+    return item['mimeType'] == 'application/pdf'
+
+def is_markdown(item):
+    return item['mimeType'] == 'text/plain'
+
+def read_manifest(tree, dest_base):
+    manifest = DownloadManifest(os.path.join(dest_base, make_manifest_filename(tree.root_id)))
+    return manifest.load()
+
+def check(tree, server, dest_base, config, verbose=False):
+    failures = [ ]
+    first = run_config(server, config, dest_base, verbose)
+    if first['returncode'] != 0:
+        return [ 'first crawl exited with status %d' % first['returncode'] ]
+    previous = read_manifest(tree, dest_base)
+
+    files = root_files(tree)
+    renamed_doc = first_of_type(files, is_doc)
+    renamed_pdf = first_of_type(files, is_pdf)
+    moved_markdown = first_of_type(files, is_markdown)
+    edited_doc = first_of_type(files, is_doc, skip=[ renamed_doc['id'] ])
+    edited_pdf = first_of_type(files, is_pdf, skip=[ renamed_pdf['id'] ])
+    subfolder_id = [item_id for item_id in tree.children[tree.root_id] if item_id in tree.children][0]
+
+    tree.rename(renamed_doc['id'], renamed_doc['title'] + ' renamed')
+    tree.rename(renamed_pdf['id'], 'Renamed ' + renamed_pdf['title'])
+    tree.move(moved_markdown['id'], subfolder_id)
+    # Content changes: a new modified date for the doc, a new checksum for the PDF
+    edited_doc['modifiedDate'] = '2016-02-01T00:00:00.000Z'
+    edited_doc['version'] = str(int(edited_doc['version']) + 1)
+    edited_pdf['md5Checksum'] = '0' * 32
+    edited_pdf['version'] = str(int(edited_pdf['version']) + 1)
+    relocated_ids = [ renamed_doc['id'], renamed_pdf['id'], moved_markdown['id'] ]
+
+    second = run_config(server, config, dest_base, verbose)
+    if second['returncode'] != 0:
+        return [ 'second crawl exited with status %d' % second['returncode'] ]
+    requests = second['requests_by_kind']
+    if requests.get('export', 0) != 1:
+        failures.append('%d exports, expected 1 for the edited doc' % requests.get('export', 0))
+    if requests.get('download', 0) != 1:
+        failures.append('%d downloads, expected 1 for the edited PDF' % requests.get('download', 0))
+
+    current = read_manifest(tree, dest_base)
+    for item_id in relocated_ids:
+        old_paths = previous[item_id]['paths']
+        new_paths = current[item_id]['paths']
+        if sorted(old_paths) == sorted(new_paths):
+            failures.append('%s kept its old paths %s' % (item_id, old_paths))
+        for path in new_paths:
+            if not os.path.exists(os.path.join(dest_base, path)):
+                failures.append('%s is missing %s' % (item_id, path))
+        for path in old_paths:
+            if path not in new_paths and os.path.exists(os.path.join(dest_base, path)):
+                failures.append('%s left %s behind' % (item_id, path))
+
+    with open(os.path.join(dest_base, make_report_filename(tree.root_id))) as f:
+        relocated = json.load(f)['sync']['relocated']
+    if relocated != len(relocated_ids):
+        failures.append('%d items relocated, expected %d' % (relocated, len(relocated_ids)))
+    return failures
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check that --sync relocates renamed and moved items')
+    parser.add_argument('--files', type=int, default=6, help='files per folder, at least 6')
+    parser.add_argument('--config', default='-s -w 2 -p 2 --qps 1000',
+        help='copy_folder.py options for both crawls, with -s')
+    parser.add_argument('-v', '--verbose', action='store_true', help='show copy_folder.py output')
+    args = parser.parse_args()
+
+    tree = FakeDriveTree(depth=1, fanout=2, files=args.files)
+    server = FakeDriveServer(tree)
+    server.start()
+    dest_base = tempfile.mkdtemp(prefix='sync_relocate_check_')
+    try:
+        failures = check(tree, server, dest_base, args.config, args.verbose)
+    finally:
+        shutil.rmtree(dest_base)
+        server.shutdown()
+
+    for failure in failures:
+        print('FAILED: %s' % failure)
+    print('%s: renamed and moved items %s' % (args.config,
+        'were relocated without fetching' if not failures else 'were not all relocated'))
+    sys.exit(1 if failures else 0)
@@ -6,17 +6,82 @@ import sys
 # Find patched bleach module
 sys.path.append(os.path.join(os.path.dirname(__file__), '../bleach'))
 
-from gdrivepel.downloader import GDriveDownloader
+from gdrivepel.downloader import GDriveDownloader, default_drive_auth
+from gdrivepel.multisite import MultiSiteCrawl, read_multisite_roots
+from gdrivepel.sanitizer import SANITIZER_ENGINES, DEFAULT_SANITIZER_ENGINE, check_engine
 
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='Recursively downloads the contents of a Google Drive folder to a path on the local machine')
     parser.add_argument('-v', '--verbose', action='store_true', help='print progress on stdout')
     parser.add_argument('-n', '--stats_only', action='store_true', help='get statistics (no downloading)')
-    parser.add_argument('src_folder_id', metavar='SRC_FOLDER_ID', help='top level Google Drive folder id')
+    parser.add_argument('--stats_dir', help='directory for the --stats_only files (default: DEST_BASE)')
+    parser.add_argument('-i', '--incremental', action='store_true', help='skip items unchanged since the last run')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='number of concurrent download threads')
+    parser.add_argument('--api', choices=['v2', 'v3'], default='v2', help='Google Drive API version to use')
+    parser.add_argument('-f', '--flat', action='store_true', help='list the whole drive in one paged query instead of folder by folder')
+    parser.add_argument('--qps', type=float, default=10.0, help='maximum Drive API requests per second')
+    parser.add_argument('--max_retries', type=int, default=8, help='retries for rate limited or failed requests')
+    parser.add_argument('-p', '--post_workers', type=int, default=None, help='number of post-processing processes (default: one per core)')
+    parser.add_argument('--pipeline', action='store_true', help='sanitize each doc as soon as it is downloaded')
+    parser.add_argument('--cache_dir', help='directory for a local cache of exported content')
+    parser.add_argument('--cache_size', type=int, default=1024, help='maximum export cache size in MB')
+    parser.add_argument('--fake_drive', metavar='URL', help='use the fake Drive server at URL instead of Google Drive')
+    parser.add_argument('--progress', type=float, default=0, metavar='SECONDS', help='print a progress line every SECONDS')
+    parser.add_argument('-r', '--resume', action='store_true', help='continue an interrupted run, skipping items it finished')
+    parser.add_argument('--meta_sidecar', action='store_true', help='also write metadata as JSON, which is faster to read')
+    parser.add_argument('--engine', choices=['threads', 'batch'], default='threads',
+        help='crawl engine: worker threads, or batch requests for folder listings')
+    parser.add_argument('-s', '--sync', action='store_true',
+        help='relocate moved items and prune removed ones (implies --incremental)')
+    parser.add_argument('--sanitizer', choices=SANITIZER_ENGINES, default=DEFAULT_SANITIZER_ENGINE,
+        help='HTML sanitizer: bleach, or the faster lxml')
+    parser.add_argument('--localize_images', action='store_true',
+        help='copy the images in exported docs next to the pages (needs --cache_dir)')
+    parser.add_argument('--zip_export', action='store_true',
+        help='export each doc as a zip of its HTML and images, in one request')
+    parser.add_argument('--multisite', metavar='PELICANCONF',
+        help='crawl the GDRIVE_FOLDER_ID of each MULTISITE entry in PELICANCONF')
+    parser.add_argument('src_folder_ids', metavar='SRC_FOLDER_ID', nargs='*',
+        help='top level Google Drive folder id; with more than one, all are crawled in one process')
     parser.add_argument('dest_base', metavar='DEST_BASE', help='top level path')
 
     args = parser.parse_args()
-    downloader = GDriveDownloader(verbose=args.verbose, stats_only=args.stats_only)
-    downloader.recursiveDownloadInto(args.src_folder_id, args.dest_base)
-    downloader.postProcess()
+    roots = [(folder_id, folder_id) for folder_id in args.src_folder_ids]
+    if args.multisite:
+        try:
+            roots += read_multisite_roots(args.multisite)
+        except (IOError, SyntaxError, ValueError) as e:
+            parser.error(str(e))
+    if not roots:
+        parser.error('a SRC_FOLDER_ID or --multisite is required')
+    if args.localize_images and not args.cache_dir:
+        parser.error('--localize_images needs a --cache_dir')
+    try:
+        check_engine(args.sanitizer)
+    except ImportError as e:
+        parser.error(str(e))
+    drive_auth = None
+    if args.fake_drive:
+        if args.api != 'v2':
+            parser.error('the fake Drive server only implements the v2 API')
+        # Only test runs need the fake server and its http server
+        from gdrivepel.fake_drive import FakeDriveServiceAuth
+        drive_auth = FakeDriveServiceAuth(args.fake_drive)
+    downloader_args = dict(verbose=args.verbose, stats_only=args.stats_only,
+        incremental=args.incremental, workers=args.workers, api_version=args.api,
+        flat_listing=args.flat, max_qps=args.qps, max_retries=args.max_retries,
+        post_workers=args.post_workers, pipeline=args.pipeline,
+        cache_dir=args.cache_dir, cache_size=args.cache_size,
+        progress_interval=args.progress, resume=args.resume,
+        meta_sidecar=args.meta_sidecar, engine=args.engine, sync=args.sync,
+        sanitizer_engine=args.sanitizer, localize_images=args.localize_images,
+        zip_export=args.zip_export, stats_dir=args.stats_dir)
+    if len(roots) > 1:
+        if drive_auth is None:
+            drive_auth = default_drive_auth(args.api)
+        MultiSiteCrawl(roots, args.dest_base, GDriveDownloader, downloader_args).run(drive_auth)
+    else:
+        downloader = GDriveDownloader(drive_auth=drive_auth, **downloader_args)
+        downloader.recursiveDownloadInto(roots[0][1], args.dest_base)
+        downloader.postProcess()
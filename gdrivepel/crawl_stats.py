@@ -0,0 +1,212 @@
+import csv
+import json
+import os.path
+import time
+
+# Aggregates for the --stats_only crawl: sizes by folder and type,
+# folder shapes and listing latency, plus a few sampled downloads to
+# estimate how long a full download of the drive would take.
+
+# Folders listed in each top-N section of the report
+STATS_TOP_N = 20
+
+# Downloads and exports timed to measure throughput
+STATS_SAMPLE_DOWNLOADS = 3
+STATS_SAMPLE_EXPORTS = 3
+
+def item_size(item, key):
+    # Sizes come back from the API as strings, and are missing for Google Docs
+    try:
+        return int(item.get(key) or 0)
+    except ValueError:
+        return 0
+
+def path_depth(path):
+    return len([p for p in path.split('/') if p])
+
+class CrawlStats(object):
+    def __init__(self, root_id=None):
+        self.root_id = root_id
+        self.start_time = time.time()
+        # folder path -> aggregates for the files directly in it
+        self.folders = { }
+        # mime type -> { 'count', 'bytes', 'quota_bytes' }
+        self.types = { }
+        # folder id -> seconds spent listing it.  Written by the
+        # listing threads, one key each, so no lock needed.
+        self.listing_seconds = { }
+        # Folder ids listed with batch requests, which are timed as an
+        # equal share of each batch request
+        self.batched_listings = set()
+        self.flat_listing_seconds = None
+        # (title, url, is_export) for throughput sampling
+        self.download_samples = [ ]
+        self.export_samples = [ ]
+        # (bytes, seconds) for each sampled request
+        self.download_times = [ ]
+        self.export_times = [ ]
+
+    def folder_entry(self, path):
+        entry = self.folders.get(path)
+        if entry is None:
+            entry = {
+                'path': path,
+                'source_id': None,
+                'depth': max(0, path_depth(path) - 1),
+                'files': 0,
+                'folders': 0,
+                'bytes': 0,
+                'quota_bytes': 0,
+                'listing_seconds': None
+            }
+            self.folders[path] = entry
+        return entry
+
+    def record_folder(self, folder_meta):
+        path = os.path.join(folder_meta['dirname'], folder_meta['basename']).lstrip('/')
+        entry = self.folder_entry(path)
+        entry['source_id'] = folder_meta['source_id']
+        if folder_meta['dirname'] != '/':
+            self.folder_entry(folder_meta['dirname'])['folders'] += 1
+
+    def record_file(self, item, file_meta, download_url):
+        size = item_size(item, 'fileSize')
+        quota_bytes = item_size(item, 'quotaBytesUsed')
+        entry = self.folder_entry(file_meta['dirname'])
+        entry['files'] += 1
+        entry['bytes'] += size
+        entry['quota_bytes'] += quota_bytes
+
+        mime_type = item['mimeType']
+        type_entry = self.types.setdefault(mime_type, { 'count': 0, 'bytes': 0, 'quota_bytes': 0 })
+        type_entry['count'] += 1
+        type_entry['bytes'] += size
+        type_entry['quota_bytes'] += quota_bytes
+
+        if download_url:
+            if 'fileSize' in item:
+                if len(self.download_samples) < STATS_SAMPLE_DOWNLOADS:
+                    self.download_samples.append((item['title'], download_url, False))
+            elif len(self.export_samples) < STATS_SAMPLE_EXPORTS:
+                self.export_samples.append((item['title'], download_url, True))
+
+    # Called once per page of a batched listing
+    def record_listing(self, folder_id, seconds, batched=False):
+        self.listing_seconds[folder_id] = self.listing_seconds.get(folder_id, 0.0) + seconds
+        if batched:
+            self.batched_listings.add(folder_id)
+
+    def record_sample(self, is_export, size, seconds):
+        if is_export:
+            self.export_times.append((size, seconds))
+        else:
+            self.download_times.append((size, seconds))
+
+    # Subtree totals, computed bottom up from the per-folder entries
+    def subtree_totals(self):
+        totals = dict([(path, { 'files': 0, 'bytes': 0, 'quota_bytes': 0 }) for path in self.folders])
+        for path, entry in self.folders.items():
+            parts = [p for p in path.split('/') if p]
+            for i in range(len(parts) + 1):
+                ancestor = '/'.join(parts[:i])
+                if ancestor in totals:
+                    totals[ancestor]['files'] += entry['files']
+                    totals[ancestor]['bytes'] += entry['bytes']
+                    totals[ancestor]['quota_bytes'] += entry['quota_bytes']
+        return totals
+
+    def folder_rows(self):
+        totals = self.subtree_totals()
+        rows = [ ]
+        for path in sorted(self.folders.keys()):
+            entry = dict(self.folders[path])
+            entry['listing_seconds'] = self.listing_seconds.get(entry['source_id'])
+            entry['children'] = entry['files'] + entry['folders']
+            entry['total_files'] = totals[path]['files']
+            entry['total_bytes'] = totals[path]['bytes']
+            entry['total_quota_bytes'] = totals[path]['quota_bytes']
+            rows.append(entry)
+        return rows
+
+    def throughput(self):
+        download_bytes = sum([b for b, s in self.download_times])
+        download_seconds = sum([s for b, s in self.download_times])
+        export_seconds = sum([s for b, s in self.export_times])
+        return {
+            'sampled_downloads': len(self.download_times),
+            'sampled_download_bytes': download_bytes,
+            'sampled_download_seconds': download_seconds,
+            'bytes_per_second': download_bytes / download_seconds if download_seconds > 0 else None,
+            'sampled_exports': len(self.export_times),
+            'seconds_per_export': export_seconds / len(self.export_times) if self.export_times else None
+        }
+
+    def report(self, top_n=STATS_TOP_N):
+        rows = self.folder_rows()
+        listing_times = list(self.listing_seconds.values())
+        total_bytes = sum([e['bytes'] for e in self.folders.values()])
+        exported_docs = sum([t['count'] for m, t in self.types.items()
+            if m.startswith('application/vnd.google-apps.')])
+
+        throughput = self.throughput()
+        estimate = None
+        if throughput['bytes_per_second'] or throughput['seconds_per_export']:
+            estimate = 0.0
+            if throughput['bytes_per_second']:
+                estimate += total_bytes / throughput['bytes_per_second']
+            if throughput['seconds_per_export']:
+                estimate += exported_docs * throughput['seconds_per_export']
+
+        def top(key):
+            return [dict((k, r[k]) for k in ['path', 'depth', key])
+                for r in sorted(rows, key=lambda r: (-r[key], r['path']))[:top_n]]
+
+        return {
+            'root_id': self.root_id,
+            'generated': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'crawl_seconds': time.time() - self.start_time,
+            'totals': {
+                'files': sum([e['files'] for e in self.folders.values()]),
+                'folders': len(self.folders),
+                'bytes': total_bytes,
+                'quota_bytes': sum([e['quota_bytes'] for e in self.folders.values()]),
+                'google_docs': exported_docs,
+                'max_depth': max([r['depth'] for r in rows] or [0])
+            },
+            'listing': {
+                'folders_listed': len(listing_times),
+                'folders_batched': len(self.batched_listings),
+                'total_seconds': sum(listing_times),
+                'max_seconds': max(listing_times or [0]),
+                'flat_listing_seconds': self.flat_listing_seconds
+            },
+            'bytes_by_type': self.types,
+            'top_folders_by_files': top('total_files'),
+            'top_folders_by_bytes': top('total_bytes'),
+            'widest_folders': top('children'),
+            'deepest_folders': top('depth'),
+            'throughput': throughput,
+            'estimated_download_seconds': estimate
+        }
+
+    def write_report(self, json_file, csv_file):
+        report = self.report()
+        with open(json_file, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+        fields = [ 'path', 'source_id', 'depth', 'files', 'folders', 'bytes', 'quota_bytes',
+            'total_files', 'total_bytes', 'total_quota_bytes', 'listing_seconds' ]
+        with open(csv_file, 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow(fields)
+            for row in self.folder_rows():
+                writer.writerow([encode_cell(row[k]) for k in fields])
+        return report
+
+def encode_cell(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
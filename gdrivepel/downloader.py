@@ -1,16 +1,32 @@
 from __future__ import print_function
 
 import codecs
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import os.path
 from pprint import pprint as pp
+import Queue
 import re
 import sys
-import yaml
+import threading
+import time
+import traceback
 
-from drive_service import DriveServiceAuth
+from drive_service import (DriveServiceAuth, all_drives_url, v3_to_v2_file,
+    V3_FILE_FIELDS, V3_LIST_FIELDS, V3_ROOT_FIELDS)
+from crawl_stats import CrawlStats
+from export_cache import ExportCache
+from images import ImageLocalizer, IMAGE_FETCH_THREADS
+from journal import CrawlJournal, make_journal_filename
+from manifest import DownloadManifest, make_content_id, make_manifest_filename
+from metadata import load_metadata, read_metadata, write_metadata
+from run_metrics import RunMetrics, make_report_filename
+from sanitized_cache import SanitizedCache
+from scheduler import RequestScheduler
+from zip_export import ZIP_EXPORT_TYPE, unpack_doc_zip
 
 from sanitizer import (slugify, make_raw_filename, make_meta_filename, 
-    sanitize_html_file, prepend_markdown_metadata)
+    sanitize_html_file, prepend_markdown_metadata, check_engine, DEFAULT_SANITIZER_ENGINE)
 
 # List of atributes that users can put in Google Drive, Markdown, HTML, etc.
 USER_META_KEYS = [ 
@@ -29,24 +45,192 @@ GDRIVE_EXPORT_AS = {
 }
 
 STATS_META_FIELDS = [ 'title', 'basename', 'dirname', 'source_id', 'source_type', 'exported_type' ]
+STATS_ITEM_FIELDS = [ 'fileSize', 'quotaBytesUsed' ]
+STATS_COLUMNS = STATS_META_FIELDS + [ 'item_type', 'depth', 'file_size', 'quota_bytes' ]
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+# One listing per folder; files and subfolders are split up locally
+CHILDREN_QUERY = '"%s" in parents and trashed = false'
+
+# Most requests allowed in one batch request
+BATCH_SIZE = 100
+
+# Everything in the drive, for the flat listing crawl strategy
+ALL_ITEMS_QUERY = 'trashed = false'
+
+# Largest page size that files().list accepts
+LIST_PAGE_SIZE = 1000
+
+# Drive answers 404 for shared drive items, and leaves them out of
+# lists, unless the request says it supports them
+ALL_DRIVES_ARGS = { 'supportsAllDrives': True }
+LIST_ALL_DRIVES_ARGS = { 'supportsAllDrives': True, 'includeItemsFromAllDrives': True }
+
+# Bytes per Range request when streaming downloads to disk
+DOWNLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Files handed to each post-processing worker at a time
+POST_PROCESS_CHUNK_SIZE = 4
+
+# Waiting on the pool with a timeout lets KeyboardInterrupt through
+POST_PROCESS_TIMEOUT = 7 * 24 * 3600
+
+# Worker thread entry point for GDriveDownloader.concurrentDownloadInto.
+# Exceptions are handed back to the coordinating thread with the token.
+def run_task(token, fn, args):
+    try:
+        return (token, fn(*args), None)
+    except Exception as e:
+        traceback.print_exc()
+        return (token, None, e)
+
+# OAuth with client_secrets.json and credentials.json next to copy_folder.py
+def default_drive_auth(api_version='v2'):
+    secrets_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'client_secrets.json')
+    credentials_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'credentials.json')
+    return DriveServiceAuth(secrets_path, credentials_path, api_version=api_version)
+
+def read_meta(meta_file):
+    return read_metadata(meta_file)
+
+# Process pool entry point for GDriveDownloader.postProcessFiles.
+# Returns (error, seconds, cached), where error is None, or an error
+# message so that one bad file doesn't abort the whole batch, and cached
+# is True if the output came from the sanitized cache.
+# The task is (root_path, file_entry, metadata, sanitizer_engine,
+# sanitized_cache), where metadata is None unless in pipeline mode, when
+# it doesn't need to be read back in, and sanitized_cache may be None.
+def post_process_file(task):
+    root_path, file_entry, metadata, sanitizer_engine, sanitized_cache = task
+    dirname, basename_raw, basename, meta_name, exported_type = file_entry
+    file_in = os.path.join(root_path, dirname, basename_raw)
+    file_out = os.path.join(root_path, dirname, basename)
+    meta_file = os.path.join(root_path, dirname, meta_name)
+    start_time = time.time()
+    cached = False
+    try:
+        if exported_type in ['text/html', 'text/x-markdown']:
+            if metadata is None:
+                metadata = read_meta(meta_file)
+        if exported_type == 'text/html':
+            cached = sanitize_html_file(file_in, file_out, metadata, sanitizer_engine, sanitized_cache)
+        elif exported_type == 'text/x-markdown':
+            prepend_markdown_metadata(file_in, file_out, metadata)
+    except Exception as e:
+        return ('%s: %s' % (e.__class__.__name__, e), time.time() - start_time, False)
+    return (None, time.time() - start_time, cached)
+
+class FolderNode():
+    def __init__(self, folder_id, path_to, depth, folder_meta=None):
+        self.folder_id = folder_id
+        self.path_to = path_to
+        self.depth = depth
+        self.folder_meta = folder_meta
+        self.file_results = [ ]
+        self.subfolders = [ ]
 
 class GDriveDownloader():
-    def __init__(self, maxdepth=1000000, verbose=False, stats_only=False):
-        secrets_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'client_secrets.json')
-        credentials_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'credentials.json')
-        self.drive_auth = DriveServiceAuth(secrets_path, credentials_path)
+    def __init__(self, maxdepth=1000000, verbose=False, stats_only=False, incremental=False,
+            workers=1, api_version='v2', flat_listing=False, max_qps=10.0, max_retries=8,
+            post_workers=None, pipeline=False, cache_dir=None, cache_size=1024, drive_auth=None,
+            progress_interval=0, resume=False, meta_sidecar=False, engine='threads', sync=False,
+            shared=None, site_name=None, sanitizer_engine=DEFAULT_SANITIZER_ENGINE, localize_images=False,
+            zip_export=False, stats_dir=None):
+        self.api_version = api_version
+        # SharedCrawlResources, when this is one site of a MultiSiteCrawl
+        self.shared = shared
+        self.site_name = site_name
+        if shared is not None:
+            drive_auth = shared.drive_auth
+        # Anything with build_service and authorize_http, such as FakeDriveServiceAuth
+        if drive_auth is None:
+            drive_auth = default_drive_auth(api_version)
+        self.drive_auth = drive_auth
         self.drive_service = None
         self.depth = 0
         self.root_path = None
+        self.root_id = None
         self.maxdepth = maxdepth
         self.verbose = verbose
         self.stats_only = stats_only
         self.stats_file = None
+        # Where --stats_only writes its files, dest_base by default
+        self.stats_dir = stats_dir
+        # Also write metadata as JSON, for YamlReader
+        self.meta_sidecar = meta_sidecar
+        self.crawl_stats = None
         self.file_list = [ ]
-        print('GDriveDownloader maxdepth %d, verbose %r' % (maxdepth, verbose))
+        # --sync needs the manifest, so it implies --incremental
+        self.sync = sync and not stats_only
+        self.incremental = (incremental or sync) and not stats_only
+        self.relocated_count = 0
+        self.sync_changes = None
+        self.manifest = None
+        self.fetched_count = 0
+        self.skipped_count = 0
+        # Journal of finished items, to --resume an interrupted run
+        self.resume = resume and not stats_only
+        self.journal = None
+        self.resumed_count = 0
+        self.workers = max(1, workers)
+        # 'threads', or 'batch' to list folders with batch requests
+        self.engine = engine
+        self.thread_local = shared.thread_local if shared is not None else threading.local()
+        self.flat_listing = flat_listing
+        # Counters and latencies for the run report
+        self.metrics = RunMetrics()
+        self.progress_interval = progress_interval
+        # Shared by all threads (and sites), to stay under the project quota
+        if shared is not None:
+            self.scheduler = shared.scheduler
+        else:
+            self.scheduler = RequestScheduler(rate=max_qps, max_retries=max_retries, verbose=verbose,
+                metrics=self.metrics)
+        # Scheduler counters when this crawl started
+        self.scheduler_start = None
+        self.run_report = None
+        # Processes for sanitizing, one per core by default
+        if post_workers is None:
+            post_workers = multiprocessing.cpu_count()
+        self.post_workers = max(1, post_workers)
+        self.pipeline = pipeline and not stats_only
+        # bleach or lxml
+        check_engine(sanitizer_engine)
+        self.sanitizer_engine = sanitizer_engine
+        self.post_pool = None
+        # Exported content by (file id, version, export type), cache_size in MB
+        self.export_cache = None
+        # Sanitized HTML, in the sanitized folder of the cache, also cache_size in MB
+        self.sanitized_cache = None
+        self.cache_size = cache_size
+        if cache_dir is not None and not stats_only:
+            self.export_cache = ExportCache(cache_dir, cache_size * 1024 * 1024)
+            self.export_cache.load()
+            self.sanitized_cache = SanitizedCache(os.path.join(cache_dir, 'sanitized'))
+        # Local copies of the images in sanitized pages, cached in the
+        # images folder of the cache
+        self.image_localizer = None
+        # Sanitized page path -> id of the item, for the manifest
+        self.page_sources = { }
+        # Export docs as a zip of the HTML and its images
+        self.zip_export = zip_export
+        # Item id -> images unpacked from its zip export, for the manifest
+        self.zip_images = { }
+        if localize_images and not stats_only:
+            if cache_dir is None:
+                raise ValueError('Localizing images needs a cache_dir')
+            self.image_localizer = ImageLocalizer(os.path.join(cache_dir, 'images'), cache_size * 1024 * 1024,
+                threads=max(self.workers, IMAGE_FETCH_THREADS), verbose=verbose)
+        # Parent folder id -> child items, built by listAllItems
+        self.children_index = None
+        print('GDriveDownloader maxdepth %d, verbose %r, incremental %r, workers %d, api %s, engine %s, sanitizer %s, localize images %r' % (maxdepth, verbose, self.incremental, self.workers, api_version, engine, sanitizer_engine, self.image_localizer is not None))
 
     def initService(self):
-        self.drive_service = self.drive_auth.build_service()
+        if self.shared is not None:
+            self.drive_service = self.shared.get_service()
+        else:
+            self.drive_service = self.drive_auth.build_service()
 
     def getLocalTitle(self, item, metadata=None):
         local_title = None
@@ -107,7 +291,7 @@ class GDriveDownloader():
             description = item['description'].strip()
             yaml_i = description.find('---')
             if yaml_i >= 0:
-                raw_meta = yaml.load(description[yaml_i:].strip())
+                raw_meta = load_metadata(description[yaml_i:].strip())
                 description = description[:yaml_i].strip()
             if len(description) == 0:
                 description = None
@@ -125,15 +309,29 @@ class GDriveDownloader():
                 gdrive_meta[key] = raw_meta[key]
         return gdrive_meta
 
-    def appendStats(self, item_type, item_meta):
+    def appendStats(self, item_type, item_meta, item=None):
         item_vals = [codecs.encode(item_meta.get(f) or '', 'utf-8') for f in STATS_META_FIELDS]
+        depth = len([p for p in item_meta['dirname'].split('/') if p])
+        item_vals += [item_type, str(depth)]
+        item_vals += [str((item or { }).get(f) or '') for f in STATS_ITEM_FIELDS]
         self.stats_file.write('\t'.join(item_vals))
         self.stats_file.write('\n')
 
+    # httplib2.Http objects are not thread-safe, so in concurrent mode
+    # each worker thread gets its own authorized connection.
+    def getHttp(self):
+        if self.workers <= 1 and self.engine == 'threads':
+            return self.drive_service._http
+        http = getattr(self.thread_local, 'http', None)
+        if http is None:
+            http = self.drive_auth.authorize_http()
+            self.thread_local.http = http
+        return http
+
     def getDownloadContent(self, download_url):
         content = None
         if download_url:
-            resp, content = self.drive_service._http.request(download_url)
+            resp, content = self.scheduler.request(self.getHttp(), download_url)
             if resp.status != 200:
                 raise RuntimeError('An error occurred: %s' % resp)
         else:
@@ -141,6 +339,118 @@ class GDriveDownloader():
             content = ''
         return content
 
+    # Run report phase for fetching an item's content from Drive
+    def contentPhase(self, child, exported_type):
+        if exported_type in child.get('exportLinks', { }):
+            return 'export'
+        return 'download'
+
+    # getDownloadContent, served from the export cache when we can
+    def fetchContent(self, child, exported_type, download_url):
+        use_cache = self.export_cache is not None and download_url
+        start_time = time.time()
+        if use_cache:
+            content = self.export_cache.read(child['id'], child['version'], exported_type)
+            if content is not None:
+                if self.verbose:
+                    print('Export cache hit for "%s"' % child['title'])
+                self.metrics.record_phase('cache', time.time() - start_time)
+                return content
+        content = self.getDownloadContent(download_url)
+        self.metrics.record_phase(self.contentPhase(child, exported_type), time.time() - start_time,
+            bytes_in=len(content))
+        if use_cache:
+            self.export_cache.store_content(child['id'], child['version'], exported_type, content)
+        return content
+
+    # downloadToFile, served from an earlier site of a multi-site crawl
+    # or the export cache when we can
+    def fetchToFile(self, child, exported_type, download_url, content_file):
+        use_cache = self.export_cache is not None and download_url
+        start_time = time.time()
+        if self.shared is not None and self.shared.copy_content(child['id'], child['version'],
+                exported_type, content_file):
+            if self.verbose:
+                print('Copied "%s" from an earlier site' % child['title'])
+            size = os.path.getsize(content_file)
+            self.metrics.record_phase('shared', time.time() - start_time, bytes_out=size)
+            return size
+        if use_cache and self.export_cache.copy_to(child['id'], child['version'], exported_type, content_file):
+            if self.verbose:
+                print('Export cache hit for "%s"' % child['title'])
+            size = os.path.getsize(content_file)
+            self.metrics.record_phase('cache', time.time() - start_time, bytes_out=size)
+            return size
+        size = self.downloadToFile(download_url, content_file)
+        self.metrics.record_phase(self.contentPhase(child, exported_type), time.time() - start_time,
+            bytes_in=size, bytes_out=size)
+        if use_cache:
+            self.export_cache.store_file(child['id'], child['version'], exported_type, content_file)
+        return size
+
+    # Let later sites of a multi-site crawl copy the item's content file
+    def shareContent(self, child, exported_type, content_file):
+        if self.shared is not None:
+            self.shared.record_content(child['id'], child['version'], exported_type, content_file)
+
+    # Stream content to a temporary file in chunks and rename it into
+    # place, so a large PDF or video is never held in memory and a
+    # failed download never leaves a partial file behind.
+    def downloadToFile(self, download_url, content_file):
+        dirname, basename = os.path.split(content_file)
+        temp_file = os.path.join(dirname, '.#' + basename + '.part')
+        start_time = time.time()
+        size = 0
+        try:
+            with open(temp_file, 'wb') as f:
+                if download_url:
+                    size = self.downloadChunks(download_url, f)
+                # else the file doesn't have any content stored on Drive.
+            os.rename(temp_file, content_file)
+        except:
+            # Don't let a missing .part file hide the original error
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            raise
+
+        if self.verbose:
+            elapsed = max(time.time() - start_time, 0.001)
+            print('Downloaded %d bytes in %.2fs (%.0f bytes/sec) to "%s"' % (size, elapsed, size / elapsed, content_file))
+        return size
+
+    # Fetch download_url with Range requests of DOWNLOAD_CHUNK_SIZE bytes,
+    # writing each chunk to f.  Each chunk is a separate request that
+    # starts at the current offset, so a failed chunk can be retried
+    # without starting over.  Returns the number of bytes written.
+    def downloadChunks(self, download_url, f):
+        http = self.getHttp()
+        offset = 0
+        total_size = None
+        while total_size is None or offset < total_size:
+            headers = { 'range': 'bytes=%d-%d' % (offset, offset + DOWNLOAD_CHUNK_SIZE - 1) }
+            resp, content = self.scheduler.request(http, download_url, headers=headers)
+            if resp.status == 206:
+                f.write(content)
+                offset += len(content)
+                content_range = resp.get('content-range', '')
+                total_size = int(content_range.rsplit('/', 1)[-1]) if '/' in content_range else offset
+                if len(content) == 0:
+                    break
+            elif resp.status == 200:
+                # Range not supported (Google Docs exports): whole body at once
+                if offset > 0:
+                    f.seek(0)
+                    f.truncate()
+                f.write(content)
+                offset = len(content)
+                break
+            elif resp.status == 416 and offset == 0:
+                # Range not satisfiable: an empty file
+                break
+            else:
+                raise RuntimeError('An error occurred: %s' % resp)
+        return offset
+
     def makeFolder(self, folder_item, path_to):
         local_title, cleaned_title, sorted_title, sort_priority, exported_type = self.getLocalTitle(folder_item)
         new_path = None
@@ -184,145 +494,611 @@ class GDriveDownloader():
         }
         folder_meta.update(gdrive_meta)
 
-        if self.stats_only:
-            self.appendStats('folder', folder_meta)
-        else:
+        if not self.stats_only:
             meta_file = os.path.join(new_folder, '_folder_.yml')
-            self.writeMeta(meta_file, folder_meta)
-        return new_path
+            if self.resume and self.journal.is_folder_done(folder_item['id'], folder_item['version'],
+                    self.root_path, os.path.join(new_path, '_folder_.yml')):
+                if self.verbose:
+                    print('Folder "%s" already written, resuming' % new_path)
+            else:
+                self.writeMeta(meta_file, folder_meta)
+                if self.journal is not None:
+                    self.journal.record_folder(folder_item['id'], folder_item['version'], new_path)
+        return (new_path, folder_meta)
+
+    # Fetch a single file resource, in v2 form for either API version
+    def getItem(self, fID, fields=V3_FILE_FIELDS):
+        if self.api_version == 'v3':
+            request = self.drive_service.files().get(fileId=fID, fields=fields, **ALL_DRIVES_ARGS)
+            item = self.scheduler.execute(request, self.getHttp())
+            return v3_to_v2_file(item, self.drive_service._baseUrl)
+        request = self.drive_service.files().get(fileId=fID, **ALL_DRIVES_ARGS)
+        return self.scheduler.execute(request, self.getHttp())
+
+    # Fetch one page of a files().list query.
+    # Returns the items in v2 form and the token for the next page.
+    def listPage(self, query, page_token, **list_args):
+        request = self.listRequest(query, page_token, **list_args)
+        return self.listResult(self.scheduler.execute(request, self.getHttp()))
 
-    def downloadFiles(self, fID_from, path_to, query_format):
+    def listRequest(self, query, page_token, **list_args):
+        list_args = dict(LIST_ALL_DRIVES_ARGS, **list_args)
+        if self.api_version == 'v3':
+            return self.drive_service.files().list(pageToken=page_token, q=query,
+                pageSize=LIST_PAGE_SIZE, fields=V3_LIST_FIELDS, **list_args)
+        return self.drive_service.files().list(pageToken=page_token, q=query,
+            maxResults=LIST_PAGE_SIZE, **list_args)
+
+    def listResult(self, result):
+        if self.api_version == 'v3':
+            items = [v3_to_v2_file(item, self.drive_service._baseUrl) for item in result['files']]
+        else:
+            items = result['items']
+        return (items, result.get('nextPageToken'))
+
+    # Page through every non-trashed item in the root's drive with one
+    # flat query and index the items by parent folder id.  After this,
+    # listChildren is answered from memory, so the listing phase costs
+    # one request per LIST_PAGE_SIZE items instead of one per folder.
+    def listAllItems(self, root_item):
+        list_args = { }
+        if root_item.get('driveId'):
+            # Shared drive: list just that drive
+            list_args = {
+                'corpora': 'drive',
+                'driveId': root_item['driveId']
+            }
+
+        self.children_index = { }
+        item_count = 0
+        start_time = time.time()
+        page_token = None
+        while True:
+            page_items, page_token = self.listPage(ALL_ITEMS_QUERY, page_token, **list_args)
+            for item in page_items:
+                for parent in item.get('parents', [ ]):
+                    self.children_index.setdefault(parent['id'], [ ]).append(item)
+            item_count += len(page_items)
+            if self.verbose:
+                print('Listed %d items' % item_count)
+            if not page_token:
+                break
+        print('Flat listing found %d items under %d parent folders' % (item_count, len(self.children_index)))
+        elapsed = time.time() - start_time
+        self.metrics.record_phase('flat_list', elapsed)
+        if self.crawl_stats is not None:
+            self.crawl_stats.flat_listing_seconds = elapsed
+
+    def listFiles(self, fID_from, query_format):
         # Go through children with pagination
         query =  query_format % fID_from
+        items = [ ]
         page_token = None
         while True:
-            result = self.drive_service.files().list(pageToken=page_token, q=query).execute()
-
             # Alternative way to get children:
             #   (returns `drive#childReference` instead of `drive#file`)
             # result = self.drive_service.children().list(folderId=fID_from).execute()
-            for child in result['items']:
-                if child['kind'] != 'drive#file':
-                    print('Unknown object type (not file or folder): "%s"' % child['kind'])
-                    pp(child)
-
-                source_type = child['mimeType']
-                if source_type == 'application/vnd.google-apps.folder':
-                    self.depth += 1
-                    new_folder = self.makeFolder(child, path_to)
-                    self.recursiveDownloadInto(child['id'], new_folder)
-                    self.depth -= 1
-                    # print('Returned from "%s" (id: %s)' % (child['title'], child['id']))
-                    # print('  back in folder %s at depth %d' % (path_to, self.depth))
-
-                else:
-                    gdrive_meta = self.parseGDriveMeta(child)
-                    local_title, cleaned_title, sorted_title, sort_priority, exported_type = self.getLocalTitle(child, gdrive_meta)
-
-                    meta_name = file_name = local_title
-
-                    # Handle .yml files
-                    if re.search(r'\.yml$', file_name):
-                        # Depending on how you edit or upload .yml files in Google Drive
-                        # The mime type reported could be text/plain or application/octet-stream
-                        # Avoid improperly dealing with Google Docs or Sheets inadvertently saved with .yml extension
-                        if re.match(r'(text|application)\/', source_type) and not re.match(r'application\/vnd\.google-apps', source_type):
-                            source_type = 'text/yaml'
-                            exported_type = None
-                        else:
-                            if self.verbose:
-                                print('Unknown source type for .yml file: ' % source_type)
-                                sys.exit(1)
+            page_items, page_token = self.listPage(query, page_token)
+            items.extend(page_items)
+
+            # Get page
+            if not page_token:
+                break
+        return items
+
+    def listChildren(self, fID_from):
+        if self.children_index is not None:
+            return self.splitChildren(self.children_index.get(fID_from, [ ]))
+        start_time = time.time()
+        children = self.listFiles(fID_from, CHILDREN_QUERY)
+        elapsed = time.time() - start_time
+        self.metrics.record_phase('list', elapsed)
+        if self.crawl_stats is not None:
+            self.crawl_stats.record_listing(fID_from, elapsed)
+        return self.splitChildren(children)
+
+    def splitChildren(self, children):
+        # Files in this folder and subfolders in this folder, each in listing order
+        files = [ ]
+        folders = [ ]
+        for child in children:
+            if child['mimeType'] == FOLDER_MIME_TYPE:
+                folders.append(child)
+            else:
+                files.append(child)
+        self.metrics.increment('folders_listed')
+        self.metrics.increment('files_listed', len(files))
+        return (files, folders)
+
+    # Work out local names and metadata for a single non-folder item.
+    # Does no I/O, so the coordinating thread can use the result to
+    # find items that would be written to the same local files.
+    def prepareFile(self, child, path_to):
+        if child['kind'] != 'drive#file':
+            print('Unknown object type (not file or folder): "%s"' % child['kind'])
+            pp(child)
+
+        source_type = child['mimeType']
+        gdrive_meta = self.parseGDriveMeta(child)
+        local_title, cleaned_title, sorted_title, sort_priority, exported_type = self.getLocalTitle(child, gdrive_meta)
 
-                    # Handle .html and .md exported files
-                    if exported_type == 'text/html':
-                        file_name += '.html'
+        meta_name = file_name = local_title
 
-                    raw_file_name = file_name
-                    if exported_type in ['text/html', 'text/x-markdown']:
-                        raw_file_name = make_raw_filename(file_name)
+        # Handle .yml files
+        if re.search(r'\.yml$', file_name):
+            # Depending on how you edit or upload .yml files in Google Drive
+            # The mime type reported could be text/plain or application/octet-stream
+            # Avoid improperly dealing with Google Docs or Sheets inadvertently saved with .yml extension
+            if re.match(r'(text|application)\/', source_type) and not re.match(r'application\/vnd\.google-apps', source_type):
+                source_type = 'text/yaml'
+                exported_type = None
+            else:
+                if self.verbose:
+                    print('Unknown source type for .yml file: ' % source_type)
+                    sys.exit(1)
+
+        # Handle .html and .md exported files
+        if exported_type == 'text/html':
+            file_name += '.html'
+
+        raw_file_name = file_name
+        if exported_type in ['text/html', 'text/x-markdown']:
+            raw_file_name = make_raw_filename(file_name)
+
+        # Local files written for this item, relative to root_path, and
+        # the ones of those that fetchFile writes (the rest are written
+        # by post-processing)
+        if source_type == 'text/yaml':
+            local_files = fetched_files = [ meta_name ]
+        else:
+            meta_name = make_meta_filename(file_name)
+            local_files = [ raw_file_name, file_name, meta_name ]
+            fetched_files = [ raw_file_name, meta_name ]
+        local_paths = [os.path.join(path_to, f) for f in sorted(set(local_files))]
+        fetched_paths = [os.path.join(path_to, f) for f in sorted(set(fetched_files))]
+
+        file_entry = None
+        if exported_type is not None:
+            file_entry = (path_to, raw_file_name, file_name, meta_name, exported_type)
+
+        # Lower-case url, with .md converted to .html
+        relative_url = re.sub(r'\.md$', '.html', local_title, flags=re.IGNORECASE)
+
+        # Lower-case slug, stripped of .yml, .md, .html, and leading _
+        # .pdf and image extensions are left alone
+        slug = re.sub(r'\.(yml|md|html)$', '', local_title, flags=re.IGNORECASE)
+        if slug[:1] == '_' and relative_url[-5:] == '.html':
+            slug = slug[1:]
+
+        # Pull description from Google Drive
+        file_meta = {
+            'author': child['lastModifyingUserName'],
+            'basename': file_name,
+            'basename_raw': raw_file_name,
+            'date': child['createdDate'],
+            'dirname': path_to,
+            'email': child['lastModifyingUser']['emailAddress'],
+            'exported_type': exported_type,
+            'relative_url': relative_url,
+            'slug': slug,
+            'source_id': child['id'],
+            'source_type': source_type,
+            'sort_priority': sort_priority,
+            'sorted_title': sorted_title,
+            'summary': None,
+            'template': None,
+            'title': cleaned_title,
+            'modified': child['modifiedDate'],
+            'version': child['version']
+        }
+        file_meta.update(gdrive_meta)
+
+        return {
+            'child': child,
+            'path_to': path_to,
+            'source_type': source_type,
+            'exported_type': exported_type,
+            'raw_file_name': raw_file_name,
+            'meta_name': meta_name,
+            'local_paths': local_paths,
+            'fetched_paths': fetched_paths,
+            'file_entry': file_entry,
+            'file_meta': file_meta
+        }
 
-                    new_file = os.path.join(self.root_path, path_to, raw_file_name)
+    # Download (or skip) a prepared item.  Safe to run in a worker
+    # thread: everything that touches shared downloader state is done
+    # in addFileResult with the returned tuple.
+    def fetchFile(self, prepared):
+        child = prepared['child']
+        path_to = prepared['path_to']
+        source_type = prepared['source_type']
+        exported_type = prepared['exported_type']
+        local_paths = prepared['local_paths']
+        file_entry = prepared['file_entry']
+        file_meta = prepared['file_meta']
+
+        if self.stats_only:
+            self.metrics.increment('files_done')
+            return (child, exported_type, file_meta, local_paths, file_entry, 'listed')
+
+        # Post-processing may not have run before the interruption, so
+        # only the files fetchFile writes are checked, and resumed items
+        # are post-processed again
+        if self.resume and self.journal.is_file_done(child['id'], child['version'],
+                exported_type, self.root_path, prepared['fetched_paths']):
+            # Written before the previous run was interrupted
+            self.zip_images.setdefault(child['id'], [ ]).extend(self.journal.file_images(child['id']))
+            if self.verbose:
+                print('Already fetched "%s" version %s, resuming' % (child['title'], child['version']))
+            self.metrics.increment('files_done')
+            self.metrics.increment('files_resumed')
+            return (child, exported_type, file_meta, local_paths, file_entry, 'resumed')
+
+        if self.incremental and self.manifest.is_unchanged(child['id'], child['version'],
+                exported_type, self.root_path, local_paths):
+            # Previous output for this version is still in place
+            if self.verbose:
+                print('Unchanged "%s" version %s, skipped' % (child['title'], child['version']))
+            self.metrics.increment('files_done')
+            self.metrics.increment('files_skipped')
+            return (child, exported_type, file_meta, local_paths, file_entry, 'skipped')
+
+        content_path = os.path.join(path_to, prepared['raw_file_name'])
+        meta_file = os.path.join(self.root_path, path_to, prepared['meta_name'])
+        # Zip exports also wrote images, which relocate_content doesn't move
+        if self.sync and source_type != 'text/yaml' and not self.isZipExport(child, exported_type):
+            if self.manifest.relocate_content(child['id'], make_content_id(child), exported_type,
+                    self.root_path, content_path):
+                # Moved or renamed since the last run, content unchanged
+                if self.verbose:
+                    print('Relocated "%s" to %s' % (child['title'], content_path))
+                self.writeMeta(meta_file, file_meta)
+                self.shareContent(child, exported_type, os.path.join(self.root_path, content_path))
+                if self.journal is not None:
+                    self.journal.record_file(child['id'], child['version'], exported_type, prepared['fetched_paths'])
+                self.metrics.increment('files_done')
+                self.metrics.increment('files_relocated')
+                return (child, exported_type, file_meta, local_paths, file_entry, 'relocated')
+            self.manifest.claim_content(child['id'], content_path)
+
+        new_file = os.path.join(self.root_path, content_path)
+        image_paths = None
+        if self.verbose:
+            print('Trying to download "%s"' % child['title'])
+        try:
+            # Download the file
+            download_url = self.getDownloadUrl(child, exported_type)
+            if source_type == 'text/yaml':
+                file_content = self.fetchContent(child, exported_type, download_url)
+                try:
+                    source_meta = load_metadata(file_content)
+                    if isinstance(source_meta, dict):
+                        file_meta.update(source_meta)
+                    else:
+                        raise Exception('YAML object %r is not a dict' % source_meta)
+                except Exception as e:
+                    print('Error parsing YAML from %s: %s' % (download_url, e))
+            elif self.isZipExport(child, exported_type):
+                # An item with several parents is fetched for each
+                image_paths = self.fetchZipExport(child, path_to, new_file)
+                self.zip_images.setdefault(child['id'], [ ]).extend(image_paths)
+            else:
+                self.fetchToFile(child, exported_type, download_url, new_file)
+                self.shareContent(child, exported_type, new_file)
+
+            self.writeMeta(meta_file, file_meta)
+
+            if self.verbose:
+                print('Write to file "%s" exported as %s' % (new_file, exported_type))
+
+        except Exception as e:
+            print('  Failed: %s\n' % e)
+            self.metrics.increment('files_failed')
+            raise
+
+        if self.journal is not None:
+            self.journal.record_file(child['id'], child['version'], exported_type, prepared['fetched_paths'], image_paths)
+        self.metrics.increment('files_done')
+        self.metrics.increment('files_fetched')
+        return (child, exported_type, file_meta, local_paths, file_entry, 'fetched')
+
+    def isZipExport(self, child, exported_type):
+        return self.zip_export and exported_type == 'text/html' and ZIP_EXPORT_TYPE in child.get('exportLinks', { })
+
+    # Export a doc as a zip and unpack it: the HTML to content_file, and
+    # its images next to it.  Returns the paths of the images.
+    def fetchZipExport(self, child, path_to, content_file):
+        dirname, basename = os.path.split(content_file)
+        zip_file = os.path.join(dirname, '.#' + basename + '.zip')
+        self.fetchToFile(child, ZIP_EXPORT_TYPE, self.getDownloadUrl(child, ZIP_EXPORT_TYPE), zip_file)
+        start_time = time.time()
+        try:
+            image_names = unpack_doc_zip(zip_file, content_file)
+        finally:
+            os.remove(zip_file)
+        self.metrics.record_phase('unzip', time.time() - start_time, bytes_out=os.path.getsize(content_file))
+        self.metrics.increment('zip_images', len(image_names))
+        return [os.path.join(path_to, name) for name in image_names]
+
+    def getDownloadUrl(self, child, exported_type):
+        if 'exportLinks' in child and exported_type in child['exportLinks']:
+            return all_drives_url(child['exportLinks'][exported_type])
+        if child.get('downloadUrl'):
+            return all_drives_url(child['downloadUrl'])
+        return None
+
+    # Items that write to the same local files must be fetched in
+    # listing order, so that the last one wins as in a serial run.
+    def fetchFiles(self, prepared_list):
+        return [self.fetchFile(prepared) for prepared in prepared_list]
+
+    def addFileResult(self, result):
+        child, exported_type, file_meta, local_paths, file_entry, status = result
+        if status == 'listed':
+            self.appendStats('file', file_meta, child)
+            self.crawl_stats.record_file(child, file_meta, self.getDownloadUrl(child, exported_type))
+            return
+
+        zip_images = self.zip_images.pop(child['id'], [ ])
+        if self.incremental:
+            content_paths = [ ]
+            if file_meta['source_type'] != 'text/yaml':
+                content_paths.append(os.path.join(file_meta['dirname'], file_meta['basename_raw']))
+            self.manifest.record(child['id'], child['version'],
+                exported_type, child['modifiedDate'], local_paths, content_paths,
+                content_id=make_content_id(child))
+            self.manifest.record_images(child['id'], zip_images)
+        if status == 'skipped':
+            self.skipped_count += 1
+            if self.incremental:
+                # Its page, and so its images, are unchanged too
+                self.manifest.keep_images(child['id'])
+        else:
+            # Resumed and relocated items need post-processing too
+            if status == 'resumed':
+                self.resumed_count += 1
+            elif status == 'relocated':
+                self.relocated_count += 1
+            else:
+                self.fetched_count += 1
+            if file_entry is not None:
+                self.file_list.append(file_entry)
+                self.page_sources[os.path.join(file_entry[0], file_entry[2])] = child['id']
+
+    def addFolderResult(self, folder_meta):
+        if self.stats_only:
+            self.appendStats('folder', folder_meta)
+            self.crawl_stats.record_folder(folder_meta)
+        elif self.incremental:
+            # So that --sync can prune folders that are gone
+            folder_path = os.path.join(folder_meta['dirname'], folder_meta['basename']).lstrip('/')
+            self.manifest.record(folder_meta['source_id'], folder_meta['version'], None,
+                folder_meta['modified'], [ os.path.join(folder_path, '_folder_.yml') ], kind='folder')
+
+    def downloadFiles(self, fID_from, path_to):
+        files, folders = self.listChildren(fID_from)
+        for child in files:
+            result = self.fetchFile(self.prepareFile(child, path_to))
+            self.pipelineFileResult(result)
+            self.addFileResult(result)
+
+        for child in folders:
+            self.depth += 1
+            new_folder, folder_meta = self.makeFolder(child, path_to)
+            self.addFolderResult(folder_meta)
+            self.recursiveDownloadInto(child['id'], new_folder, child)
+            self.depth -= 1
+            # print('Returned from "%s" (id: %s)' % (child['title'], child['id']))
+            # print('  back in folder %s at depth %d' % (path_to, self.depth))
+
+    # Prepare the files in a folder listing and group together the
+    # ones that share any local path.  Returns (indexes, prepared_list)
+    # tuples in listing order.
+    def groupFiles(self, files, path_to):
+        groups = [ ]
+        group_for_path = { }
+        for i, child in enumerate(files):
+            prepared = self.prepareFile(child, path_to)
+            group = None
+            for path in prepared['local_paths']:
+                if path in group_for_path:
+                    group = group_for_path[path]
+                    break
+            if group is None:
+                group = ([ ], [ ])
+                groups.append(group)
+            group[0].append(i)
+            group[1].append(prepared)
+            for path in prepared['local_paths']:
+                group_for_path[path] = group
+        return groups
+
+    def submitTask(self, pool, results, token, fn, *args):
+        pool.apply_async(run_task, (token, fn, args), callback=results.put)
+
+    # Lists folders and downloads files with a pool of worker threads.
+    # Folders are still created by this (the calling) thread as soon as
+    # their parent's listing comes back, and results are collected in
+    # a tree so that file_list, stats and the manifest are filled in
+    # exactly the same order as the serial traversal.
+    def concurrentDownloadInto(self, fID_from, path_to):
+        pool = self.startWorkers()
+        results = Queue.Queue()
+        root = FolderNode(fID_from, path_to, self.depth)
+        self.submitTask(pool, results, ('list', root, None), self.listChildren, fID_from)
+        pending = 1
+        try:
+            while pending > 0:
+                try:
+                    # Wait with a timeout so that KeyboardInterrupt gets through
+                    token, result, error = results.get(True, 1.0)
+                except Queue.Empty:
+                    continue
+                pending -= 1
+                if error is not None:
+                    raise error
+
+                task_type, node, indexes = token
+                if task_type == 'file':
+                    self.addFileTaskResult(node, indexes, result)
+                    continue
+
+                files, folders = result
+                node.file_results = [ None ] * len(files)
+                for indexes, prepared_list in self.groupFiles(files, node.path_to):
+                    self.submitTask(pool, results, ('file', node, indexes), self.fetchFiles, prepared_list)
+                    pending += 1
+
+                for child in folders:
+                    new_folder, folder_meta = self.makeFolder(child, node.path_to)
+                    subnode = FolderNode(child['id'], new_folder, node.depth + 1, folder_meta)
+                    node.subfolders.append(subnode)
+                    if subnode.depth > self.maxdepth:
+                        if self.verbose:
+                            print('Maximum depth %d exceeded' % subnode.depth)
+                        continue
                     if self.verbose:
-                        print('Trying to download "%s"' % child['title'])
-                    try:
-                        # Lower-case url, with .md converted to .html
-                        relative_url = re.sub(r'\.md$', '.html', local_title, flags=re.IGNORECASE)
-
-                        # Lower-case slug, stripped of .yml, .md, .html, and leading _
-                        # .pdf and image extensions are left alone
-                        slug = re.sub(r'\.(yml|md|html)$', '', local_title, flags=re.IGNORECASE)
-                        if slug[:1] == '_' and relative_url[-5:] == '.html':
-                            slug = slug[1:]
-
-                        # Pull description from Google Drive
-                        file_meta = {
-                            'author': child['lastModifyingUserName'],
-                            'basename': file_name,
-                            'basename_raw': raw_file_name,
-                            'date': child['createdDate'],
-                            'dirname': path_to,
-                            'email': child['lastModifyingUser']['emailAddress'],
-                            'exported_type': exported_type,
-                            'relative_url': relative_url,
-                            'slug': slug,
-                            'source_id': child['id'],
-                            'source_type': source_type,
-                            'sort_priority': sort_priority,
-                            'sorted_title': sorted_title,
-                            'summary': None,
-                            'template': None,
-                            'title': cleaned_title,
-                            'modified': child['modifiedDate'],
-                            'version': child['version']
-                        }
-                        file_meta.update(gdrive_meta)
-
-                        if not self.stats_only:
-                            # Download the file
-                            download_url = None
-                            if 'exportLinks' in child and exported_type in child['exportLinks']:
-                                download_url = child['exportLinks'][exported_type]
-                            elif 'downloadUrl' in child:
-                                download_url = child['downloadUrl']
-                            file_content = self.getDownloadContent(download_url)
-
-                            if source_type == 'text/yaml':
-                                try:
-                                    source_meta = yaml.load(file_content)
-                                    if isinstance(source_meta, dict):
-                                        file_meta.update(source_meta)
-                                    else:
-                                        raise Exception('YAML object %r is not a dict' % source_meta)
-                                except Exception as e:
-                                    print('Error parsing YAML from %s: %s' % (download_url, e))
-                            else:
-                                self.writeContent(new_file, file_content)
-                                meta_name = make_meta_filename(file_name)
-
-                            meta_file = os.path.join(self.root_path, path_to, meta_name)
-                            self.writeMeta(meta_file, file_meta)
+                        print('Recursively downloading "%s" (id: %s)' % (child['title'], child['id']))
+                        print('  into folder %s at depth %d' % (new_folder, subnode.depth))
+                    self.submitTask(pool, results, ('list', subnode, None), self.listChildren, child['id'])
+                    pending += 1
+        except:
+            pool.terminate()
+            raise
+
+        self.stopWorkers(pool)
+        self.addNodeResults(root)
+
+    # Worker threads for the concurrent and batch engines.  In a
+    # multi-site crawl they are shared, and so are their connections.
+    def startWorkers(self):
+        if self.shared is not None:
+            return self.shared.get_worker_pool(self.workers)
+        return ThreadPool(self.workers)
+
+    def stopWorkers(self, pool):
+        # Every task has been collected, so a shared pool is idle
+        if self.shared is None:
+            pool.close()
+            pool.join()
+
+    def addFileTaskResult(self, node, indexes, result):
+        for i, file_result in zip(indexes, result):
+            node.file_results[i] = file_result
+            self.pipelineFileResult(file_result)
+
+    # List many folders with Drive batch requests: up to BATCH_SIZE
+    # files.list calls go out as one HTTP request on one keep-alive
+    # connection.  Returns (files, folders) for each folder id, as
+    # listChildren would.
+    def batchListChildren(self, folder_ids):
+        if self.children_index is not None:
+            return [self.listChildren(fID) for fID in folder_ids]
 
+        children = dict([(fID, [ ]) for fID in folder_ids])
+        # (folder id, page token, attempt)
+        pending = [(fID, None, 0) for fID in folder_ids]
+        while pending:
+            next_pending = [ ]
+            retry_attempt = None
+            for i in range(0, len(pending), BATCH_SIZE):
+                batch = pending[i:i + BATCH_SIZE]
+                requests = [self.listRequest(CHILDREN_QUERY % fID, page_token) for fID, page_token, attempt in batch]
+                start_time = time.time()
+                responses = self.scheduler.execute_batch(requests,
+                    self.drive_service.new_batch_http_request, self.getHttp())
+                elapsed = time.time() - start_time
+                self.metrics.record_phase('batch_list', elapsed)
+                # Each folder gets an equal share of the batch's time
+                share = elapsed / len(batch)
+                for (fID, page_token, attempt), (result, error) in zip(batch, responses):
+                    if error is None:
+                        items, next_token = self.listResult(result)
+                        children[fID].extend(items)
+                        if self.crawl_stats is not None:
+                            self.crawl_stats.record_listing(fID, share, batched=True)
+                        if next_token:
+                            next_pending.append((fID, next_token, 0))
+                    elif self.scheduler.should_retry(error, attempt):
+                        next_pending.append((fID, page_token, attempt + 1))
+                        retry_attempt = max(retry_attempt, attempt)
+                    else:
+                        raise error
+            if retry_attempt is not None:
+                time.sleep(self.scheduler.backoff_delay(retry_attempt))
+            pending = next_pending
+        return [self.splitChildren(children[fID]) for fID in folder_ids]
+
+    # Batch engine: lists folders a level at a time from this thread,
+    # with batch requests, while a pool of worker threads fetches the
+    # files.  Results are replayed in serial order as in
+    # concurrentDownloadInto.
+    def batchDownloadInto(self, fID_from, path_to):
+        pool = self.startWorkers()
+        results = Queue.Queue()
+        root = FolderNode(fID_from, path_to, self.depth)
+        level = [ root ]
+        pending = 0
+        try:
+            while level:
+                next_level = [ ]
+                listings = self.batchListChildren([node.folder_id for node in level])
+                for node, (files, folders) in zip(level, listings):
+                    node.file_results = [ None ] * len(files)
+                    for indexes, prepared_list in self.groupFiles(files, node.path_to):
+                        self.submitTask(pool, results, ('file', node, indexes), self.fetchFiles, prepared_list)
+                        pending += 1
+
+                    for child in folders:
+                        new_folder, folder_meta = self.makeFolder(child, node.path_to)
+                        subnode = FolderNode(child['id'], new_folder, node.depth + 1, folder_meta)
+                        node.subfolders.append(subnode)
+                        if subnode.depth > self.maxdepth:
                             if self.verbose:
-                                print('Write to file "%s" exported as %s' % (new_file, exported_type))
+                                print('Maximum depth %d exceeded' % subnode.depth)
+                            continue
+                        next_level.append(subnode)
+                if self.verbose:
+                    print('Listed %d folders, %d in the next level' % (len(level), len(next_level)))
+                level = next_level
+                # Pick up the files finished so far, so pipelining can start
+                pending -= self.collectFileResults(results, False)
 
-                        if exported_type is not None:
-                            if self.stats_only:
-                                self.appendStats('file', file_meta)
-                            else:
-                                self.file_list.append((path_to, raw_file_name, file_name, meta_name, exported_type))
+            while pending > 0:
+                pending -= self.collectFileResults(results, True)
+        except:
+            pool.terminate()
+            raise
 
-                    except Exception as e:
-                        print('  Failed: %s\n' % e)
-                        raise
+        self.stopWorkers(pool)
+        self.addNodeResults(root)
 
-            # Get page
-            page_token = result.get('nextPageToken')
-            if not page_token:
-                break
+    # Add file task results from the queue, waiting for one if `wait`.
+    # Returns the number of results added.
+    def collectFileResults(self, results, wait):
+        added = 0
+        while True:
+            try:
+                # Wait with a timeout so that KeyboardInterrupt gets through
+                token, result, error = results.get(wait and added == 0, 1.0)
+            except Queue.Empty:
+                return added
+            if error is not None:
+                raise error
+            task_type, node, indexes = token
+            self.addFileTaskResult(node, indexes, result)
+            added += 1
 
+    def addNodeResults(self, node):
+        for result in node.file_results:
+            self.addFileResult(result)
+        for subnode in node.subfolders:
+            self.addFolderResult(subnode.folder_meta)
+            self.addNodeResults(subnode)
 
-    def recursiveDownloadInto(self, fID_from, path_to):
+    # item is the folder's resource from its parent's listing, if we have it
+    def recursiveDownloadInto(self, fID_from, path_to, item=None):
         if self.depth > self.maxdepth:
             if self.verbose:
                 print('Maximum depth %d exceeded' % self.depth)
@@ -331,40 +1107,77 @@ class GDriveDownloader():
         if not self.drive_service:
             self.initService()
 
-        item = self.drive_service.files().get(fileId=fID_from).execute()
+        if self.scheduler_start is None:
+            if self.shared is not None:
+                # Sites are crawled one at a time, so API latencies go to this site's report
+                self.scheduler.metrics = self.metrics
+            self.scheduler_start = self.scheduler.counters()
+
+        if item is None:
+            item = self.getItem(fID_from, V3_ROOT_FIELDS)
         if self.verbose:
             print('Recursively downloading "%s" (id: %s)' % (item['title'], item['id']))
             print('  into folder %s at depth %d' % (path_to, self.depth))
 
         if self.depth == 0:
             if self.stats_only:
-                stats_fname = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'stats.tsv')
+                if self.stats_dir is None:
+                    self.stats_dir = path_to
+                if not os.path.isdir(self.stats_dir):
+                    os.makedirs(self.stats_dir)
+                stats_fname = self.statsFilename('stats', '.tsv')
                 self.stats_file = codecs.EncodedFile(open(stats_fname, 'w'), 'utf-8')
-                self.stats_file.write('\t'.join(STATS_META_FIELDS))
+                self.stats_file.write('\t'.join(STATS_COLUMNS))
                 self.stats_file.write('\n')
+                self.crawl_stats = CrawlStats(item['id'])
 
-            if item['kind'] == 'drive#file' and item['mimeType'] == 'application/vnd.google-apps.folder':
+            if item['kind'] == 'drive#file' and item['mimeType'] == FOLDER_MIME_TYPE:
                 self.root_path = path_to
-                path_to = self.makeFolder(item, '')
+                self.root_id = item['id']
+                if not self.stats_only:
+                    journal_file = os.path.join(self.root_path, make_journal_filename(item['id']))
+                    self.journal = CrawlJournal(journal_file)
+                    if self.resume:
+                        entries = self.journal.load()
+                        print('Resuming with %d journal entries from %s' % (entries, journal_file))
+                    self.journal.open(item['id'], self.resume)
+                if self.progress_interval > 0:
+                    self.metrics.start_progress(self.progress_interval)
+                if self.incremental:
+                    manifest_file = os.path.join(self.root_path, make_manifest_filename(item['id']))
+                    self.manifest = DownloadManifest(manifest_file)
+                    self.manifest.load()
+                    if self.verbose:
+                        print('Loaded %d manifest entries from %s' % (len(self.manifest.previous), manifest_file))
+                path_to, folder_meta = self.makeFolder(item, '')
+                self.addFolderResult(folder_meta)
             else:
                 print('Top level item is not a folder')
                 return
 
-        # First get files in this folder
-        self.downloadFiles(fID_from, path_to, '"%s" in parents and trashed = false and mimeType != "application/vnd.google-apps.folder"')
-        # Then get subfolders in this folder
-        self.downloadFiles(fID_from, path_to, '"%s" in parents and trashed = false and mimeType = "application/vnd.google-apps.folder"')
+            # Fork the sanitizer processes before any worker threads start
+            if self.pipeline:
+                self.startPostPipeline()
+
+            if self.flat_listing:
+                self.listAllItems(item)
+
+            if self.engine == 'batch':
+                self.batchDownloadInto(fID_from, path_to)
+                return
+            if self.workers > 1:
+                self.concurrentDownloadInto(fID_from, path_to)
+                return
+
+        self.downloadFiles(fID_from, path_to)
 
     def readMeta(self, meta_file):
-        metadata = { }
-        with codecs.open(meta_file, 'r', 'utf-8') as f:
-            metadata = yaml.load(f)
-        return metadata
+        return read_meta(meta_file)
 
     def writeMeta(self, meta_file, metadata):
-        yaml_meta = yaml.safe_dump(metadata, default_flow_style=False,  explicit_start=True)
-        with codecs.open(meta_file, 'w+', 'utf-8') as f:
-            f.write(yaml_meta)
+        start_time = time.time()
+        size = write_metadata(meta_file, metadata, self.meta_sidecar)
+        self.metrics.record_phase('write_meta', time.time() - start_time, bytes_out=size)
 
     def writeContent(self, content_file, content):
         # Using codecs will throw some decoding errors...
@@ -372,28 +1185,212 @@ class GDriveDownloader():
         with open(content_file, 'w+') as f:
             f.write(content)
 
+    # Time a few real downloads and exports, one chunk each, so the
+    # report can estimate how long a full download would take.
+    def sampleThroughput(self):
+        http = self.getHttp()
+        samples = self.crawl_stats.download_samples + self.crawl_stats.export_samples
+        for title, download_url, is_export in samples:
+            headers = { 'range': 'bytes=0-%d' % (DOWNLOAD_CHUNK_SIZE - 1) }
+            start_time = time.time()
+            try:
+                resp, content = self.scheduler.request(http, download_url, headers=headers)
+            except Exception as e:
+                print('Unable to sample download of "%s": %s' % (title, e))
+                continue
+            if resp.status in [200, 206]:
+                self.crawl_stats.record_sample(is_export, len(content), time.time() - start_time)
+
+    # Stats go in stats_dir, with the site name in a multi-site crawl
+    def statsFilename(self, basename, extension):
+        if self.site_name is not None:
+            basename += '_' + self.site_name
+        return os.path.join(self.stats_dir, basename + extension)
+
     def postProcessStats(self):
-        pass
+        self.stats_file.close()
+        self.sampleThroughput()
+
+        json_file = self.statsFilename('stats', '.json')
+        csv_file = self.statsFilename('stats_folders', '.csv')
+        report = self.crawl_stats.write_report(json_file, csv_file)
+
+        totals = report['totals']
+        print('Stats: %d files, %d folders, %d bytes (%d bytes of quota), %d Google Docs, max depth %d' %
+            (totals['files'], totals['folders'], totals['bytes'], totals['quota_bytes'],
+            totals['google_docs'], totals['max_depth']))
+        if report['estimated_download_seconds'] is not None:
+            print('Estimated full download time: %.0f seconds' % report['estimated_download_seconds'])
+        print('Wrote %s and %s' % (json_file, csv_file))
+
+    # Pipeline mode: start sanitizing a file as soon as it is downloaded,
+    # with the metadata we already have, while the crawl goes on.
+    def startPostPipeline(self):
+        if self.shared is not None:
+            self.post_pool = self.shared.get_post_pool(self.post_workers)
+        else:
+            self.post_pool = multiprocessing.Pool(self.post_workers)
+        self.post_results = [ ]
+        self.post_pending = { }
+
+    def pipelineFileResult(self, result):
+        child, exported_type, file_meta, local_paths, file_entry, status = result
+        if self.post_pool is None or status not in ['fetched', 'resumed', 'relocated'] or file_entry is None:
+            return
+        if exported_type not in ['text/html', 'text/x-markdown']:
+            return
+
+        # Items that share an output file must be processed in order
+        file_out = os.path.join(file_entry[0], file_entry[2])
+        if file_out in self.post_pending:
+            self.post_pending[file_out].wait()
+
+        async_result = self.post_pool.apply_async(post_process_file,
+            ((self.root_path, file_entry, file_meta, self.sanitizer_engine, self.sanitized_cache), ))
+        self.post_pending[file_out] = async_result
+        self.post_results.append((file_entry, async_result))
+
+    def finishPostPipeline(self):
+        if self.verbose:
+            print('Waiting for %d pipelined files' % len(self.post_results))
+        try:
+            results = [async_result.get(POST_PROCESS_TIMEOUT) for file_entry, async_result in self.post_results]
+        except:
+            self.post_pool.terminate()
+            raise
+        if self.shared is None:
+            self.post_pool.close()
+            self.post_pool.join()
+        return ([file_entry for file_entry, async_result in self.post_results], results)
 
     def postProcessFiles(self):
+        if self.post_pool is not None:
+            file_entries, results = self.finishPostPipeline()
+            self.reportPostProcessing(file_entries, results)
+            self.localizeImages(file_entries, results)
+            return
+
+        post_workers = min(self.post_workers, len(self.file_list))
         if self.verbose:
-            print('Post-processing %d files' % len(self.file_list))
-
-        for dirname, basename_raw, basename, meta_name, exported_type in self.file_list:
-            file_in = os.path.join(self.root_path, dirname, basename_raw)
-            file_out = os.path.join(self.root_path, dirname, basename)
-            meta_file = os.path.join(self.root_path, dirname, meta_name)
-            if exported_type == 'text/html':
-                metadata = self.readMeta(meta_file)
-                sanitize_html_file(file_in, file_out, metadata)
-            elif exported_type == 'text/x-markdown':
-                metadata = self.readMeta(meta_file)
-                prepend_markdown_metadata(file_in, file_out, metadata)
+            print('Post-processing %d files with %d processes' % (len(self.file_list), max(1, post_workers)))
+
+        tasks = [(self.root_path, file_entry, None, self.sanitizer_engine, self.sanitized_cache)
+            for file_entry in self.file_list]
+        if post_workers > 1:
+            # sanitize_html_file is CPU-bound, so use processes rather than threads
+            pool = multiprocessing.Pool(post_workers)
+            try:
+                results = pool.map_async(post_process_file, tasks, chunksize=POST_PROCESS_CHUNK_SIZE).get(POST_PROCESS_TIMEOUT)
+            except:
+                pool.terminate()
+                raise
+            pool.close()
+            pool.join()
+        else:
+            results = [post_process_file(task) for task in tasks]
+        self.reportPostProcessing(self.file_list, results)
+        self.localizeImages(self.file_list, results)
+
+    def reportPostProcessing(self, file_entries, results):
+        failed = 0
+        cached = 0
+        for file_entry, (error, seconds, from_cache) in zip(file_entries, results):
+            if from_cache:
+                cached += 1
+                self.metrics.record_phase('sanitize_cached', seconds)
+            else:
+                self.metrics.record_phase('sanitize', seconds)
+            if error is not None:
+                self.metrics.increment('post_process_failed')
+                failed += 1
+                print('Post-processing failed for %s: %s' % (os.path.join(file_entry[0], file_entry[1]), error))
+                if self.incremental:
+                    # Fetch it again next time
+                    self.manifest.discard(os.path.join(file_entry[0], file_entry[1]))
+        if failed > 0:
+            print('Post-processing failed for %d of %d files' % (failed, len(file_entries)))
+        if self.sanitized_cache is not None:
+            html_count = len([e for e in file_entries if e[4] == 'text/html'])
+            pruned = self.sanitized_cache.prune(self.cache_size * 1024 * 1024)
+            print('Sanitized cache: %d of %d docs unchanged, %d old outputs pruned' % (
+                cached, html_count, pruned))
+
+    # Replace remote <img> sources in the sanitized pages with local copies
+    def localizeImages(self, file_entries, results):
+        if self.image_localizer is None:
+            return
+        pages = [os.path.join(file_entry[0], file_entry[2]) for file_entry, (error, seconds, cached)
+            in zip(file_entries, results) if file_entry[4] == 'text/html' and error is None]
+        start_time = time.time()
+        page_images = self.image_localizer.localize(self.root_path, sorted(set(pages)))
+        self.metrics.record_phase('localize_images', time.time() - start_time)
+        if self.incremental:
+            for page, image_paths in page_images.items():
+                source_id = self.page_sources.get(page)
+                if source_id is not None:
+                    self.manifest.record_images(source_id, image_paths)
+        self.image_localizer.cache.save()
+        for name, count in self.image_localizer.counters.items():
+            self.metrics.increment('images_' + name, count)
+        print('Images: %s' % self.image_localizer.summary())
 
     def postProcess(self):
+        self.metrics.stop_progress()
+        print('Drive API: %s' % self.scheduler.summary(self.scheduler_start))
         if self.stats_only:
             self.postProcessStats()
         else:
             self.postProcessFiles()
+            if self.export_cache is not None:
+                self.export_cache.save()
+                print('Export cache: %s' % self.export_cache.summary())
+            if self.incremental:
+                self.manifest.save()
+                print('Incremental: %d items fetched, %d unchanged items skipped' % (self.fetched_count, self.skipped_count))
+            if self.sync:
+                self.syncLocalTree()
+            if self.resume:
+                print('Resume: %d items already fetched before the interruption' % self.resumed_count)
+            if self.journal is not None:
+                # Finished, so there is nothing left to resume
+                self.journal.close(remove=True)
+        self.writeRunReport()
+
+    # Report what changed since the last run, and delete files and
+    # folders that no item claims any more.  Only called after a
+    # complete crawl, so anything missing really is gone from Drive.
+    def syncLocalTree(self):
+        changes = self.manifest.changes()
+        removed_paths = self.manifest.prune(self.root_path)
+        counts = dict([(k, len(v)) for k, v in changes.items()])
+        print('Sync: %d added, %d updated, %d moved or renamed (%d relocated without fetching), %d removed, %d local paths pruned' % (
+            counts['added'], counts['updated'], counts['moved'], self.relocated_count, counts['removed'], len(removed_paths)))
+        if self.verbose:
+            for change in changes['moved']:
+                print('  moved %s: %s -> %s' % (change['id'], ', '.join(change['from']), ', '.join(change['to'])))
+            for change in changes['removed']:
+                print('  removed %s: %s' % (change['id'], ', '.join(change['paths'])))
+            for path in removed_paths:
+                print('  pruned %s' % path)
+        self.sync_changes = {
+            'counts': counts,
+            'relocated': self.relocated_count,
+            'changes': changes,
+            'pruned': removed_paths
+        }
+
+    def writeRunReport(self):
+        if self.root_path is None:
+            return
+        report_file = os.path.join(self.root_path, make_report_filename(self.root_id))
+        self.run_report = self.metrics.write_report(report_file, {
+            'root_id': self.root_id,
+            'site': self.site_name,
+            'workers': self.workers,
+            'api_version': self.api_version,
+            'sync': self.sync_changes,
+            'scheduler': self.scheduler.counters(self.scheduler_start)
+        })
+        print('Run report written to %s' % report_file)
 
 
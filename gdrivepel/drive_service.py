@@ -1,15 +1,75 @@
 import httplib2
+import sys
+import urllib
 import webbrowser
 
 from oauth2client import client
 from oauth2client.file import Storage
 from apiclient.discovery import build
 
+# Drive API v3 field masks, limited to what GDriveDownloader uses
+V3_FILE_FIELDS = ('id,name,mimeType,description,createdTime,modifiedTime,version,'
+    'size,quotaBytesUsed,md5Checksum,headRevisionId,lastModifyingUser(displayName,emailAddress),parents')
+V3_LIST_FIELDS = 'nextPageToken,files(%s)' % V3_FILE_FIELDS
+
+# The root folder also needs to tell us which drive it is in
+V3_ROOT_FIELDS = V3_FILE_FIELDS + ',driveId'
+
+# Formats that a Google Doc can be exported as with files.export
+V3_DOCUMENT_EXPORT_TYPES = [
+    'text/html',
+    'text/plain',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'application/zip',
+    'application/vnd.oasis.opendocument.text',
+    'application/rtf',
+    'application/pdf',
+    'application/epub+zip'
+]
+
+# Export and download urls, with the flag that lets them reach items in
+# shared drives
+def all_drives_url(url):
+    return url + ('&' if '?' in url else '?') + 'supportsAllDrives=true'
+
+# Map a v3 file resource onto the v2 keys that the downloader reads.
+# exportLinks and downloadUrl point at the v3 files.export and
+# files.get?alt=media endpoints.
+def v3_to_v2_file(item, base_url):
+    user = item.get('lastModifyingUser', { })
+    v2_item = {
+        'kind': 'drive#file',
+        'id': item['id'],
+        'title': item['name'],
+        'mimeType': item['mimeType'],
+        'createdDate': item.get('createdTime'),
+        'modifiedDate': item.get('modifiedTime'),
+        'version': item.get('version'),
+        'lastModifyingUserName': user.get('displayName'),
+        'lastModifyingUser': { 'emailAddress': user.get('emailAddress') },
+        'parents': [{ 'id': parent_id } for parent_id in item.get('parents', [ ])]
+    }
+    for key in ['description', 'driveId', 'quotaBytesUsed', 'md5Checksum', 'headRevisionId']:
+        if key in item:
+            v2_item[key] = item[key]
+    if 'size' in item:
+        v2_item['fileSize'] = item['size']
+
+    file_url = base_url + 'files/' + urllib.quote(item['id'])
+    if item['mimeType'] == 'application/vnd.google-apps.document':
+        v2_item['exportLinks'] = dict([(export_type,
+            file_url + '/export?' + urllib.urlencode({ 'mimeType': export_type }))
+            for export_type in V3_DOCUMENT_EXPORT_TYPES])
+    elif not item['mimeType'].startswith('application/vnd.google-apps.'):
+        v2_item['downloadUrl'] = file_url + '?alt=media'
+    return v2_item
+
 class DriveServiceAuth(object):
 
     def __init__(self, secrets_path, credentials_path, 
             scope='https://www.googleapis.com/auth/drive',
             api_version='v2'):
+        self.credentials = None
         self.http_auth = None
         self.service = None
         self.scope = scope
@@ -45,6 +105,12 @@ class DriveServiceAuth(object):
                 print('Could not create credentials')
                 sys.exit(1)
 
-        self.http_auth = credentials.authorize(httplib2.Http())
+        self.credentials = credentials
+        self.http_auth = self.authorize_http()
         self.service = build('drive', self.api_version, http=self.http_auth)
         return self.service
+
+    def authorize_http(self):
+        # A new connection sharing our credentials.  httplib2.Http
+        # is not thread-safe, so each thread needs its own.
+        return self.credentials.authorize(httplib2.Http())
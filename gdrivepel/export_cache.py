@@ -0,0 +1,193 @@
+import codecs
+import hashlib
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+from metadata import dump_metadata, load_metadata
+
+# Local content-addressed store of exported and downloaded file bodies.
+#
+# Objects are stored by the SHA-1 of their content in
+# <cache_dir>/objects/ab/abcdef...; index.yml maps each
+# (source_id, version, exported_type) to an object hash, and records
+# the size and last use of each object for LRU eviction.  In memory
+# the objects are kept in least recently used first order, so eviction
+# pops from the front.
+
+CACHE_INDEX_VERSION = 1
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+def make_cache_key(source_id, version, exported_type):
+    return '%s/%s/%s' % (source_id, version, exported_type or '')
+
+def hash_file(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(HASH_BLOCK_SIZE)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+class ExportCache(object):
+    def __init__(self, cache_dir, max_bytes=1024 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.index_file = os.path.join(cache_dir, 'index.yml')
+        self.lock = threading.Lock()
+        # cache key -> object hash
+        self.entries = { }
+        # object hash -> set of cache keys, to drop entries on eviction
+        self.object_keys = { }
+        # object hash -> { 'size': bytes, 'last_used': timestamp },
+        # least recently used first
+        self.objects = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def load(self):
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        if os.path.exists(self.index_file):
+            with codecs.open(self.index_file, 'r', 'utf-8') as f:
+                data = load_metadata(f)
+            if isinstance(data, dict) and data.get('cache_version') == CACHE_INDEX_VERSION:
+                self.entries = data.get('entries') or { }
+                objects = data.get('objects') or { }
+                self.objects = OrderedDict(sorted(objects.items(), key=lambda item: item[1]['last_used']))
+        for key, object_hash in self.entries.items():
+            self.object_keys.setdefault(object_hash, set()).add(key)
+        self.total_bytes = sum([o['size'] for o in self.objects.values()])
+
+    def save(self):
+        with self.lock:
+            data = {
+                'cache_version': CACHE_INDEX_VERSION,
+                'entries': self.entries,
+                'objects': dict(self.objects)
+            }
+            yaml_data = dump_metadata(data)
+        temp_file = self.index_file + '.tmp'
+        with codecs.open(temp_file, 'w+', 'utf-8') as f:
+            f.write(yaml_data)
+        os.rename(temp_file, self.index_file)
+
+    def object_path(self, object_hash):
+        return os.path.join(self.cache_dir, 'objects', object_hash[:2], object_hash)
+
+    # Path of the cached object for this item, or None
+    def lookup(self, source_id, version, exported_type):
+        key = make_cache_key(source_id, version, exported_type)
+        with self.lock:
+            object_hash = self.entries.get(key)
+            if object_hash is not None:
+                path = self.object_path(object_hash)
+                if object_hash in self.objects and os.path.exists(path):
+                    self.touch(object_hash, self.objects[object_hash]['size'])
+                    self.hits += 1
+                    return path
+                self.remove_entry(key)
+            self.misses += 1
+        return None
+
+    # Copy the cached object for this item to content_file.
+    # Returns False if there is no cached object.
+    def copy_to(self, source_id, version, exported_type, content_file):
+        path = self.lookup(source_id, version, exported_type)
+        if path is None:
+            return False
+        dirname, basename = os.path.split(content_file)
+        temp_file = os.path.join(dirname, '.#' + basename + '.part')
+        shutil.copyfile(path, temp_file)
+        os.rename(temp_file, content_file)
+        return True
+
+    def read(self, source_id, version, exported_type):
+        path = self.lookup(source_id, version, exported_type)
+        if path is None:
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def store_file(self, source_id, version, exported_type, content_file):
+        object_hash = hash_file(content_file)
+        path = self.object_path(object_hash)
+        if not os.path.exists(path):
+            self.write_object(path, lambda temp_file: shutil.copyfile(content_file, temp_file))
+        self.add_entry(source_id, version, exported_type, object_hash, os.path.getsize(path))
+
+    def store_content(self, source_id, version, exported_type, content):
+        object_hash = hashlib.sha1(content).hexdigest()
+        path = self.object_path(object_hash)
+        if not os.path.exists(path):
+            def write_content(temp_file):
+                with open(temp_file, 'wb') as f:
+                    f.write(content)
+            self.write_object(path, write_content)
+        self.add_entry(source_id, version, exported_type, object_hash, len(content))
+        return object_hash
+
+    def write_object(self, path, write_fn):
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # Another thread got there first
+                pass
+        temp_file = '%s.%d.%s.tmp' % (path, os.getpid(), threading.current_thread().ident)
+        write_fn(temp_file)
+        os.rename(temp_file, path)
+
+    def add_entry(self, source_id, version, exported_type, object_hash, size):
+        key = make_cache_key(source_id, version, exported_type)
+        with self.lock:
+            if key in self.entries:
+                self.remove_entry(key)
+            self.entries[key] = object_hash
+            self.object_keys.setdefault(object_hash, set()).add(key)
+            if object_hash in self.objects:
+                self.total_bytes -= self.objects[object_hash]['size']
+            self.touch(object_hash, size)
+            self.total_bytes += size
+            self.evict()
+
+    # Move an object to the most recently used end.
+    # Called with the lock held.
+    def touch(self, object_hash, size):
+        self.objects.pop(object_hash, None)
+        self.objects[object_hash] = { 'size': size, 'last_used': time.time() }
+
+    # Called with the lock held.
+    def remove_entry(self, key):
+        object_hash = self.entries.pop(key)
+        keys = self.object_keys.get(object_hash)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.object_keys[object_hash]
+
+    # Remove least recently used objects until we are under max_bytes.
+    # Called with the lock held.
+    def evict(self):
+        while self.total_bytes > self.max_bytes and self.objects:
+            object_hash, info = self.objects.popitem(last=False)
+            self.total_bytes -= info['size']
+            for key in self.object_keys.pop(object_hash, ()):
+                del self.entries[key]
+            self.evicted += 1
+            try:
+                os.remove(self.object_path(object_hash))
+            except OSError:
+                pass
+
+    def summary(self):
+        return ('%d hits, %d misses, %d objects evicted, %d objects cached' %
+            (self.hits, self.misses, self.evicted, len(self.objects)))
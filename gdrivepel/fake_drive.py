@@ -0,0 +1,516 @@
+from __future__ import print_function
+
+import BaseHTTPServer
+import email.parser
+import hashlib
+import io
+import json
+import random
+import re
+import SocketServer
+import struct
+import threading
+import time
+import urllib
+import urlparse
+import zipfile
+import zlib
+
+import httplib2
+from apiclient.discovery import build
+
+# A local stand-in for the Google Drive v2 API, serving a synthetic
+# folder tree so that GDriveDownloader can be benchmarked and tested
+# offline.  Implements just what the downloader uses: files.get,
+# files.list with parent and trashed queries and pagination, and the
+# exportLinks and downloadUrl content endpoints, with Range support.
+#
+# Run the server with `python -m gdrivepel.fake_drive`, then point
+# copy_folder.py at it with --fake_drive URL.
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+DOCUMENT_MIME_TYPE = 'application/vnd.google-apps.document'
+EXPORT_TYPES = [ 'text/html', 'text/plain', 'application/pdf', 'application/zip' ]
+
+BATCH_BOUNDARY = 'fake_drive_batch_response'
+
+DEFAULT_MAX_RESULTS = 100
+MAX_MAX_RESULTS = 1000
+
+# With --shared_drive, every item is in this shared drive, and like
+# Drive the server only gets, lists, exports and downloads them for
+# requests that pass supportsAllDrives (and includeItemsFromAllDrives
+# for lists)
+SHARED_DRIVE_ID = 'drive000001'
+
+CHILDREN_QUERY_RE = re.compile(r'^"([^"]+)" in parents and trashed = false$')
+ALL_ITEMS_QUERY = 'trashed = false'
+
+FAKE_USER_NAME = 'Fake User'
+FAKE_USER_EMAIL = 'fake.user@example.com'
+FAKE_DATE = '2016-01-01T00:00:00.000Z'
+
+HTML_TEMPLATE = ('<html><head><meta content="text/html; charset=UTF-8" http-equiv="content-type">'
+    '<style type="text/css">.c1{font-weight:bold}.c2{font-style:italic}</style></head>'
+    '<body class="c3"><p class="c0"><span class="c1">%s</span></p>%s</body></html>')
+HTML_PARAGRAPH = '<p class="c0"><span class="c2">%s</span> %s</p>'
+# Images are served at this size, and shown at half of it
+HTML_IMAGE = ('<p class="c0"><span style="overflow: hidden; display: inline-block; width: %d.00px; height: %d.00px;">'
+    '<img alt="" src="%s" style="width: %d.00px; height: %d.00px; margin-left: 0.00px; '
+    'margin-top: 0.00px; transform: rotate(0.00rad) translateZ(0px);" title=""></span></p>')
+IMAGE_SIZE = (640, 480)
+LOREM = ('Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod '
+    'tempor incididunt ut labore et dolore magna aliqua. ')
+
+# A PNG of a gradient, different for each n
+def make_png(width, height, n):
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+    rows = [ ]
+    for y in range(height):
+        row = bytearray([0])
+        for x in range(width):
+            row.extend([(x + n * 40) % 256, (y + n * 80) % 256, (x + y) % 256])
+        rows.append(bytes(row))
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return ('\x89PNG\r\n\x1a\n' + chunk('IHDR', header) + chunk('IDAT', zlib.compress(''.join(rows))) +
+        chunk('IEND', ''))
+
+# Minimal discovery document for the drive v2 files.get and files.list
+# methods, enough for apiclient.discovery.build.
+def make_discovery_doc(base_url):
+    return {
+        'kind': 'discovery#restDescription',
+        'discoveryVersion': 'v1',
+        'id': 'drive:v2',
+        'name': 'drive',
+        'version': 'v2',
+        'protocol': 'rest',
+        'rootUrl': base_url + '/',
+        'servicePath': 'drive/v2/',
+        'baseUrl': base_url + '/drive/v2/',
+        'batchPath': 'batch/drive/v2',
+        'parameters': {
+            'alt': { 'type': 'string', 'default': 'json', 'location': 'query' },
+            'fields': { 'type': 'string', 'location': 'query' }
+        },
+        'schemas': {
+            'File': { 'id': 'File', 'type': 'object' },
+            'FileList': { 'id': 'FileList', 'type': 'object' }
+        },
+        'resources': {
+            'files': {
+                'methods': {
+                    'get': {
+                        'id': 'drive.files.get',
+                        'path': 'files/{fileId}',
+                        'httpMethod': 'GET',
+                        'parameters': {
+                            'fileId': { 'type': 'string', 'required': True, 'location': 'path' },
+                            'supportsAllDrives': { 'type': 'boolean', 'location': 'query' }
+                        },
+                        'parameterOrder': [ 'fileId' ],
+                        'response': { '$ref': 'File' }
+                    },
+                    'list': {
+                        'id': 'drive.files.list',
+                        'path': 'files',
+                        'httpMethod': 'GET',
+                        'parameters': {
+                            'q': { 'type': 'string', 'location': 'query' },
+                            'pageToken': { 'type': 'string', 'location': 'query' },
+                            'maxResults': { 'type': 'integer', 'location': 'query' },
+                            'corpora': { 'type': 'string', 'location': 'query' },
+                            'driveId': { 'type': 'string', 'location': 'query' },
+                            'includeItemsFromAllDrives': { 'type': 'boolean', 'location': 'query' },
+                            'supportsAllDrives': { 'type': 'boolean', 'location': 'query' }
+                        },
+                        'response': { '$ref': 'FileList' }
+                    }
+                }
+            }
+        }
+    }
+
+class FakeDriveTree(object):
+    """
+    A synthetic Drive: `depth` levels of folders below the root, each
+    folder with `fanout` subfolders and `files` files.  Files cycle
+    through Google Docs, PDFs and Markdown text files, with PDF and
+    Markdown sizes around `file_size` bytes.  Each doc shows `images`
+    images, from a set of twice as many, so some are on several docs.
+    With shared_drive, the tree is in a shared drive.  The same seed
+    always gives the same tree.
+    """
+
+    def __init__(self, depth=3, fanout=4, files=10, file_size=20000, seed=1, images=0, shared_drive=False):
+        self.depth = depth
+        self.fanout = fanout
+        self.files_per_folder = files
+        self.file_size = file_size
+        self.images_per_doc = images
+        self.image_count = 2 * images
+        self.image_contents = { }
+        self.drive_id = SHARED_DRIVE_ID if shared_drive else None
+        self.random = random.Random(seed)
+        # id -> v2 file resource, without the urls
+        self.items = { }
+        # parent id -> child ids, in listing order
+        self.children = { }
+        self.order = [ ]
+        self.root_id = self.add_folder('Sites', None)
+        self.add_level(self.root_id, 1, '')
+
+    def next_id(self, prefix):
+        return '%s%06d' % (prefix, len(self.items))
+
+    def add_item(self, item_id, title, mime_type, parent_id):
+        item = {
+            'kind': 'drive#file',
+            'id': item_id,
+            'title': title,
+            'mimeType': mime_type,
+            'createdDate': FAKE_DATE,
+            'modifiedDate': FAKE_DATE,
+            'version': '1',
+            'lastModifyingUserName': FAKE_USER_NAME,
+            'lastModifyingUser': { 'emailAddress': FAKE_USER_EMAIL },
+            'parents': [ ]
+        }
+        if parent_id is not None:
+            item['parents'].append({ 'id': parent_id })
+            self.children.setdefault(parent_id, [ ]).append(item_id)
+        if self.drive_id is not None:
+            item['driveId'] = self.drive_id
+        self.items[item_id] = item
+        self.order.append(item_id)
+        return item
+
+    def add_folder(self, title, parent_id):
+        item_id = self.next_id('folder')
+        self.add_item(item_id, title, FOLDER_MIME_TYPE, parent_id)
+        self.children.setdefault(item_id, [ ])
+        return item_id
+
+    def add_level(self, parent_id, level, label):
+        for i in range(self.files_per_folder):
+            self.add_file(parent_id, '%s%d' % (label, i), i)
+        if level > self.depth:
+            return
+        for i in range(self.fanout):
+            sublabel = '%s%d-' % (label, i)
+            folder_id = self.add_folder('%03d] Folder %s' % (i + 1, sublabel.rstrip('-')), parent_id)
+            self.add_level(folder_id, level + 1, sublabel)
+
+    def add_file(self, parent_id, label, i):
+        kind = i % 3
+        if kind == 0:
+            item = self.add_item(self.next_id('doc'), 'Page %s' % label, DOCUMENT_MIME_TYPE, parent_id)
+            item['quotaBytesUsed'] = '0'
+        else:
+            size = max(1, int(self.random.uniform(0.5, 1.5) * self.file_size))
+            if kind == 1:
+                item = self.add_item(self.next_id('pdf'), 'Handout %s.pdf' % label, 'application/pdf', parent_id)
+            else:
+                item = self.add_item(self.next_id('md'), 'Notes %s.md' % label, 'text/plain', parent_id)
+            item['originalFilename'] = item['title']
+            item['fileSize'] = str(size)
+            item['quotaBytesUsed'] = str(size)
+            item['md5Checksum'] = hashlib.md5(self.download_content(item['id'])).hexdigest()
+
+    # Rename an item, or move it to another folder.  As on Drive, this
+    # bumps the version but not the content's checksum or modified date.
+    def rename(self, item_id, title):
+        item = self.items[item_id]
+        item['title'] = title
+        item['version'] = str(int(item['version']) + 1)
+
+    def move(self, item_id, parent_id):
+        item = self.items[item_id]
+        for parent in item['parents']:
+            self.children[parent['id']].remove(item_id)
+        item['parents'] = [ { 'id': parent_id } ]
+        self.children[parent_id].append(item_id)
+        item['version'] = str(int(item['version']) + 1)
+
+    # The item as the API would return it, with urls on this server
+    def resource(self, item_id, base_url):
+        item = dict(self.items[item_id])
+        if item['mimeType'] == DOCUMENT_MIME_TYPE:
+            item['exportLinks'] = dict([(export_type,
+                '%s/export/%s?%s' % (base_url, item_id, urllib.urlencode({ 'mimeType': export_type })))
+                for export_type in EXPORT_TYPES])
+        elif item['mimeType'] != FOLDER_MIME_TYPE:
+            item['downloadUrl'] = '%s/download/%s' % (base_url, item_id)
+        return item
+
+    def query(self, q):
+        if q is None or q == ALL_ITEMS_QUERY:
+            return self.order
+        m = CHILDREN_QUERY_RE.match(q)
+        if m is None:
+            return None
+        return self.children.get(m.group(1), [ ])
+
+    # Image numbers of a doc
+    def doc_images(self, item_id):
+        return [(int(item_id[-6:]) + i) % self.image_count for i in range(self.images_per_doc)]
+
+    # image_src % n is the src of image n
+    def doc_html(self, item_id, image_src):
+        paragraphs = ''.join([HTML_PARAGRAPH % ('Paragraph %d' % i, LOREM * 4) for i in range(12)])
+        width, height = IMAGE_SIZE
+        for n in self.doc_images(item_id):
+            paragraphs += HTML_IMAGE % (width / 2, height / 2, image_src % n, width / 2, height / 2)
+        return HTML_TEMPLATE % (self.items[item_id]['title'], paragraphs)
+
+    def export_content(self, item_id, export_type, base_url=''):
+        title = self.items[item_id]['title']
+        if export_type == 'text/html':
+            return self.doc_html(item_id, base_url + '/image/%d.png')
+        if export_type == 'application/zip':
+            # As Docs does it: the HTML, and the images in images/
+            f = io.BytesIO()
+            with zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED) as archive:
+                archive.writestr(re.sub(r'\W+', '', title) + '.html', self.doc_html(item_id, 'images/image%d.png'))
+                for n in self.doc_images(item_id):
+                    archive.writestr('images/image%d.png' % n, self.image_content(n))
+            return f.getvalue()
+        return '%s\n\n%s' % (title, LOREM * 40)
+
+    def download_content(self, item_id):
+        item = self.items[item_id]
+        size = int(item['fileSize'])
+        if item['mimeType'] == 'text/plain':
+            body = '# %s\n\n' % item['originalFilename']
+            return (body + LOREM * (size / len(LOREM) + 1))[:size]
+        # Deterministic filler bytes for binary files
+        block = ''.join([chr((i * 7 + len(item_id)) % 256) for i in range(256)])
+        return (block * (size / len(block) + 1))[:size]
+
+    def image_content(self, n):
+        if n not in self.image_contents:
+            self.image_contents[n] = make_png(IMAGE_SIZE[0], IMAGE_SIZE[1], n)
+        return self.image_contents[n]
+
+    def summary(self):
+        folders = len([i for i in self.items.values() if i['mimeType'] == FOLDER_MIME_TYPE])
+        return '%d folders, %d files' % (folders, len(self.items) - folders)
+
+class FakeDriveStats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.requests = { }
+        self.bytes_sent = 0
+        self.errors = 0
+
+    def record(self, kind, size, error=False):
+        with self.lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+            self.bytes_sent += size
+            if error:
+                self.errors += 1
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'requests': dict(self.requests),
+                'total_requests': sum(self.requests.values()),
+                'bytes_sent': self.bytes_sent,
+                'errors': self.errors
+            }
+
+class FakeDriveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if url.path == '/stats':
+            return self.send_response_tuple(json_response('stats', self.server.stats.as_dict()), count=False)
+        if url.path.startswith('/discovery/v1/'):
+            return self.send_response_tuple(json_response('discovery', make_discovery_doc(self.server.base_url)))
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+        self.send_response_tuple(self.server.respond(self.path, self.headers))
+
+    # Batch requests: a multipart/mixed body of GET requests, answered
+    # with a multipart/mixed body of responses in the same order.
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('content-length', 0)))
+        if not urlparse.urlparse(self.path).path.startswith('/batch/'):
+            return self.send_response_tuple(error_response('not_found', 404, 'notFound'))
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+
+        message = email.parser.Parser().parsestr(
+            'Content-Type: %s\r\n\r\n%s' % (self.headers.get('content-type'), body))
+        boundary = BATCH_BOUNDARY
+        parts = [ ]
+        for part in message.get_payload():
+            request_lines = part.get_payload().split('\n')
+            method, path = request_lines[0].split(' ')[:2]
+            headers = dict([line.strip().split(': ', 1) for line in request_lines[1:] if ': ' in line])
+            headers = dict([(k.lower(), v) for k, v in headers.items()])
+            kind, status, content_type, content, extra_headers, error = self.server.respond(path, headers)
+            self.server.stats.record(kind, len(content), error)
+            parts.append('--%s\r\nContent-Type: application/http\r\nContent-ID: <response-%s>\r\n\r\n'
+                'HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n\r\n%s\r\n' % (
+                boundary, part['content-id'].strip('<>'), status, self.responses.get(status, ('', ))[0],
+                content_type, len(content), content))
+        parts.append('--%s--\r\n' % boundary)
+        self.send_response_tuple(('batch', 200, 'multipart/mixed; boundary=%s' % boundary,
+            ''.join(parts), [ ], False))
+
+    def send_response_tuple(self, response, count=True):
+        kind, status, content_type, body, extra_headers, error = response
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in extra_headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        if count:
+            self.server.stats.record(kind, len(body), error)
+
+# Responses are (kind, status, content type, body, extra headers, error)
+def json_response(kind, data, status=200, error=False):
+    return (kind, status, 'application/json; charset=UTF-8', json.dumps(data), [ ], error)
+
+def error_response(kind, status, reason):
+    body = { 'error': { 'code': status, 'message': reason,
+        'errors': [ { 'domain': 'usageLimits', 'reason': reason } ] } }
+    return json_response(kind, body, status=status, error=True)
+
+def content_response(kind, content, mime_type, range_header=None):
+    size = len(content)
+    m = re.match(r'^bytes=(\d+)-(\d*)$', range_header or '')
+    if m is None:
+        return (kind, 200, mime_type, content, [ ], False)
+    first = int(m.group(1))
+    last = min(int(m.group(2)) if m.group(2) else size - 1, size - 1)
+    if first >= size:
+        return (kind, 416, mime_type, '', [ ('Content-Range', 'bytes */%d' % size) ], False)
+    return (kind, 206, mime_type, content[first:last + 1],
+        [ ('Content-Range', 'bytes %d-%d/%d' % (first, last, size)) ], False)
+
+class FakeDriveServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, tree, host='127.0.0.1', port=0, latency=0.0, error_rate=0.0, seed=1, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), FakeDriveHandler)
+        self.tree = tree
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.verbose = verbose
+        self.stats = FakeDriveStats()
+        self.base_url = 'http://%s:%d' % self.server_address
+
+    def respond(self, path, headers):
+        url = urlparse.urlparse(path)
+        params = dict(urlparse.parse_qsl(url.query))
+        parts = [urllib.unquote(p) for p in url.path.split('/') if p]
+        kind = parts[0] if parts else 'unknown'
+
+        # Fail like Drive does, with a mix of rate limit and backend errors
+        if self.random.random() < self.error_rate:
+            if self.random.random() < 0.5:
+                return error_response(kind, 403, 'userRateLimitExceeded')
+            return error_response(kind, 503, 'backendError')
+
+        tree = self.tree
+        if parts == [ 'drive', 'v2', 'files' ]:
+            return self.files_list(params)
+        item_id = parts[-1] if len(parts) in [ 2, 4 ] else None
+        if (item_id in tree.items and 'driveId' in tree.items[item_id] and
+                parts[0] != 'image' and params.get('supportsAllDrives') != 'true'):
+            # Drive says a shared drive item without supportsAllDrives isn't there
+            return error_response(kind, 404, 'notFound')
+        if len(parts) == 4 and parts[:3] == [ 'drive', 'v2', 'files' ] and parts[3] in tree.items:
+            return json_response('files.get', tree.resource(parts[3], self.base_url))
+        if len(parts) == 2 and parts[0] == 'export' and parts[1] in tree.items:
+            export_type = params.get('mimeType', 'text/html')
+            return content_response('export', tree.export_content(parts[1], export_type, self.base_url), export_type)
+        m = re.match(r'^(\d+)\.png$', parts[1]) if len(parts) == 2 and parts[0] == 'image' else None
+        if m is not None and int(m.group(1)) < tree.image_count:
+            return content_response('image', tree.image_content(int(m.group(1))), 'image/png')
+        if len(parts) == 2 and parts[0] == 'download' and 'fileSize' in tree.items.get(parts[1], { }):
+            mime_type = tree.items[parts[1]]['mimeType']
+            return content_response('download', tree.download_content(parts[1]), mime_type, headers.get('range'))
+        return error_response('not_found', 404, 'notFound')
+
+    def files_list(self, params):
+        item_ids = self.tree.query(params.get('q'))
+        if item_ids is None:
+            return error_response('files.list', 400, 'invalidQuery')
+        if params.get('supportsAllDrives') != 'true' or params.get('includeItemsFromAllDrives') != 'true':
+            item_ids = [item_id for item_id in item_ids if 'driveId' not in self.tree.items[item_id]]
+        max_results = min(int(params.get('maxResults', DEFAULT_MAX_RESULTS)), MAX_MAX_RESULTS)
+        start = int(params.get('pageToken') or 0)
+        page_ids = item_ids[start:start + max_results]
+        result = {
+            'kind': 'drive#fileList',
+            'items': [self.tree.resource(item_id, self.base_url) for item_id in page_ids]
+        }
+        if start + max_results < len(item_ids):
+            result['nextPageToken'] = str(start + max_results)
+        return json_response('files.list', result)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+# Stands in for DriveServiceAuth, building a service for the fake
+# server with plain, unauthorized connections.
+class FakeDriveServiceAuth(object):
+    def __init__(self, server_url, api_version='v2'):
+        self.server_url = server_url.rstrip('/')
+        self.api_version = api_version
+        self.service = None
+
+    def build_service(self):
+        discovery_url = self.server_url + '/discovery/v1/apis/{api}/{apiVersion}/rest'
+        self.service = build('drive', self.api_version, http=self.authorize_http(),
+            discoveryServiceUrl=discovery_url, cache_discovery=False)
+        return self.service
+
+    def authorize_http(self):
+        return httplib2.Http()
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Serve a synthetic Google Drive tree for offline testing')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8765, help='port to listen on')
+    parser.add_argument('--depth', type=int, default=3, help='levels of folders below the root')
+    parser.add_argument('--fanout', type=int, default=4, help='subfolders per folder')
+    parser.add_argument('--files', type=int, default=10, help='files per folder')
+    parser.add_argument('--file_size', type=int, default=20000, help='average size of PDF and Markdown files')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every API request')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='fraction of requests that fail with 403 or 503')
+    parser.add_argument('--images', type=int, default=0, help='images in each Google Doc')
+    parser.add_argument('--shared_drive', action='store_true', help='put the tree in a shared drive')
+    parser.add_argument('--seed', type=int, default=1, help='random seed for the tree and for errors')
+    parser.add_argument('-v', '--verbose', action='store_true', help='log every request')
+    args = parser.parse_args()
+
+    tree = FakeDriveTree(args.depth, args.fanout, args.files, args.file_size, args.seed, args.images,
+        args.shared_drive)
+    server = FakeDriveServer(tree, args.host, args.port, args.latency, args.error_rate, args.seed, args.verbose)
+    print('Serving %s at %s, root folder id %s' % (tree.summary(), server.base_url, tree.root_id))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -5,13 +5,13 @@ import logging
 import os.path
 import re
 import sys
-import yaml
 
 from pelican.contents import is_valid_content
 from pelican.generators import CachingGenerator, PagesGenerator
 from pelican.readers import parse_path_metadata
 
 from gdrivepel.contents import Page, DocMeta, NavMenu
+from gdrivepel.metadata import dump_metadata
 from gdrivepel.readers import YamlReader
 from gdrivepel.sanitizer import slugify, make_meta_filename
 from gdrivepel.search import on_content
@@ -188,6 +188,11 @@ class YamlGenerator(CachingGenerator):
         # directory tree
         self.docid_map = { }
         self.by_classes = { }
+        # Folder location to { 'docs': { location: Doc }, 'subfolders':
+        # { folder: DocMeta }, 'folder_meta': DocMeta or None }, built in
+        # _categorize_filenames.  'section_meta', the nearest _folder_.yml
+        # DocMeta or None, is added when a folder is first looked up.
+        self.folders = { }
         self.navmenus = { }
         self.index_pages = [ ]
 
@@ -272,16 +277,31 @@ class YamlGenerator(CachingGenerator):
         return None
 
     def _folder_meta_for_page(self, location):
-        """Work up the location hierarchy looking for a _folder_.yml DocMeta content"""
+        """Find the nearest _folder_.yml DocMeta content at or above the page's folder"""
         # Location is something like pages/sites/district/general-information/lcap-and-accountability-reports/lcap-and-accountability-reports.md
-        # See if we have a pages/sites/district/general-information/lcap-and-accountability-reports/_folder_.yml
-        dirname = os.path.dirname(location)
-        while dirname != '':
-            yaml_filename = os.path.join(dirname, '_folder_.yml')
-            if yaml_filename in self.context['filenames']:
-                return self.context['filenames'][yaml_filename]
-            dirname = os.path.dirname(dirname)
-        return None
+        # The nearest would be pages/sites/district/general-information/lcap-and-accountability-reports/_folder_.yml
+        return self._section_meta_for_folder(os.path.dirname(location))
+
+    def _section_meta_for_folder(self, folder):
+        """
+        Work up the folder hierarchy looking for a _folder_.yml DocMeta content.
+        Each folder is only looked up once, the answer is kept in self.folders.
+        """
+        walked = [ ]
+        section_meta = None
+        while folder != '':
+            entry = self._folder_entry(folder)
+            if 'section_meta' in entry:
+                section_meta = entry['section_meta']
+                break
+            walked.append(entry)
+            if entry['folder_meta'] is not None:
+                section_meta = entry['folder_meta']
+                break
+            folder = os.path.dirname(folder)
+        for entry in walked:
+            entry['section_meta'] = section_meta
+        return section_meta
 
     def _add_yaml_meta_to_page(self, location, page):
         doc_meta = self._doc_meta_for_page(location)
@@ -318,8 +338,8 @@ class YamlGenerator(CachingGenerator):
             navmenu_file = os.path.join(sub_folder, '_navmenu_.yml')
             if navmenu_file in self.by_classes['NavMenu']:
                 item_type = 'include'
-            elif sub_location in self.by_classes['DocMeta']:
-                section_meta = self.by_classes['DocMeta'][sub_location]
+            elif self.folders.get(sub_folder, { }).get('folder_meta') is not None:
+                section_meta = self.folders[sub_folder]['folder_meta']
                 subsub = self._get_submenu_for_section(sub_folder, section_meta)
                 if len(subsub) > 0:
                     item_type = 'section'
@@ -331,32 +351,32 @@ class YamlGenerator(CachingGenerator):
         return submenu
 
     def _build_section_links(self, folder, section_meta):
+        entry = self._folder_entry(folder)
+
+        # Sorted by location first, so that docs with the same title
+        # always come out in the same order
         doc_links = [ ]
-        for location, doc in self.by_classes['Doc'].iteritems():
-            dirname, fname = os.path.split(location)
-            if dirname == folder:
-                title = None
-                if 'title' in doc.metadata:
-                    title = doc.metadata['title']
-                else:
-                    logger.warn('No title for %s %s in %s' % (doc.__class__.__name__, fname, dirname))
-                    title = fname
-                doc_links.append(
-                    (doc.metadata.get('sorted_title', title), title, doc.url, doc.__class__.__name__))
+        for location, doc in sorted(entry['docs'].iteritems()):
+            fname = os.path.basename(location)
+            title = None
+            if 'title' in doc.metadata:
+                title = doc.metadata['title']
+            else:
+                logger.warn('No title for %s %s in %s' % (doc.__class__.__name__, fname, folder))
+                title = fname
+            doc_links.append(
+                (doc.metadata.get('sorted_title', title), title, doc.url, doc.__class__.__name__))
 
         subfolder_links = [ ]
-        for location, doc_meta in self.by_classes['DocMeta'].iteritems():
-            dirname, fname = os.path.split(location)
-            parent = os.path.dirname(dirname)
-            if fname == '_folder_.yml' and parent == folder:
-                title = None
-                if 'title' in doc_meta.metadata:
-                    title = doc_meta.metadata['title']
-                else:
-                    logger.warn('No title for subfolder %s in %s' % (dirname, parent))
-                    title = fname
-                subfolder_links.append(
-                    (doc_meta.metadata.get('sorted_title', title), title, dirname, 'DocMeta'))
+        for dirname, doc_meta in sorted(entry['subfolders'].iteritems()):
+            title = None
+            if 'title' in doc_meta.metadata:
+                title = doc_meta.metadata['title']
+            else:
+                logger.warn('No title for subfolder %s in %s' % (dirname, folder))
+                title = '_folder_.yml'
+            subfolder_links.append(
+                (doc_meta.metadata.get('sorted_title', title), title, dirname, 'DocMeta'))
 
         section_meta.metadata['contents'] = [ ]
         for link in sorted(doc_links, key=lambda x: x[0]):
@@ -434,20 +454,18 @@ class YamlGenerator(CachingGenerator):
 
     def _build_sections(self):
         # Build deepest sections first, because they may be included by shorter ones
-        section_paths = sorted(self.by_classes['DocMeta'].keys(), key=lambda path: -len(path))
-        for location in section_paths:
-            dirname, fname = os.path.split(location)
-            if fname == '_folder_.yml':
-                section_meta = self.by_classes['DocMeta'][location]
+        section_folders = [folder for folder, entry in self.folders.iteritems() if entry['folder_meta'] is not None]
+        for dirname in sorted(section_folders, key=lambda path: (-len(path), path)):
+            section_meta = self.folders[dirname]['folder_meta']
 
-                # Capture ordered links to contents and subtopics
-                self._build_section_links(dirname, section_meta)
+            # Capture ordered links to contents and subtopics
+            self._build_section_links(dirname, section_meta)
 
-                # Depends on having subsection navmenus completed first
-                self._build_section_navmenu(dirname, section_meta)
+            # Depends on having subsection navmenus completed first
+            self._build_section_navmenu(dirname, section_meta)
 
-                # Must be done AFTER _build_section_links
-                self._create_section_index(dirname, section_meta)
+            # Must be done AFTER _build_section_links
+            self._create_section_index(dirname, section_meta)
 
     def _set_sections_for_pages(self):
         """
@@ -470,6 +488,7 @@ class YamlGenerator(CachingGenerator):
         """
         for classname in CONTENT_CLASSES:
             self.by_classes[classname] = { }
+        self.folders = { }
         for location, obj in self.context['filenames'].iteritems():
             classname = None
             if obj is not None:
@@ -484,6 +503,26 @@ class YamlGenerator(CachingGenerator):
                     classname = 'Doc'
                     self.by_classes[classname][location] = obj
 
+                self._index_folder_content(location, classname, obj)
+
+    def _folder_entry(self, folder):
+        entry = self.folders.get(folder)
+        if entry is None:
+            entry = self.folders[folder] = { 'docs': { }, 'subfolders': { }, 'folder_meta': None }
+        return entry
+
+    def _index_folder_content(self, location, classname, obj):
+        """
+        Add a content item to the parent-to-children folder index, so that
+        sections don't have to scan every doc to find their own.
+        """
+        dirname, fname = os.path.split(location)
+        if classname == 'Doc':
+            self._folder_entry(dirname)['docs'][location] = obj
+        elif classname == 'DocMeta' and fname == '_folder_.yml':
+            self._folder_entry(dirname)['folder_meta'] = obj
+            self._folder_entry(os.path.dirname(dirname))['subfolders'][dirname] = obj
+
     def _resolve_navmenu_item(self, item, dirname):
         name = item['title']
         slug = slugify(name)
@@ -526,27 +565,22 @@ class YamlGenerator(CachingGenerator):
     def _build_automenu(self):
         top = None
 
-        # Get shortest paths first
-        file_paths = sorted(self.by_classes['DocMeta'].keys(), key=lambda path: len(path))
-        for location in file_paths:
-            loc_parts = location.split(os.sep)
-            depth = len(loc_parts) - 2
-            if depth == 0 and loc_parts[0] == 'pages' and loc_parts[-1] == '_folder_.yml':
-                folder_meta = self.by_classes['DocMeta'][location]
-                navmenu = folder_meta.metadata['navmenu']
-                if len(navmenu) > 0:
-                    dirname, filename = os.path.split(location)
-                    navmenu_file = os.path.abspath(os.path.join(self.path, 'pages', '_navmenu_auto_.yml'))
-                    navmenu_dict = { 'navmenu': navmenu }
-                    yaml_meta = yaml.safe_dump(navmenu_dict, default_flow_style=False,  explicit_start=True)
-                    with codecs.open(navmenu_file, 'w+', 'utf-8') as f:
-                        f.write(yaml_meta)
-                    self.navmenus[dirname] = [ ]
-                    for item in navmenu:
-                        name, link, submenu = self._resolve_navmenu_item(item, dirname)
-                        self.navmenus[dirname].append((name, link, submenu))
-                    top = dirname
-                break
+        # The top-level pages/_folder_.yml
+        dirname = 'pages'
+        folder_meta = self.folders.get(dirname, { }).get('folder_meta')
+        if folder_meta is not None:
+            navmenu = folder_meta.metadata['navmenu']
+            if len(navmenu) > 0:
+                navmenu_file = os.path.abspath(os.path.join(self.path, 'pages', '_navmenu_auto_.yml'))
+                navmenu_dict = { 'navmenu': navmenu }
+                yaml_meta = dump_metadata(navmenu_dict)
+                with codecs.open(navmenu_file, 'w+', 'utf-8') as f:
+                    f.write(yaml_meta)
+                self.navmenus[dirname] = [ ]
+                for item in navmenu:
+                    name, link, submenu = self._resolve_navmenu_item(item, dirname)
+                    self.navmenus[dirname].append((name, link, submenu))
+                top = dirname
 
         return top
 
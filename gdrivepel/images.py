@@ -0,0 +1,256 @@
+import codecs
+import io
+from multiprocessing.pool import ThreadPool
+import os
+import re
+import socket
+import threading
+from xml.sax.saxutils import escape, unescape
+
+import httplib2
+
+# Optional, to scale images down to the size they are shown at
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from export_cache import ExportCache
+from sanitized_cache import link_file
+
+# Copies the images that sanitized pages load from googleusercontent.com
+# (or anywhere else) next to the pages, and points the <img> tags at
+# the copies.  Each image is fetched once and written under a name made
+# from its content hash, so an image used on several pages in a folder
+# is one file.  With PIL, an image larger than the width and height in
+# its style is scaled down to that size.
+#
+# Fetched and scaled images are kept in an ExportCache, keyed by url
+# and by (original hash, size), so a later run doesn't fetch or scale
+# them again.
+
+IMAGE_FETCH_THREADS = 8
+IMAGE_FETCH_TIMEOUT = 60
+
+# Not starting with _, which Pelican ignores
+IMAGE_PREFIX = 'image-'
+
+JPEG_QUALITY = 85
+
+IMG_TAG_RE = re.compile(r'<img\b(?:[^>"\']|"[^"]*"|\'[^\']*\')*>', re.IGNORECASE)
+SRC_ATTRIBUTE_RE = re.compile(r'(\ssrc=)(?:"([^"]*)"|\'([^\']*)\')', re.IGNORECASE)
+STYLE_ATTRIBUTE_RE = re.compile(r'(\sstyle=)(?:"([^"]*)"|\'([^\']*)\')', re.IGNORECASE)
+STYLE_SIZE_RE = re.compile(r'(?:^|;)\s*(width|height)\s*:\s*([\d.]+)px', re.IGNORECASE)
+
+IMAGE_SIGNATURES = [
+    ('\x89PNG\r\n\x1a\n', 'png'),
+    ('\xff\xd8\xff', 'jpg'),
+    ('GIF87a', 'gif'),
+    ('GIF89a', 'gif')
+]
+
+def image_extension(content):
+    for signature, extension in IMAGE_SIGNATURES:
+        if content.startswith(signature):
+            return extension
+    if content[:4] == 'RIFF' and content[8:12] == 'WEBP':
+        return 'webp'
+    return None
+
+def make_image_filename(object_hash, extension):
+    return IMAGE_PREFIX + object_hash[:16] + '.' + extension
+
+def attribute_value(m):
+    return unescape(m.group(2) if m.group(2) is not None else m.group(3), { '&quot;': '"' })
+
+# (width, height) in px from an <img> style, or None
+def style_size(tag):
+    m = STYLE_ATTRIBUTE_RE.search(tag)
+    if m is None:
+        return None
+    size = { }
+    for name, value in STYLE_SIZE_RE.findall(attribute_value(m)):
+        size[name.lower()] = int(round(float(value)))
+    if 'width' not in size or 'height' not in size:
+        return None
+    return (size['width'], size['height'])
+
+# (url, size) of an <img> tag with an http or https src, or None
+def remote_image(tag):
+    m = SRC_ATTRIBUTE_RE.search(tag)
+    if m is None:
+        return None
+    url = attribute_value(m).strip()
+    if not re.match(r'^https?://', url, re.IGNORECASE):
+        return None
+    return (url, style_size(tag))
+
+# The image scaled to size, or None if it is no larger than that or
+# is not a PNG or JPEG (GIFs may be animated)
+def scale_image(content, size):
+    try:
+        image = Image.open(io.BytesIO(content))
+        image_format = image.format
+        if image_format not in [ 'PNG', 'JPEG' ]:
+            return None
+        width, height = size
+        if width <= 0 or height <= 0 or (image.size[0] <= width and image.size[1] <= height):
+            return None
+        if image.mode not in [ 'RGB', 'RGBA', 'L', 'LA' ]:
+            image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+        image = image.resize((width, height), Image.LANCZOS)
+        out = io.BytesIO()
+        if image_format == 'JPEG':
+            image.convert('RGB').save(out, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+        else:
+            image.save(out, 'PNG', optimize=True)
+        return out.getvalue()
+    except Exception:
+        # Truncated, corrupt or oversized images are used as they are
+        return None
+
+class ImageLocalizer(object):
+    def __init__(self, cache_dir, max_bytes, threads=IMAGE_FETCH_THREADS, verbose=False):
+        self.cache = ExportCache(cache_dir, max_bytes)
+        self.cache.load()
+        self.threads = max(1, threads)
+        self.verbose = verbose
+        self.thread_local = threading.local()
+        self.lock = threading.Lock()
+        self.counters = {
+            'pages': 0,
+            'images': 0,
+            'fetched': 0,
+            'failed': 0,
+            'scaled': 0,
+            'written': 0
+        }
+
+    def increment(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def get_http(self):
+        http = getattr(self.thread_local, 'http', None)
+        if http is None:
+            http = self.thread_local.http = httplib2.Http(timeout=IMAGE_FETCH_TIMEOUT)
+        return http
+
+    # Hash of the cached image at url, fetched if it isn't cached yet.
+    # None if it can't be fetched.
+    def fetch(self, url):
+        path = self.cache.lookup(url, '', 'image')
+        if path is not None:
+            return os.path.basename(path)
+        try:
+            resp, content = self.get_http().request(url.encode('utf-8'))
+            if resp.status != 200:
+                raise IOError('HTTP status %d' % resp.status)
+            if image_extension(content) is None:
+                raise IOError('not an image')
+        except (IOError, socket.error, httplib2.HttpLib2Error) as e:
+            self.increment('failed')
+            if self.verbose:
+                print('Image %s not fetched: %s' % (url, e))
+            return None
+        self.increment('fetched')
+        return self.cache.store_content(url, '', 'image', content)
+
+    # Hash of the cached image scaled down to size (or of the image
+    # itself, if it doesn't need scaling)
+    def scale(self, object_hash, size):
+        if Image is None or size is None:
+            return object_hash
+        version = '%dx%d' % size
+        path = self.cache.lookup(object_hash, version, 'scaled')
+        if path is not None:
+            return os.path.basename(path)
+        with open(self.cache.object_path(object_hash), 'rb') as f:
+            content = f.read()
+        scaled_content = scale_image(content, size)
+        if scaled_content is None or len(scaled_content) >= len(content):
+            # Stored as is, so that the next run doesn't try again
+            scaled_content = content
+        else:
+            self.increment('scaled')
+        return self.cache.store_content(object_hash, version, 'scaled', scaled_content)
+
+    def prepare_image(self, url_size):
+        url, size = url_size
+        object_hash = self.fetch(url)
+        if object_hash is None:
+            return None
+        try:
+            object_hash = self.scale(object_hash, size)
+            path = self.cache.object_path(object_hash)
+            with open(path, 'rb') as f:
+                extension = image_extension(f.read(12))
+        except IOError:
+            # Evicted from the cache since it was stored
+            self.increment('failed')
+            return None
+        return (path, make_image_filename(object_hash, extension))
+
+    # Point the remote <img>s of the pages (paths relative to
+    # root_path) at local copies.  Returns {page: [paths of its images]}.
+    def localize(self, root_path, pages):
+        page_html = { }
+        wanted = set()
+        for page in pages:
+            with codecs.open(os.path.join(root_path, page), 'r', 'utf-8') as f:
+                html = f.read()
+            images = [remote_image(tag) for tag in IMG_TAG_RE.findall(html)]
+            images = [image for image in images if image is not None]
+            if images:
+                page_html[page] = html
+                wanted.update(images)
+        wanted = sorted(wanted)
+
+        pool = ThreadPool(min(self.threads, max(1, len(wanted))))
+        try:
+            prepared = dict(zip(wanted, pool.map(self.prepare_image, wanted)))
+        finally:
+            pool.close()
+            pool.join()
+
+        page_images = { }
+        for page, html in sorted(page_html.items()):
+            page_images[page] = self.localize_page(root_path, page, html, prepared)
+        return page_images
+
+    def localize_page(self, root_path, page, html, prepared):
+        dirname = os.path.dirname(page)
+        image_paths = [ ]
+
+        def replace_src(m):
+            tag = m.group(0)
+            image = prepared.get(remote_image(tag))
+            if image is None:
+                return tag
+            path, filename = image
+            image_path = os.path.join(dirname, filename)
+            local_file = os.path.join(root_path, image_path)
+            if not os.path.exists(local_file):
+                link_file(path, local_file)
+                self.increment('written')
+            if image_path not in image_paths:
+                image_paths.append(image_path)
+            self.increment('images')
+            return SRC_ATTRIBUTE_RE.sub(lambda s: '%s"%s"' % (s.group(1), escape(filename, { '"': '&quot;' })), tag, 1)
+
+        new_html = IMG_TAG_RE.sub(replace_src, html)
+        if new_html != html:
+            # Replace rather than rewrite, the page may be linked to a cached copy
+            page_file = os.path.join(root_path, page)
+            temp_file = os.path.join(root_path, dirname, '.#' + os.path.basename(page) + '.part')
+            with codecs.open(temp_file, 'w+', 'utf-8') as f:
+                f.write(new_html)
+            os.rename(temp_file, page_file)
+            self.increment('pages')
+        return image_paths
+
+    def summary(self):
+        counters = self.counters
+        return ('%d images on %d pages made local, %d fetched, %d failed, %d scaled down, %d files written' % (
+            counters['images'], counters['pages'], counters['fetched'], counters['failed'],
+            counters['scaled'], counters['written']))
@@ -0,0 +1,110 @@
+import json
+import os.path
+import threading
+import time
+
+# Append-only record of the folders and files that a crawl has
+# finished writing, one JSON object per line, so that an interrupted
+# run can be resumed with --resume instead of starting over.  The
+# journal is removed once a run completes.
+
+def make_journal_filename(root_id):
+    return '_journal_' + root_id + '.jsonl'
+
+class CrawlJournal(object):
+    def __init__(self, journal_file):
+        self.journal_file = journal_file
+        self.lock = threading.Lock()
+        self.f = None
+        # Entries read from the interrupted run, by Drive id
+        self.files = { }
+        self.folders = { }
+
+    # Read the journal of an interrupted run.  A crash can leave a
+    # partial last line, which is ignored.
+    def load(self):
+        self.files = { }
+        self.folders = { }
+        if not os.path.exists(self.journal_file):
+            return 0
+        with open(self.journal_file, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry.get('type') == 'file':
+                    previous = self.files.get(entry['id'])
+                    if (previous is not None and previous['version'] == entry['version'] and
+                            previous['exported_type'] == entry['exported_type']):
+                        # A Drive item can have more than one parent
+                        entry['paths'] = previous['paths'] + [p for p in entry['paths'] if p not in previous['paths']]
+                        images = previous.get('images', [ ])
+                        entry['images'] = images + [p for p in entry.get('images', [ ]) if p not in images]
+                    self.files[entry['id']] = entry
+                elif entry.get('type') == 'folder':
+                    self.folders[entry['id']] = entry
+        return len(self.files) + len(self.folders)
+
+    # Start appending.  Without resume, any previous journal is discarded.
+    def open(self, root_id, resume=False):
+        self.f = open(self.journal_file, 'a' if resume else 'w')
+        self.append({ 'type': 'resume' if resume else 'start', 'root_id': root_id, 'time': time.time() })
+
+    def append(self, entry):
+        line = json.dumps(entry, sort_keys=True) + '\n'
+        with self.lock:
+            self.f.write(line)
+            # Flush every entry so that a crash loses at most the item in progress
+            self.f.flush()
+
+    def record_folder(self, source_id, version, path):
+        self.append({ 'type': 'folder', 'id': source_id, 'version': version, 'path': path })
+
+    # paths are the files fetched for the item, images any images
+    # unpacked from a zip export
+    def record_file(self, source_id, version, exported_type, paths, images=None):
+        entry = { 'type': 'file', 'id': source_id, 'version': version,
+            'exported_type': exported_type, 'paths': paths }
+        if images:
+            entry['images'] = images
+        self.append(entry)
+
+    # True if the interrupted run finished writing this version of the
+    # folder's metadata, and it is still on disk.
+    def is_folder_done(self, source_id, version, root_path, meta_path):
+        entry = self.folders.get(source_id)
+        if entry is None or entry.get('version') != version:
+            return False
+        return os.path.exists(os.path.join(root_path, meta_path))
+
+    # True if the interrupted run wrote all of `paths` for this version
+    # and export type of the item, and the files and any images are
+    # still on disk.
+    def is_file_done(self, source_id, version, exported_type, root_path, paths):
+        entry = self.files.get(source_id)
+        if entry is None:
+            return False
+        if entry.get('version') != version or entry.get('exported_type') != exported_type:
+            return False
+        for path in paths:
+            if path not in entry['paths']:
+                return False
+        for path in paths + entry.get('images', [ ]):
+            if not os.path.exists(os.path.join(root_path, path)):
+                return False
+        return True
+
+    # The images the interrupted run unpacked for the item
+    def file_images(self, source_id):
+        entry = self.files.get(source_id)
+        if entry is None:
+            return [ ]
+        return entry.get('images', [ ])
+
+    def close(self, remove=False):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+        if remove and os.path.exists(self.journal_file):
+            os.remove(self.journal_file)
@@ -0,0 +1,151 @@
+import re
+import threading
+from xml.sax.saxutils import unescape
+
+from lxml import etree
+
+# A bleach.clean(..., strip=True) work-alike on top of lxml.  The
+# document is parsed by libxml2 and walked once: disallowed elements
+# are dropped but their content kept, attributes are filtered with the
+# same allow-lists, URI protocol check and CSS filtering as bleach,
+# and the result is serialized the way bleach's html5lib serializer
+# does it (sorted attributes, every end tag, & < > escaped in text).
+#
+# Unlike bleach, which is given a fragment, clean() takes a whole
+# document and cleans the content of its <body>.  Like html5lib, it
+# normalizes line breaks and puts <tr>s that are directly in a <table>
+# in a <tbody>.  libxml2 fixes up badly nested markup, such as a <div>
+# in a <p>, before disallowed tags are dropped, so output can differ
+# from bleach's on such markup.  Google Docs exports are well formed.
+
+ALLOWED_PROTOCOLS = [ 'http', 'https', 'mailto' ]
+
+# Attributes checked against the allowed protocols, as in html5lib's sanitizer
+URI_ATTRIBUTES = [ 'action', 'background', 'cite', 'datasrc', 'dynsrc', 'href',
+    'longdesc', 'lowsrc', 'ping', 'poster', 'src', 'xlink:href', 'xml:base' ]
+
+VOID_ELEMENTS = set([ 'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+    'keygen', 'link', 'meta', 'param', 'source', 'track', 'wbr' ])
+
+URI_STRIP_RE = re.compile(u'[`\000-\040\177-\240\\s]+')
+URI_SCHEME_RE = re.compile(r'^[a-z0-9][-+.a-z0-9]*:')
+
+CSS_URL_RE = re.compile(r'url\s*\(\s*[^\s)]+?\s*\)\s*')
+CSS_GAUNTLET_RE = re.compile(r"""^([-/:,#%.'"\sa-zA-Z0-9!]|\w-\w|'[\s\w]+'"""
+    r"""\s*|"[\s\w]+"|\([\d,%\.\s]+\))*$""")
+CSS_STYLE_RE = re.compile(r'^\s*([-\w]+\s*:[^:;]*(;\s*|$))*$')
+CSS_PROPERTY_RE = re.compile(r'([-\w]+)\s*:\s*([^:;]*)')
+
+# lxml parsers should not be shared between threads
+parsers = threading.local()
+
+def get_parser():
+    parser = getattr(parsers, 'parser', None)
+    if parser is None:
+        parser = parsers.parser = etree.HTMLParser(encoding='utf-8')
+    return parser
+
+def escape_text(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+# The same filtering as bleach's sanitize_css
+def clean_style(style, styles):
+    style = CSS_URL_RE.sub(' ', style)
+    for part in style.split(';'):
+        if not CSS_GAUNTLET_RE.match(part):
+            return ''
+    if not CSS_STYLE_RE.match(style):
+        return ''
+    clean = [ ]
+    for prop, value in CSS_PROPERTY_RE.findall(style):
+        if value and prop.lower() in styles:
+            clean.append(prop + ': ' + value + ';')
+    return ' '.join(clean)
+
+def has_allowed_protocol(value, protocols):
+    value = URI_STRIP_RE.sub('', unescape(value)).lower().replace(u'\ufffd', '')
+    return not URI_SCHEME_RE.match(value) or value.split(':')[0] in protocols
+
+def quote_attribute(value):
+    value = value.replace('&', '&amp;')
+    if '"' in value and "'" not in value:
+        return "'" + value + "'"
+    return '"' + value.replace('"', '&quot;') + '"'
+
+def start_tag(tag, attrib, allowed, styles, protocols):
+    if callable(allowed):
+        attrs = [(name, value) for name, value in attrib.items() if allowed(name, value)]
+    else:
+        attrs = [(name, value) for name, value in attrib.items() if name in allowed]
+    if not attrs:
+        return '<' + tag + '>'
+    parts = [ '<', tag ]
+    for name, value in sorted(attrs):
+        if name in URI_ATTRIBUTES and not has_allowed_protocol(value, protocols):
+            continue
+        if name == 'style':
+            value = clean_style(value, styles)
+        parts.append(' ' + name + '=' + quote_attribute(value))
+    parts.append('>')
+    return ''.join(parts)
+
+def clean(text, tags, attributes, styles=[ ], protocols=ALLOWED_PROTOCOLS, strip_comments=True):
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    root = etree.fromstring(text, get_parser())
+    if root is None:
+        return u''
+    body = root.find('body')
+    if body is None:
+        return u''
+
+    tags = set(tags)
+    out = [ ]
+    append = out.append
+
+    def walk(element):
+        tag = element.tag
+        if tag is etree.Comment:
+            if not strip_comments:
+                append(u'<!--%s-->' % element.text)
+        elif tag is etree.PI or tag is etree.Entity:
+            pass
+        elif tag in tags:
+            append(start_tag(tag, element.attrib, attributes.get(tag, [ ]), styles, protocols))
+            if element.text:
+                append(escape_text(element.text))
+            if tag == 'table':
+                walk_table(element)
+            else:
+                for child in element:
+                    walk(child)
+            if tag not in VOID_ELEMENTS:
+                append('</' + tag + '>')
+        else:
+            if element.text:
+                append(escape_text(element.text))
+            for child in element:
+                walk(child)
+        if element.tail:
+            append(escape_text(element.tail))
+
+    # html5lib's tree builder adds the <tbody> for rows outside one
+    def walk_table(table):
+        in_tbody = False
+        for child in table:
+            if child.tag == 'tr' and not in_tbody:
+                append('<tbody>')
+                in_tbody = True
+            elif child.tag != 'tr' and isinstance(child.tag, basestring) and in_tbody:
+                append('</tbody>')
+                in_tbody = False
+            walk(child)
+        if in_tbody:
+            append('</tbody>')
+
+    if body.text:
+        append(escape_text(body.text))
+    for child in body:
+        walk(child)
+    return u''.join(out)
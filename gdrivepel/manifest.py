@@ -0,0 +1,225 @@
+import codecs
+import os
+import os.path
+import shutil
+import threading
+
+from metadata import dump_metadata, load_metadata, make_sidecar_filename
+
+# Persistent record of what the downloader wrote on the last run,
+# keyed by Google Drive file id.  Used by the --incremental mode
+# to skip export/download and post-processing of unchanged items,
+# and by --sync to relocate moved items and prune removed ones.
+
+MANIFEST_VERSION = 1
+
+def make_manifest_filename(root_id):
+    return '_manifest_' + root_id + '.yml'
+
+# What identifies an item's content, unlike version, which Drive also
+# bumps for renames, moves and other metadata changes.  Uploaded files
+# have a checksum and a head revision, Google Docs only the time their
+# content was last modified.
+def make_content_id(item):
+    if item.get('md5Checksum'):
+        return 'md5:' + item['md5Checksum']
+    if item.get('headRevisionId'):
+        return 'revision:' + item['headRevisionId']
+    if item.get('modifiedDate'):
+        return 'modified:' + item['modifiedDate']
+    return None
+
+class DownloadManifest(object):
+    def __init__(self, manifest_file):
+        self.manifest_file = manifest_file
+        # Entries read from the previous run
+        self.previous = { }
+        # Entries recorded during this run
+        self.current = { }
+        # Every path recorded during this run, even if discarded later
+        self.claimed = set()
+        # For --sync: content path -> id of the item the previous run
+        # wrote there, and items whose old content was overwritten
+        self.content_owners = { }
+        self.overwritten = set()
+        self.lock = threading.Lock()
+
+    def load(self):
+        self.previous = { }
+        if os.path.exists(self.manifest_file):
+            with codecs.open(self.manifest_file, 'r', 'utf-8') as f:
+                data = load_metadata(f)
+            if isinstance(data, dict) and data.get('manifest_version') == MANIFEST_VERSION:
+                self.previous = data.get('items') or { }
+        self.content_owners = { }
+        for source_id, entry in self.previous.items():
+            for path in entry.get('content_paths') or [ ]:
+                self.content_owners[path] = source_id
+        return self.previous
+
+    def save(self):
+        data = {
+            'manifest_version': MANIFEST_VERSION,
+            'items': self.current
+        }
+        yaml_data = dump_metadata(data)
+        temp_file = self.manifest_file + '.tmp'
+        with codecs.open(temp_file, 'w+', 'utf-8') as f:
+            f.write(yaml_data)
+        os.rename(temp_file, self.manifest_file)
+
+    # True if the previous run wrote all of `paths` for this version
+    # and export type of the item, and the files are still on disk.
+    def is_unchanged(self, source_id, version, exported_type, root_path, paths):
+        entry = self.previous.get(source_id)
+        if entry is None:
+            return False
+        if entry.get('version') != version or entry.get('exported_type') != exported_type:
+            return False
+        previous_paths = entry.get('paths') or [ ]
+        for path in paths:
+            if path not in previous_paths:
+                return False
+            if not os.path.exists(os.path.join(root_path, path)):
+                return False
+        for path in entry.get('images') or [ ]:
+            if not os.path.exists(os.path.join(root_path, path)):
+                return False
+        return True
+
+    # content_paths are the downloaded or exported files, which can be
+    # copied to a new location if the item is moved or renamed
+    def record(self, source_id, version, exported_type, modified, paths, content_paths=None, kind='file',
+            content_id=None):
+        # A Drive item can have more than one parent, so accumulate paths
+        entry = self.current.get(source_id)
+        if entry is None:
+            entry = {
+                'kind': kind,
+                'version': version,
+                'content_id': content_id,
+                'exported_type': exported_type,
+                'modified': modified,
+                'paths': [ ],
+                'content_paths': [ ]
+            }
+            self.current[source_id] = entry
+        for path in paths:
+            if path not in entry['paths']:
+                entry['paths'].append(path)
+            self.claimed.add(path)
+        for path in content_paths or [ ]:
+            if path not in entry['content_paths']:
+                entry['content_paths'].append(path)
+
+    # Images that ImageLocalizer wrote next to the item's page.  Kept
+    # apart from paths, since an unchanged item keeps them (keep_images)
+    # but not the paths of a parent it was removed from.
+    def record_images(self, source_id, paths):
+        entry = self.current.get(source_id)
+        if entry is None or not paths:
+            return
+        images = entry.setdefault('images', [ ])
+        for path in paths:
+            if path not in images:
+                images.append(path)
+            self.claimed.add(path)
+
+    def keep_images(self, source_id):
+        entry = self.previous.get(source_id)
+        if entry is not None:
+            self.record_images(source_id, entry.get('images') or [ ])
+
+    # Called before writing content to `path`.  If the previous run
+    # kept another item's content there, that item can no longer be
+    # relocated from it.
+    def claim_content(self, source_id, path):
+        with self.lock:
+            self.claim_content_locked(source_id, path)
+
+    # Copy content written by the previous run for this content id
+    # (see make_content_id) and export type of the item to new_path, so
+    # that a moved or renamed item doesn't have to be fetched again.
+    # The old copy is removed by prune if nothing claims it any more.
+    # Returns False if there is no such content on disk.
+    def relocate_content(self, source_id, content_id, exported_type, root_path, new_path):
+        entry = self.previous.get(source_id)
+        if entry is None or content_id is None:
+            return False
+        if entry.get('content_id') != content_id or entry.get('exported_type') != exported_type:
+            return False
+        with self.lock:
+            if source_id in self.overwritten:
+                return False
+            for old_path in entry.get('content_paths') or [ ]:
+                old_file = os.path.join(root_path, old_path)
+                if not os.path.exists(old_file):
+                    continue
+                if old_path != new_path:
+                    self.claim_content_locked(source_id, new_path)
+                    new_file = os.path.join(root_path, new_path)
+                    dirname, basename = os.path.split(new_file)
+                    temp_file = os.path.join(dirname, '.#' + basename + '.part')
+                    shutil.copy2(old_file, temp_file)
+                    os.rename(temp_file, new_file)
+                return True
+        return False
+
+    def claim_content_locked(self, source_id, path):
+        owner = self.content_owners.get(path)
+        if owner is not None and owner != source_id:
+            self.overwritten.add(owner)
+
+    # Item ids and paths that changed since the previous run
+    def changes(self):
+        changes = { 'added': [ ], 'updated': [ ], 'moved': [ ], 'removed': [ ] }
+        for source_id, entry in self.current.items():
+            previous_entry = self.previous.get(source_id)
+            if previous_entry is None:
+                changes['added'].append({ 'id': source_id, 'paths': entry['paths'] })
+                continue
+            if previous_entry.get('version') != entry['version']:
+                changes['updated'].append({ 'id': source_id, 'paths': entry['paths'] })
+            if sorted(previous_entry.get('paths') or [ ]) != sorted(entry['paths']):
+                changes['moved'].append({ 'id': source_id, 'from': previous_entry.get('paths'),
+                    'to': entry['paths'] })
+        for source_id, previous_entry in self.previous.items():
+            if source_id not in self.current:
+                changes['removed'].append({ 'id': source_id, 'paths': previous_entry.get('paths') })
+        return changes
+
+    # Delete files that the previous run wrote and nothing in this run
+    # claimed, then any folders left empty.  Returns the deleted paths.
+    def prune(self, root_path):
+        removed = [ ]
+        dirnames = set()
+        for entry in self.previous.values():
+            for path in (entry.get('paths') or [ ]) + (entry.get('images') or [ ]):
+                if path in self.claimed or path in removed:
+                    continue
+                local_path = os.path.join(root_path, path)
+                if os.path.isfile(local_path):
+                    os.remove(local_path)
+                    removed.append(path)
+                    dirnames.add(os.path.dirname(path))
+                # JSON metadata written with --meta_sidecar
+                sidecar_file = make_sidecar_filename(local_path)
+                if os.path.isfile(sidecar_file):
+                    os.remove(sidecar_file)
+
+        # Deepest first, so that emptied parents go too
+        for dirname in sorted(dirnames, key=lambda d: -len(d.split('/'))):
+            while dirname:
+                local_dir = os.path.join(root_path, dirname)
+                if not os.path.isdir(local_dir) or os.listdir(local_dir):
+                    break
+                os.rmdir(local_dir)
+                removed.append(dirname + '/')
+                dirname = os.path.dirname(dirname)
+        return removed
+
+    # Forget any item recorded with this path, so the next run fetches it again
+    def discard(self, path):
+        for source_id, entry in list(self.current.items()):
+            if path in entry['paths']:
+                del self.current[source_id]
@@ -0,0 +1,93 @@
+import codecs
+import datetime
+import json
+import os.path
+import re
+import yaml
+
+import dateutil.parser
+from dateutil.tz import tzoffset, tzutc
+
+# Reading and writing of the _meta_*.yml, _folder_.yml and navmenu
+# files, shared by the downloader, the readers and the generators.
+#
+# Uses libyaml's CSafeLoader/CSafeDumper when PyYAML was built with
+# it, which is several times faster than the pure Python versions.
+# Metadata can also be written to a JSON sidecar next to the .yml
+# file, <name>.yml.json, which YamlReader reads instead when it is
+# at least as new as the .yml file.
+
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+YamlDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+# 2016-01-31T12:34:56.789Z, as Drive returns them, or with an offset
+ISO_DATE_RE = re.compile(r'^(\d{4})-(\d{2})-(\d{2})(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:\.(\d{1,6})\d*)?)?)?'
+    r'\s*(Z|[+-]\d{2}:?\d{2})?$')
+
+UTC = tzutc()
+
+def make_sidecar_filename(meta_file):
+    return meta_file + '.json'
+
+def load_metadata(text):
+    return yaml.load(text, Loader=YamlLoader)
+
+def dump_metadata(metadata):
+    return yaml.dump(metadata, Dumper=YamlDumper, default_flow_style=False, explicit_start=True)
+
+def read_metadata(meta_file):
+    with codecs.open(meta_file, 'r', 'utf-8') as f:
+        return load_metadata(f)
+
+def write_metadata(meta_file, metadata, sidecar=False):
+    yaml_meta = dump_metadata(metadata)
+    with codecs.open(meta_file, 'w+', 'utf-8') as f:
+        f.write(yaml_meta)
+    size = len(yaml_meta)
+    if sidecar:
+        json_meta = json.dumps(metadata, default=json_default, sort_keys=True)
+        with open(make_sidecar_filename(meta_file), 'w+') as f:
+            f.write(json_meta)
+        size += len(json_meta)
+    return size
+
+# Metadata from the JSON sidecar if it is up to date, else from the .yml file
+def read_metadata_fast(meta_file):
+    sidecar_file = make_sidecar_filename(meta_file)
+    try:
+        if os.path.getmtime(sidecar_file) >= os.path.getmtime(meta_file):
+            with open(sidecar_file, 'r') as f:
+                return json.load(f)
+    except (OSError, ValueError):
+        pass
+    return read_metadata(meta_file)
+
+# Dates in user written .yml files come back from YAML as date objects
+def json_default(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    raise TypeError('%r is not JSON serializable' % value)
+
+# datetime for an ISO 8601 date, without going through
+# dateutil.parser for the common formats.  Dates without a time zone
+# are left naive, as dateutil.parser.parse would.
+def parse_date(value):
+    if isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, datetime.date):
+        return datetime.datetime(value.year, value.month, value.day)
+    m = ISO_DATE_RE.match(value.strip())
+    if m is None:
+        return dateutil.parser.parse(value)
+    year, month, day, hour, minute, second, fraction, zone = m.groups()
+    microsecond = int(fraction.ljust(6, '0')) if fraction else 0
+    tzinfo = None
+    if zone == 'Z':
+        tzinfo = UTC
+    elif zone:
+        sign = -1 if zone[0] == '-' else 1
+        zone = zone[1:].replace(':', '')
+        offset = sign * (int(zone[:2]) * 3600 + int(zone[2:]) * 60)
+        tzinfo = UTC if offset == 0 else tzoffset(None, offset)
+    return datetime.datetime(int(year), int(month), int(day), int(hour or 0), int(minute or 0),
+        int(second or 0), microsecond, tzinfo)
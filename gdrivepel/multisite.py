@@ -0,0 +1,182 @@
+from __future__ import print_function
+
+import ast
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
+import shutil
+import threading
+import time
+
+from drive_service import V3_ROOT_FIELDS
+from scheduler import RequestScheduler
+
+# Crawl several Drive folders, such as the roots of the MULTISITE
+# sites in pelicanconf.py, in one process.  Each site gets its own
+# GDriveDownloader, with its own manifest, journal and run report,
+# but they all share one SharedCrawlResources: the Drive service, the
+# request scheduler (so one quota budget), the worker threads and
+# their connections, the sanitizer processes, and the content already
+# fetched for an earlier site, so a doc shared by several sites is
+# exported once.
+
+# Key of a MULTISITE entry that holds the site's Drive folder id
+MULTISITE_FOLDER_KEY = 'GDRIVE_FOLDER_ID'
+
+# (site name, folder id) for each MULTISITE entry in a pelicanconf.py
+# with a GDRIVE_FOLDER_ID.  The file is parsed, not run, since it
+# imports the plugin and appconfig.py.
+def read_multisite_roots(conf_file):
+    with open(conf_file, 'r') as f:
+        tree = ast.parse(f.read(), conf_file)
+    multisite = None
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and [getattr(t, 'id', None) for t in node.targets] == [ 'MULTISITE' ]:
+            multisite = ast.literal_eval(node.value)
+    if not multisite:
+        raise ValueError('No MULTISITE setting in %s' % conf_file)
+    roots = [(name, site[MULTISITE_FOLDER_KEY]) for name, site in sorted(multisite.items())
+        if site.get(MULTISITE_FOLDER_KEY)]
+    if not roots:
+        raise ValueError('No MULTISITE entry in %s has a %s' % (conf_file, MULTISITE_FOLDER_KEY))
+    return roots
+
+class SharedCrawlResources(object):
+    def __init__(self, drive_auth, max_qps=10.0, max_retries=8, verbose=False):
+        self.drive_auth = drive_auth
+        self.drive_service = None
+        self.verbose = verbose
+        # One quota budget for all sites
+        self.scheduler = RequestScheduler(rate=max_qps, max_retries=max_retries, verbose=verbose)
+        # Per worker thread connections, kept from site to site
+        self.thread_local = threading.local()
+        self.worker_pool = None
+        self.post_pool = None
+        self.lock = threading.Lock()
+        # (source id, version, export type) -> file written for an
+        # earlier site, and the other way around
+        self.content_files = { }
+        self.content_keys = { }
+        self.shared_count = 0
+
+    def get_service(self):
+        if self.drive_service is None:
+            self.drive_service = self.drive_auth.build_service()
+        return self.drive_service
+
+    def get_worker_pool(self, workers):
+        if self.worker_pool is None:
+            self.worker_pool = ThreadPool(workers)
+        return self.worker_pool
+
+    def get_post_pool(self, post_workers):
+        if self.post_pool is None:
+            self.post_pool = multiprocessing.Pool(post_workers)
+        return self.post_pool
+
+    # Called when a site's crawl fails, since tasks may still be running
+    def terminate(self):
+        if self.worker_pool is not None:
+            self.worker_pool.terminate()
+            self.worker_pool = None
+        if self.post_pool is not None:
+            self.post_pool.terminate()
+            self.post_pool = None
+
+    def close(self):
+        for pool in [self.worker_pool, self.post_pool]:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        self.worker_pool = None
+        self.post_pool = None
+
+    # Remember that content_file holds this version of the item.  If
+    # another item is written to the same file later, it no longer does.
+    def record_content(self, source_id, version, exported_type, content_file):
+        key = (source_id, version, exported_type)
+        with self.lock:
+            old_key = self.content_keys.get(content_file)
+            if old_key is not None and old_key != key:
+                del self.content_files[old_key]
+            self.content_files[key] = content_file
+            self.content_keys[content_file] = key
+
+    # Copy content fetched for an earlier site to content_file.
+    # Returns False if no earlier site has it.
+    def copy_content(self, source_id, version, exported_type, content_file):
+        with self.lock:
+            old_file = self.content_files.get((source_id, version, exported_type))
+        if old_file is None or old_file == content_file or not os.path.exists(old_file):
+            return False
+        dirname, basename = os.path.split(content_file)
+        temp_file = os.path.join(dirname, '.#' + basename + '.part')
+        shutil.copyfile(old_file, temp_file)
+        os.rename(temp_file, content_file)
+        with self.lock:
+            self.shared_count += 1
+        return True
+
+class MultiSiteCrawl(object):
+    """
+    Runs a GDriveDownloader for each (site name, folder id), one site
+    after the other, with shared resources.  downloader_class and
+    downloader_args are what a single site run would be built with.
+    """
+
+    def __init__(self, roots, dest_base, downloader_class, downloader_args):
+        self.roots = roots
+        self.dest_base = dest_base
+        self.downloader_class = downloader_class
+        self.downloader_args = downloader_args
+        self.shared = None
+        # (site name, folder id, run report or None, seconds)
+        self.results = [ ]
+
+    def run(self, drive_auth):
+        args = self.downloader_args
+        self.shared = SharedCrawlResources(drive_auth, max_qps=args.get('max_qps', 10.0),
+            max_retries=args.get('max_retries', 8), verbose=args.get('verbose', False))
+        root_items = None
+        try:
+            for site_name, folder_id in self.roots:
+                start_time = time.time()
+                downloader = self.downloader_class(shared=self.shared, site_name=site_name, **args)
+                if root_items is None:
+                    root_items = self.get_root_items(downloader)
+                print('Site "%s": crawling folder %s into %s' % (site_name, folder_id, self.dest_base))
+                downloader.recursiveDownloadInto(folder_id, self.dest_base, item=root_items[folder_id])
+                downloader.postProcess()
+                self.results.append((site_name, folder_id, downloader.run_report, time.time() - start_time))
+        except:
+            self.shared.terminate()
+            raise
+        self.shared.close()
+        self.print_summary()
+
+    # Each root folder is written to dest_base under its slugged title,
+    # so two roots with the same slug would share a folder and prune
+    # each other's files.  Fetches every root before anything is
+    # crawled, and raises ValueError if two of them collide.
+    def get_root_items(self, downloader):
+        downloader.initService()
+        root_items = { }
+        slug_sites = { }
+        for site_name, folder_id in self.roots:
+            item = downloader.getItem(folder_id, V3_ROOT_FIELDS)
+            local_title = downloader.getLocalTitle(item)[0]
+            if local_title in slug_sites:
+                raise ValueError('Sites "%s" and "%s" would both be written to %s' % (
+                    slug_sites[local_title], site_name, os.path.join(self.dest_base, local_title)))
+            slug_sites[local_title] = site_name
+            root_items[folder_id] = item
+        return root_items
+
+    def print_summary(self):
+        print('Multi-site crawl of %d sites: %s, %d files copied from an earlier site' % (
+            len(self.results), self.shared.scheduler.summary(), self.shared.shared_count))
+        for site_name, folder_id, report, seconds in self.results:
+            counters = (report or { }).get('counters', { })
+            print('  %s (%s): %d files done, %d fetched, %d failed, %.1fs' % (site_name, folder_id,
+                counters.get('files_done', 0), counters.get('files_fetched', 0),
+                counters.get('files_failed', 0), seconds))
@@ -4,9 +4,6 @@ import fnmatch
 import logging
 import os.path
 import re
-import yaml
-
-import dateutil.parser
 
 from markdown import Markdown
 from markdown.inlinepatterns import Pattern
@@ -16,6 +13,8 @@ from pelican.readers import BaseReader, MarkdownReader
 from pelican.urlwrappers import Author
 from pelican.utils import pelican_open
 
+from gdrivepel.metadata import parse_date, read_metadata_fast
+
 # logger for this file
 logger = logging.getLogger(__name__)
 
@@ -94,8 +93,8 @@ class YamlReader(BaseReader):
         content = None
         metadata = dict()
         self._source_path = source_path
-        with pelican_open(source_path) as text:
-            metadata = yaml.load(text)
+        # From the JSON sidecar, if the downloader wrote one
+        metadata = read_metadata_fast(source_path)
 
         # Turn these into expected objects
         # 'author': pelican.urlwrappers.Author object
@@ -104,7 +103,7 @@ class YamlReader(BaseReader):
         # 'date' and 'modified': datetime.Date object (initially UTC)
         for key in ['date', 'modified']:
             if key in metadata:
-                metadata[key] = dateutil.parser.parse(metadata[key])
+                metadata[key] = parse_date(metadata[key])
         return content, metadata
 
 def on_readers_init(readers):
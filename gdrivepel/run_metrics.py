@@ -0,0 +1,148 @@
+from __future__ import print_function
+
+import json
+import os
+import threading
+import time
+
+# Counters and latency histograms for a downloader run, cheap enough
+# to leave on: recording a sample is a dict lookup, a few additions and
+# an append under a lock.  There is one sample per request or file, so
+# the samples are kept and percentiles are exact, interpolated between
+# the two nearest samples.
+
+def make_report_filename(root_id):
+    return '_run_report_' + root_id + '.json'
+
+class LatencyHistogram(object):
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.samples = [ ]
+        self.sorted_samples = None
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+        self.samples.append(seconds)
+        self.sorted_samples = None
+
+    def percentile(self, fraction):
+        if self.count == 0:
+            return None
+        if self.sorted_samples is None:
+            self.sorted_samples = sorted(self.samples)
+        samples = self.sorted_samples
+        position = fraction * (len(samples) - 1)
+        i = int(position)
+        if i + 1 >= len(samples):
+            return samples[-1]
+        return samples[i] + (samples[i + 1] - samples[i]) * (position - i)
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'total_seconds': self.total,
+            'mean_seconds': self.total / self.count if self.count else None,
+            'min_seconds': self.min,
+            'max_seconds': self.max,
+            'p50_seconds': self.percentile(0.5),
+            'p90_seconds': self.percentile(0.9),
+            'p99_seconds': self.percentile(0.99)
+        }
+
+class RunMetrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.counters = { }
+        # phase (list, export, download, write_meta, sanitize, ...) -> histogram
+        self.phases = { }
+        # API method (drive.files.list, content, ...) -> histogram
+        self.methods = { }
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.progress_thread = None
+        self.progress_stop = threading.Event()
+
+    def increment(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def count(self, name):
+        return self.counters.get(name, 0)
+
+    def record_phase(self, phase, seconds, bytes_in=0, bytes_out=0):
+        with self.lock:
+            histogram = self.phases.get(phase)
+            if histogram is None:
+                histogram = self.phases[phase] = LatencyHistogram()
+            histogram.add(seconds)
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+    def record_method(self, method, seconds, error=None):
+        with self.lock:
+            histogram = self.methods.get(method)
+            if histogram is None:
+                histogram = self.methods[method] = LatencyHistogram()
+            histogram.add(seconds)
+            if error is not None:
+                key = 'errors.%s.%s' % (method, error)
+                self.counters[key] = self.counters.get(key, 0) + 1
+
+    def report(self):
+        with self.lock:
+            return {
+                'started': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(self.start_time)),
+                'elapsed_seconds': time.time() - self.start_time,
+                'counters': dict(self.counters),
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'phases': dict([(k, h.as_dict()) for k, h in self.phases.items()]),
+                'methods': dict([(k, h.as_dict()) for k, h in self.methods.items()])
+            }
+
+    def write_report(self, report_file, extra=None):
+        report = self.report()
+        if extra:
+            report.update(extra)
+        temp_file = report_file + '.tmp'
+        with open(temp_file, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write('\n')
+        os.rename(temp_file, report_file)
+        return report
+
+    # One line of progress: items done and listed, rate and ETA for
+    # the items listed so far (more may turn up as listing goes on).
+    def progress_line(self):
+        elapsed = max(time.time() - self.start_time, 0.001)
+        done = self.count('files_done')
+        listed = self.count('files_listed')
+        rate = done / elapsed
+        line = 'Progress: %d of %d listed files done, %d folders listed, %.1f files/sec' % (
+            done, listed, self.count('folders_listed'), rate)
+        if rate > 0 and listed > done:
+            line += ', ETA %.0fs' % ((listed - done) / rate)
+        return line
+
+    def start_progress(self, interval):
+        def report_progress():
+            while not self.progress_stop.wait(interval):
+                print(self.progress_line())
+        self.progress_thread = threading.Thread(target=report_progress)
+        self.progress_thread.daemon = True
+        self.progress_thread.start()
+
+    def stop_progress(self):
+        if self.progress_thread is not None:
+            self.progress_stop.set()
+            self.progress_thread.join()
+            self.progress_thread = None
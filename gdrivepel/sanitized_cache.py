@@ -0,0 +1,89 @@
+import hashlib
+import os
+import shutil
+import threading
+
+# Sanitized HTML, stored by a key made from the raw export, the <head>
+# that sanitize would write for the metadata, and the sanitizer rule
+# set (see sanitizer.rules_version), so that a doc whose export and
+# metadata haven't changed is not run through the sanitizer again.
+#
+# Objects are files in <cache_dir>/ab/abcdef....html, written by
+# rename and found by name, so the post-processing processes can share
+# the cache without an index.  A file's mtime is its last use.
+
+def make_sanitized_key(raw_content, head_html, rules_version):
+    h = hashlib.sha1()
+    h.update(rules_version)
+    h.update(hashlib.sha1(raw_content).digest())
+    h.update(hashlib.sha1(head_html.encode('utf-8')).digest())
+    return h.hexdigest()
+
+# Hardlink (or copy, across file systems) path to file_out, replacing
+# whatever file_out was
+def link_file(path, file_out):
+    dirname, basename = os.path.split(file_out)
+    temp_file = os.path.join(dirname, '.#' + basename + '.part')
+    if os.path.exists(temp_file):
+        os.remove(temp_file)
+    try:
+        os.link(path, temp_file)
+    except OSError:
+        shutil.copyfile(path, temp_file)
+    os.rename(temp_file, file_out)
+
+class SanitizedCache(object):
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def object_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.html')
+
+    # Link the cached output for key to file_out.  Returns False if
+    # there is none.
+    def link_to(self, key, file_out):
+        path = self.object_path(key)
+        if not os.path.exists(path):
+            return False
+        link_file(path, file_out)
+        # Mark as recently used, for prune
+        os.utime(path, None)
+        return True
+
+    def store(self, key, content):
+        path = self.object_path(key)
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # Another process got there first
+                pass
+        temp_file = '%s.%d.%s.tmp' % (path, os.getpid(), threading.current_thread().ident)
+        with open(temp_file, 'wb') as f:
+            f.write(content.encode('utf-8'))
+        os.rename(temp_file, path)
+
+    # Remove the least recently used outputs until the cache holds at
+    # most max_bytes.  Returns the number removed.
+    def prune(self, max_bytes):
+        objects = [ ]
+        total_bytes = 0
+        if not os.path.isdir(self.cache_dir):
+            return 0
+        for dirpath, dirnames, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if not filename.endswith('.html'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                st = os.stat(path)
+                objects.append((st.st_mtime, st.st_size, path))
+                total_bytes += st.st_size
+        removed = 0
+        for mtime, size, path in sorted(objects):
+            if total_bytes <= max_bytes:
+                break
+            os.remove(path)
+            total_bytes -= size
+            removed += 1
+        return removed
@@ -1,24 +1,43 @@
 import cgi
 import codecs
+import functools
+import hashlib
 import os
 import re
 import sys
-import yaml
+
+from metadata import read_metadata
+from sanitized_cache import make_sanitized_key
+from semantic_html import find_class_tags, rewrite_semantic
 
 # Find patched bleach module
 sys.path.append(os.path.join(os.path.dirname(__file__), '../../bleach'))
 from bleach import clean
 
+# Optional, for the faster lxml engine
+try:
+    from lxml_clean import clean as lxml_clean
+except ImportError:
+    lxml_clean = None
+
 # mozilla/bleach and or html5lib tokenizer/sanitizer still have some bugs
 # 1.  <html><head><style> doesn't seem to be stripped
 # 2.  html entities are messed up. See https://github.com/mozilla/bleach/issues/143
-# 3.  Find some way to remove "empty" elements, such as: <a></a>, <li></li>, <p></p> etc.
-# 4.  Remove <span> tag if "class" attribute was filtered out
+# Empty elements and <span>s are taken care of by rewrite_semantic
 
 ENTITY_REPLACEMENTS = {
-    '\xa0': '&nbsp;'
+    u'\xa0': '&nbsp;'
 }
 
+# Engines for sanitize: bleach (html5lib), or lxml (libxml2), which
+# gives the same output for Google Docs exports several times faster
+SANITIZER_ENGINES = [ 'bleach', 'lxml' ]
+DEFAULT_SANITIZER_ENGINE = 'bleach'
+
+# Bump when sanitize changes its output in a way that rules_version
+# doesn't see, to invalidate cached output
+SANITIZER_VERSION = 5
+
 def slugify(title):
     return re.sub(r'[^-._a-z0-9]', '-', title, flags=re.IGNORECASE).lower()
 
@@ -30,38 +49,33 @@ def make_meta_filename(basename):
 
 def swap_entities(text):
     for k, v in ENTITY_REPLACEMENTS.items():
-        text = re.sub(k, v, text)
+        text = text.replace(k, v)
     return text
 
-# Look for the style that represents "<strong>"
-bold_class = None
+class DocumentState(object):
+    """
+    What the attribute filters need to know about the document being
+    sanitized.  Each document gets its own, and the callables in
+    MY_ALLOWED_ATTRIBUTES are called with it as their first argument,
+    so that several documents can be sanitized at once in threads.
+    """
 
-def get_bold_class():
-    global bold_class
-    return bold_class
-
-# .c3{font-weight:bold}
-def set_bold_class(content):
-    global bold_class
-    m = re.search(r'\.(c\d+)\{font-weight:bold\}', content)
-    if m:
-        bold_class = m.group(1)
-    else:
-        bold_class = None
-    return bold_class
+    def __init__(self, content):
+        # Generated classes that make text bold, italic or underlined
+        self.class_tags = find_class_tags(content)
 
 # TODO: change style width: and height: to attributes
-def img_attributes(name, value):
+def img_attributes(document, name, value):
     if name in ['src', 'alt', 'style']:
         return True
     return False
 
-# TODO: change <span> with bold class to <strong>
-def span_attributes(name, value):
-    bold_class = get_bold_class()
-    # print 'filter_span_class bold_class="%r", attr %s="%s"' % (bold_class, name, value)
-    if bold_class is not None and name == 'class' and value == bold_class:
-        return True
+# Keep the classes that rewrite_semantic turns into <strong>, <em>, <u>
+def span_attributes(document, name, value):
+    if name == 'class':
+        for class_name in value.split():
+            if class_name in document.class_tags:
+                return True
     return False
 
 MY_ALLOWED_TAGS = [
@@ -107,57 +121,166 @@ MY_ALLOWED_STYLES = [
     'width', 'height'
 ]
 
+IMG_STYLE_RE = re.compile(r'(<img\b[^>]*?\sstyle=")([^"]*)(")', re.IGNORECASE)
+
+CHAR_REF_RE = re.compile(r'&#(?:[xX]([0-9a-fA-F]+)|([0-9]+));?')
+
 MY_EXCLUDED_META_NAMES = [
     'title'
 ]
 
+# The CSS check drops a whole style attribute if any declaration in it
+# fails, as the transform: rotate(0.00rad) on Docs images does, so
+# keep just the allowed declarations of <img> styles before cleaning
+def trim_image_styles(content):
+    def trim(m):
+        declarations = [d.strip() for d in m.group(2).split(';')]
+        declarations = [d for d in declarations if d.split(':')[0].strip().lower() in MY_ALLOWED_STYLES]
+        return m.group(1) + '; '.join(declarations) + m.group(3)
+    return IMG_STYLE_RE.sub(trim, content)
+
+# html5lib decodes numeric character references as HTML5 says to (NUL
+# and surrogates to U+FFFD, 0x80-0x9F as Windows-1252), libxml2 drops
+# them, and also drops control characters and U+FFFE and U+FFFF, which
+# XML can't hold.  Rewrite these references to what HTML5 would decode
+# them to, or to U+FFFD, so that both engines see the same text.
+def normalize_char_refs(content):
+    def normalize(m):
+        if m.group(1) is not None:
+            code = int(m.group(1), 16)
+        else:
+            code = int(m.group(2))
+        if 0x80 <= code <= 0x9f:
+            try:
+                code = ord(chr(code).decode('cp1252'))
+            except UnicodeDecodeError:
+                # Undefined in Windows-1252, left as the C1 control
+                return m.group(0)
+        elif (code == 0 or 0xd800 <= code <= 0xdfff or code > 0x10ffff or code in [ 0xfffe, 0xffff ] or
+                (code < 0x20 and code not in [ 0x09, 0x0a, 0x0d ])):
+            code = 0xfffd
+        else:
+            return m.group(0)
+        return '&#x%X;' % code
+    return CHAR_REF_RE.sub(normalize, content)
+
 def head(metadata):
     title = metadata.get('title', 'TITLE')
     head_lines = [ '<head>', 
         '<meta name="charset" content="utf-8">', 
         '<title>%s</title>' % cgi.escape(title) ]
-    for name, content in metadata.iteritems():
+    # Sorted, so that the output (and the sanitized cache key) doesn't
+    # depend on the order of the keys in the dict
+    for name, content in sorted(metadata.iteritems()):
         if content and name not in MY_EXCLUDED_META_NAMES:
             value = cgi.escape(str(content).replace("&", "&amp;")) 
             head_lines.append('<meta name="%s" content="%s">' % (name, value))
     head_lines.append('</head>')
     return '\n'.join(head_lines)
 
-def sanitize(content, metadata):
-    # parse content looking for the span class that signifies "bold"
-    styles = [ ]
-    bold_class = set_bold_class(content)
-    if bold_class:
-        styles = [ '<style>.' + bold_class + '{font-weight:bold}</style>' ]
-
-    # parse body of html
-    i = content.index('<body')
-    body = clean(content[i:], 
-        tags=MY_ALLOWED_TAGS, attributes=MY_ALLOWED_ATTRIBUTES,
-        styles=MY_ALLOWED_STYLES, strip=True, strip_comments=True)
-
-    # build a complete html5 document with title, meta elements and bold style
-    html = '<!doctype html>\n<html>\n'
-    html += head(metadata)
-    html += '<body>\n'
-    html += '\n'.join(styles)
-    html += swap_entities(body)
-    html += '</body>\n</html>\n'
-    return html
-
-def sanitize_html_file(file_in, file_out, metadata):
-    with codecs.open(file_in, 'r', 'utf-8') as f_in:
-        file_content = f_in.read()
-        sanitized_content = sanitize(file_content, metadata)
-        with codecs.open(file_out, 'w+', 'utf-8') as f_out:
-            f_out.write(sanitized_content)
+# Hash of everything that decides sanitize's output besides the
+# content and the metadata: the allow-lists, filter functions and engine
+rules_versions = { }
+
+def rules_version(engine=DEFAULT_SANITIZER_ENGINE):
+    version = rules_versions.get(engine)
+    if version is None:
+        attributes = [ ]
+        for tag, allowed in sorted(MY_ALLOWED_ATTRIBUTES.items()):
+            if callable(allowed):
+                allowed = (allowed.__name__, allowed.__code__.co_code, allowed.__code__.co_consts)
+            else:
+                allowed = sorted(allowed)
+            attributes.append((tag, allowed))
+        rules = (SANITIZER_VERSION, engine, sorted(MY_ALLOWED_TAGS), attributes,
+            sorted(MY_ALLOWED_STYLES), sorted(MY_EXCLUDED_META_NAMES), sorted(ENTITY_REPLACEMENTS.items()))
+        version = rules_versions[engine] = hashlib.sha1(repr(rules)).hexdigest()
+    return version
+
+def check_engine(engine):
+    if engine not in SANITIZER_ENGINES:
+        raise ValueError('Unknown sanitizer engine %r, not in %r' % (engine, SANITIZER_ENGINES))
+    if engine == 'lxml' and lxml_clean is None:
+        raise ImportError('The lxml sanitizer engine needs the lxml package')
+
+# The attribute allow-lists for one document, with the filters bound to it
+def document_attributes(document):
+    attributes = { }
+    for tag, allowed in MY_ALLOWED_ATTRIBUTES.items():
+        if callable(allowed):
+            allowed = functools.partial(allowed, document)
+        attributes[tag] = allowed
+    return attributes
+
+class Sanitizer(object):
+    """
+    Sanitizes Google Docs HTML exports with one engine.  Keeps no state
+    between documents, so one Sanitizer can be used by several threads.
+    """
+
+    def __init__(self, engine=DEFAULT_SANITIZER_ENGINE):
+        check_engine(engine)
+        self.engine = engine
+
+    def clean_body(self, content, document):
+        attributes = document_attributes(document)
+        content = normalize_char_refs(trim_image_styles(content))
+        if self.engine == 'lxml':
+            return lxml_clean(content, tags=MY_ALLOWED_TAGS, attributes=attributes,
+                styles=MY_ALLOWED_STYLES, strip_comments=True)
+
+        # parse body of html
+        i = content.index('<body')
+        return clean(content[i:], 
+            tags=MY_ALLOWED_TAGS, attributes=attributes,
+            styles=MY_ALLOWED_STYLES, strip=True, strip_comments=True)
+
+    def sanitize(self, content, metadata):
+        # parse content's style sheet for the classes that mean bold etc.
+        document = DocumentState(content)
+        body = self.clean_body(content, document)
+        body = rewrite_semantic(body, document.class_tags)
+
+        # build a complete html5 document with title and meta elements
+        return ''.join([ '<!doctype html>\n<html>\n',
+            head(metadata),
+            '<body>\n',
+            swap_entities(body),
+            '</body>\n</html>\n' ])
+
+def clean_body(content, engine=DEFAULT_SANITIZER_ENGINE):
+    return Sanitizer(engine).clean_body(content, DocumentState(content))
+
+def sanitize(content, metadata, engine=DEFAULT_SANITIZER_ENGINE):
+    return Sanitizer(engine).sanitize(content, metadata)
+
+# With a SanitizedCache, unchanged docs are linked to the cached output
+# instead of being sanitized again.  Returns True if that happened.
+def sanitize_html_file(file_in, file_out, metadata, engine=DEFAULT_SANITIZER_ENGINE, cache=None):
+    with open(file_in, 'rb') as f_in:
+        raw_content = f_in.read()
+    if cache is not None:
+        key = make_sanitized_key(raw_content, head(metadata), rules_version(engine))
+        if cache.link_to(key, file_out):
+            return True
+
+    sanitized_content = sanitize(raw_content.decode('utf-8'), metadata, engine)
+    # Replace rather than rewrite, file_out may be linked to a cached copy
+    dirname, basename = os.path.split(file_out)
+    temp_file = os.path.join(dirname, '.#' + basename + '.part')
+    with codecs.open(temp_file, 'w+', 'utf-8') as f_out:
+        f_out.write(sanitized_content)
+    os.rename(temp_file, file_out)
+    if cache is not None:
+        cache.store(key, sanitized_content)
+    return False
 
 def prepend_markdown_metadata(file_in, file_out, metadata):
     with codecs.open(file_in, 'r', 'utf-8') as f_in:
         file_content = f_in.read()
         with codecs.open(file_out, 'w+', 'utf-8') as f_out:
             add_blank_line = False
-            for name, content in metadata.iteritems():
+            for name, content in sorted(metadata.iteritems()):
                 if content:
                     f_out.write('%s: %s\n' % (name.capitalize(), content))
                     add_blank_line = True
@@ -171,6 +294,8 @@ if __name__ == '__main__':
     import argparse
 
     parser = argparse.ArgumentParser(description='Run bleach on a source html file')
+    parser.add_argument('--engine', choices=SANITIZER_ENGINES, default=DEFAULT_SANITIZER_ENGINE,
+        help='sanitizer engine')
     parser.add_argument('file_name', metavar='FILE_NAME', help='html target file name')
     args = parser.parse_args()
 
@@ -179,5 +304,5 @@ if __name__ == '__main__':
     file_from = os.path.join(dirname, rawname)
     file_to = os.path.join(dirname, basename)
     meta_name = '_meta_' + basename + '.yml'
-    metadata = yaml.load(codecs.open(os.path.join(dirname, meta_name), 'r', 'utf-8'))
-    sanitize_html_file(file_from, file_to, metadata)
+    metadata = read_metadata(os.path.join(dirname, meta_name))
+    sanitize_html_file(file_from, file_to, metadata, args.engine)
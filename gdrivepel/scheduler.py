@@ -0,0 +1,222 @@
+from __future__ import print_function
+
+import json
+import random
+import socket
+import threading
+import time
+
+import httplib2
+from apiclient.errors import HttpError
+
+# Responses worth retrying.  403 is only retried for the rate limit
+# reasons below, other 403s are permission errors.
+RETRYABLE_STATUSES = [ 429, 500, 502, 503, 504 ]
+RATE_LIMIT_REASONS = [ 'userRateLimitExceeded', 'rateLimitExceeded' ]
+
+class RequestScheduler(object):
+    """
+    Shared by all downloader threads to keep Drive API requests under
+    quota.  Requests take a token from a token bucket refilled at `rate`
+    per second.  Retryable errors are retried with exponential backoff
+    and jitter, or after the server's Retry-After delay.  Rate limit
+    errors halve the rate, and each success adds back a little of it,
+    up to the configured maximum.
+    """
+
+    def __init__(self, rate=10.0, max_retries=8, base_delay=1.0, max_delay=64.0, verbose=False, metrics=None):
+        self.max_rate = float(rate)
+        self.min_rate = min(self.max_rate, 0.5)
+        self.rate = self.max_rate
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.verbose = verbose
+        # RunMetrics, for per method latency and errors
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.tokens = max(1.0, self.rate)
+        self.updated = time.time()
+
+        # Counters
+        self.requests = 0
+        self.throttled = 0
+        self.rate_limited = 0
+        self.retried = 0
+
+    def acquire(self):
+        # Reserve a token, then wait outside the lock until it is due
+        with self.lock:
+            now = time.time()
+            burst = max(1.0, self.rate)
+            self.tokens = min(burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1.0
+            self.requests += 1
+            wait = 0.0
+            if self.tokens < 0:
+                wait = -self.tokens / self.rate
+                self.throttled += 1
+        if wait > 0:
+            time.sleep(wait)
+
+    def on_success(self):
+        with self.lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 100.0)
+
+    def on_rate_limited(self):
+        with self.lock:
+            self.rate_limited += 1
+            self.rate = max(self.min_rate, self.rate / 2.0)
+            if self.verbose:
+                print('Rate limited, slowing down to %.2f requests/sec' % self.rate)
+
+    def backoff_delay(self, attempt):
+        delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+        return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+    def call(self, fn, *args, **kwargs):
+        """Call fn, retrying on rate limit, server and network errors."""
+        return self.call_method('call', fn, *args, **kwargs)
+
+    def call_method(self, method, fn, *args, **kwargs):
+        """Like call, recording each attempt's latency under `method`."""
+        attempt = 0
+        while True:
+            self.acquire()
+            start_time = time.time()
+            try:
+                result = fn(*args, **kwargs)
+                self.on_success()
+                if self.metrics is not None:
+                    self.metrics.record_method(method, time.time() - start_time)
+                return result
+            except HttpError as e:
+                status = e.resp.status
+                reason = error_reason(e.content)
+                if self.metrics is not None:
+                    self.metrics.record_method(method, time.time() - start_time, str(status))
+                if is_rate_limited(status, reason):
+                    self.on_rate_limited()
+                elif status not in RETRYABLE_STATUSES:
+                    raise
+                if attempt >= self.max_retries:
+                    raise
+                delay = retry_after(e.resp)
+                if delay is None:
+                    delay = self.backoff_delay(attempt)
+                error = '%d %s' % (status, reason or '')
+            except (socket.error, httplib2.HttpLib2Error) as e:
+                if self.metrics is not None:
+                    self.metrics.record_method(method, time.time() - start_time, e.__class__.__name__)
+                if attempt >= self.max_retries:
+                    raise
+                delay = self.backoff_delay(attempt)
+                error = str(e)
+
+            with self.lock:
+                self.retried += 1
+            if self.metrics is not None:
+                self.metrics.increment('retries')
+            if self.verbose:
+                print('Request failed (%s), retry %d in %.1fs' % (error, attempt + 1, delay))
+            time.sleep(delay)
+            attempt += 1
+
+    def execute(self, request, http):
+        """Execute an API request object with retries."""
+        method = getattr(request, 'methodId', None) or 'execute'
+        return self.call_method(method, request.execute, http=http)
+
+    def request(self, http, uri, **kwargs):
+        """
+        Make a plain http request (content downloads) with retries.
+        Retryable responses raise HttpError when retries run out,
+        other responses are returned to the caller.
+        """
+        def attempt_request():
+            resp, content = http.request(uri, **kwargs)
+            # Only a 403 body needs parsing for the rate limit reason,
+            # content downloads can be large
+            if resp.status in RETRYABLE_STATUSES or (
+                    resp.status == 403 and is_rate_limited(resp.status, error_reason(content))):
+                raise HttpError(resp, content, uri=uri)
+            return (resp, content)
+        return self.call_method('content', attempt_request)
+
+    def execute_batch(self, requests, new_batch, http):
+        """
+        Execute API requests as one batch request, which is retried as
+        a whole if it fails.  Each request in the batch counts against
+        the quota, so each one takes a token.  Returns a (response,
+        error) tuple for each request, in order.  The caller decides
+        whether to retry failed requests, with should_retry.
+        """
+        results = [ None ] * len(requests)
+        def callback(request_id, response, exception):
+            results[int(request_id)] = (response, exception)
+        batch = new_batch(callback=callback)
+        for i, request in enumerate(requests):
+            batch.add(request, request_id=str(i))
+        for request in requests[1:]:
+            self.acquire()
+        self.call_method('batch', batch.execute, http=http)
+        return results
+
+    def should_retry(self, error, attempt):
+        """True if a request that failed inside a batch is worth retrying."""
+        if attempt >= self.max_retries:
+            return False
+        if isinstance(error, HttpError):
+            status = error.resp.status
+            if is_rate_limited(status, error_reason(error.content)):
+                self.on_rate_limited()
+            elif status not in RETRYABLE_STATUSES:
+                return False
+        elif not isinstance(error, (socket.error, httplib2.HttpLib2Error)):
+            return False
+        with self.lock:
+            self.retried += 1
+        if self.metrics is not None:
+            self.metrics.increment('retries')
+        return True
+
+    def counters(self, since=None):
+        """Counters, less the ones in `since` from an earlier call."""
+        with self.lock:
+            counters = {
+                'requests': self.requests,
+                'throttled': self.throttled,
+                'rate_limited': self.rate_limited,
+                'retried': self.retried
+            }
+        if since is not None:
+            for name in counters:
+                counters[name] -= since.get(name, 0)
+        return counters
+
+    def summary(self, since=None):
+        counters = self.counters(since)
+        return ('%d requests, %d throttled locally, %d rate limited by server, %d retried' %
+            (counters['requests'], counters['throttled'], counters['rate_limited'], counters['retried']))
+
+def is_rate_limited(status, reason):
+    return status == 429 or (status == 403 and reason in RATE_LIMIT_REASONS)
+
+def error_reason(content):
+    # Google API error bodies look like {"error": {"errors": [{"reason": ...}]}}
+    try:
+        errors = json.loads(content)['error']['errors']
+        return errors[0]['reason']
+    except Exception:
+        return None
+
+def retry_after(resp):
+    value = resp.get('retry-after')
+    if value is not None:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+    return None
@@ -0,0 +1,146 @@
+import re
+
+# Turns the styling of a Google Docs export into plain HTML.  Docs puts
+# every run of text in a <span> with a generated class, .c3{...}, from
+# the <style> in the <head>.  find_class_tags reads that style sheet
+# once and maps each class that makes text bold, italic or underlined
+# to <strong>, <em> or <u>.  rewrite_semantic then makes one pass over
+# the cleaned body: spans with those classes become the tags, other
+# spans are unwrapped, runs of the same tag are merged, and <p>, <a>,
+# <li> left with nothing in them are dropped.
+#
+# The body it is given is cleaned output (see sanitizer.clean_body),
+# so every start tag has an end tag, except void ones such as <img>,
+# and there is no "<" in text.
+
+# In the order they are nested, outermost first
+SEMANTIC_TAGS = [ 'strong', 'em', 'u' ]
+
+# Dropped when nothing but whitespace is left in them
+DROP_IF_EMPTY = set([ 'p', 'a', 'li' ] + SEMANTIC_TAGS)
+
+VOID_ELEMENTS = set([ 'area', 'br', 'col', 'hr', 'img', 'wbr' ])
+
+# Tags that already give the style, so adding it again is noise
+IMPLIED_BY = {
+    'strong': set([ 'strong', 'b', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'th' ]),
+    'em': set([ 'em', 'i' ]),
+    'u': set([ 'u', 'a' ])
+}
+
+STYLE_BLOCK_RE = re.compile(r'<style[^>]*>(.*?)</style>', re.DOTALL | re.IGNORECASE)
+CSS_COMMENT_RE = re.compile(r'/\*.*?\*/', re.DOTALL)
+CSS_RULE_RE = re.compile(r'([^{}]+)\{([^{}]*)\}')
+CLASS_SELECTOR_RE = re.compile(r'^\.([-\w]+)$')
+
+TAG_RE = re.compile(r'<(/?)([a-zA-Z][a-zA-Z0-9]*)((?:[^>"\']|"[^"]*"|\'[^\']*\')*)>')
+CLASS_ATTRIBUTE_RE = re.compile(r'\sclass=(?:"([^"]*)"|\'([^\']*)\')')
+
+def declaration_tags(declarations, tags):
+    for declaration in declarations.split(';'):
+        if ':' not in declaration:
+            continue
+        name, value = declaration.split(':', 1)
+        name = name.strip().lower()
+        value = value.strip().lower()
+        if name == 'font-weight':
+            bold = value in [ 'bold', 'bolder' ] or (value.isdigit() and int(value) >= 600)
+            tags['strong'] = bold
+        elif name == 'font-style':
+            tags['em'] = value in [ 'italic', 'oblique' ]
+        elif name in [ 'text-decoration', 'text-decoration-line' ]:
+            tags['u'] = 'underline' in value
+
+# {class: [tag, ...]} for the single class rules, .c3{...}, in the
+# document's <style> elements that make text bold, italic or underlined.
+# Later rules win, as in CSS.
+def find_class_tags(content):
+    i = content.find('<body')
+    if i >= 0:
+        content = content[:i]
+    styles = { }
+    for style in STYLE_BLOCK_RE.findall(content):
+        style = CSS_COMMENT_RE.sub('', style)
+        for selectors, declarations in CSS_RULE_RE.findall(style):
+            # Drop an @import or @charset ahead of the first rule
+            selectors = selectors.split(';')[-1]
+            for selector in selectors.split(','):
+                m = CLASS_SELECTOR_RE.match(selector.strip())
+                if m:
+                    declaration_tags(declarations, styles.setdefault(m.group(1), { }))
+    class_tags = { }
+    for class_name, tags in styles.items():
+        tags = [tag for tag in SEMANTIC_TAGS if tags.get(tag)]
+        if tags:
+            class_tags[class_name] = tags
+    return class_tags
+
+def span_tags(attributes, class_tags):
+    m = CLASS_ATTRIBUTE_RE.search(attributes)
+    if m is None:
+        return [ ]
+    found = set()
+    for class_name in (m.group(1) or m.group(2) or '').split():
+        found.update(class_tags.get(class_name, [ ]))
+    return [tag for tag in SEMANTIC_TAGS if tag in found]
+
+def rewrite_semantic(body, class_tags):
+    out = [ ]
+    # [tag, index of its start tag in out, merged with the one before]
+    # for open elements, and [ 'span', None, number of tags it opened ]
+    stack = [ ]
+
+    def is_open(tags):
+        for entry in stack:
+            if entry[0] in tags:
+                return True
+        return False
+
+    def start(tag, start_tag):
+        # <strong>a</strong><strong>b</strong> is <strong>ab</strong>
+        if tag in SEMANTIC_TAGS and out and out[-1] == '</' + tag + '>':
+            out.pop()
+            stack.append([tag, len(out), True])
+        else:
+            stack.append([tag, len(out), False])
+            out.append(start_tag)
+
+    def end():
+        tag, i, merged = stack.pop()
+        if tag in DROP_IF_EMPTY and ''.join(out[i + (0 if merged else 1):]).strip(' \t\r\n') == '':
+            del out[i:]
+            if merged:
+                out.append('</' + tag + '>')
+        else:
+            out.append('</' + tag + '>')
+
+    pos = 0
+    for m in TAG_RE.finditer(body):
+        if m.start() > pos:
+            out.append(body[pos:m.start()])
+        pos = m.end()
+        closing, tag, attributes = m.groups()
+        tag = tag.lower()
+        if tag == 'span':
+            if closing:
+                if stack and stack[-1][0] == 'span':
+                    for i in range(stack.pop()[2]):
+                        end()
+                continue
+            opened = 0
+            for semantic_tag in span_tags(attributes, class_tags):
+                if not is_open(IMPLIED_BY[semantic_tag]):
+                    start(semantic_tag, '<' + semantic_tag + '>')
+                    opened += 1
+            stack.append([ 'span', None, opened ])
+        elif closing:
+            if stack and stack[-1][0] == tag:
+                end()
+            else:
+                out.append(m.group(0))
+        elif tag in VOID_ELEMENTS:
+            out.append(m.group(0))
+        else:
+            start(tag, m.group(0))
+    out.append(body[pos:])
+    return ''.join(out)
@@ -0,0 +1,82 @@
+import codecs
+import hashlib
+import os
+import re
+import urllib
+import zipfile
+from xml.sax.saxutils import escape, unescape
+
+from images import image_extension, make_image_filename
+
+# Google Docs can export a doc as a zip of its HTML and an images/
+# folder, which gets a doc and all of its images in one request.
+# unpack_doc_zip writes the HTML where the HTML export would have gone,
+# so it is sanitized like one, and the images next to it, under the
+# names ImageLocalizer gives them, with the <img> srcs pointing at them.
+#
+# The zip's directory is at its end, so the archive is downloaded to a
+# file first, then each member is copied out in blocks.  Member names
+# are never used as local paths.
+
+ZIP_EXPORT_TYPE = 'application/zip'
+
+COPY_BLOCK_SIZE = 1024 * 1024
+
+IMG_SRC_RE = re.compile(r'(<img\b[^>]*?\ssrc=")([^"]*)(")', re.IGNORECASE)
+
+# Copy an archive member to temp_file, returning its SHA-1
+def copy_member(archive, info, temp_file):
+    h = hashlib.sha1()
+    with archive.open(info) as f_in:
+        with open(temp_file, 'wb') as f_out:
+            while True:
+                block = f_in.read(COPY_BLOCK_SIZE)
+                if not block:
+                    break
+                h.update(block)
+                f_out.write(block)
+    return h.hexdigest()
+
+# Unpack a doc's zip export to html_file and the images next to it.
+# Returns the file names of the images.
+def unpack_doc_zip(zip_file, html_file):
+    dirname, basename = os.path.split(html_file)
+    temp_file = os.path.join(dirname, '.#' + basename + '.image.part')
+    # Member name -> image file name
+    images = { }
+    html_info = None
+    with zipfile.ZipFile(zip_file) as archive:
+        for info in archive.infolist():
+            if info.filename.endswith('/'):
+                continue
+            if info.filename.lower().endswith('.html') and html_info is None:
+                html_info = info
+                continue
+            object_hash = copy_member(archive, info, temp_file)
+            with open(temp_file, 'rb') as f:
+                extension = image_extension(f.read(12))
+            if extension is None:
+                os.remove(temp_file)
+                continue
+            filename = make_image_filename(object_hash, extension)
+            # Same name, same content
+            os.rename(temp_file, os.path.join(dirname, filename))
+            images[info.filename] = filename
+        if html_info is None:
+            raise ValueError('No HTML file in the zip export')
+        with archive.open(html_info) as f:
+            html = f.read().decode('utf-8')
+
+    def replace_src(m):
+        src = unescape(m.group(2), { '&quot;': '"' })
+        filename = images.get(src) or images.get(urllib.unquote(src.encode('utf-8')).decode('utf-8'))
+        if filename is None:
+            return m.group(0)
+        return m.group(1) + escape(filename) + m.group(3)
+    html = IMG_SRC_RE.sub(replace_src, html)
+
+    temp_file = os.path.join(dirname, '.#' + basename + '.part')
+    with codecs.open(temp_file, 'w+', 'utf-8') as f:
+        f.write(html)
+    os.rename(temp_file, html_file)
+    return sorted(set(images.values()))
@@ -94,6 +94,8 @@ AUTOMENU = True
 # MULTISITE configuration (custom).
 # If present and not an empty list, this is a multi-site installation.
 # Otherwise it is a list of site prefix dictionaries
+# Add a 'GDRIVE_FOLDER_ID' to a site to have copy_folder.py --multisite
+# download it, in one process with the other sites.
 MULTISITE = {
   'district': {
     'PATH': 'sites/district',